@@ -0,0 +1,80 @@
+"""
+Micro-benchmark: finding the latest version matching a requirement, for a package with many releases.
+
+Compares the original approach (matching every version string against the requirement, keeping the last match)
+to `quicklib.requirements.find_latest_matching_version` (parsed versions cached per package, newest-first search).
+
+Run from the repository root:
+
+    python benchmarks/bench_freeze_matching.py [--releases 5000] [--repeat 20]
+"""
+import os
+import sys
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from quicklib.requirements import Requirement, find_latest_matching_version, ParsedVersionsCache  # noqa: E402
+import quicklib.requirements  # noqa: E402
+
+
+def synthetic_releases(count):
+    # botocore-like: 1.<minor>.<micro>, with an occasional pre-release
+    releases = []
+    minor = 0
+    while len(releases) < count:
+        for micro in range(100):
+            releases.append("1.%d.%d" % (minor, micro))
+            if micro % 25 == 0:
+                releases.append("1.%d.%drc1" % (minor, micro + 1))
+        minor += 1
+    return releases[:count]
+
+
+def original_latest_matching_version(req, available_versions):
+    matching_versions = [v for v in available_versions if req.specifier.contains(v, prereleases=True)]
+    return matching_versions[-1] if matching_versions else None
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--releases", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    releases = synthetic_releases(args.releases)
+    requirement_lines = [
+        "botocore",
+        "botocore>=1.3",
+        "botocore~=1.20.0",
+        "botocore<1.10,>=1.2",
+    ]
+    requirements = [Requirement(line) for line in requirement_lines]
+
+    for req in requirements:
+        assert original_latest_matching_version(req, releases) == find_latest_matching_version(req, releases), req
+
+    def run_original():
+        for req in requirements:
+            original_latest_matching_version(req, releases)
+
+    def run_cold():
+        # a fresh cache for every round: versions are parsed once per round instead of once per requirement
+        quicklib.requirements.parsed_versions_cache = ParsedVersionsCache()
+        for req in requirements:
+            find_latest_matching_version(req, releases)
+
+    def run_warm():
+        for req in requirements:
+            find_latest_matching_version(req, releases)
+
+    print("%d releases, %d requirement lines, best of %d rounds:" % (len(releases), len(requirements), args.repeat))
+    results = {}
+    for name, func in [("original", run_original), ("cached (cold)", run_cold), ("cached (warm)", run_warm)]:
+        results[name] = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print("  %-15s %9.2f ms  (x%.1f)" % (name, results[name] * 1000, results["original"] / results[name]))
+
+
+if __name__ == '__main__':
+    main()
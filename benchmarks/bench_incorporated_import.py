@@ -0,0 +1,72 @@
+"""
+Benchmark: importing quicklib from the incorporated zip, the way the bootstrap block of a library's setup script does
+at install time.
+
+Compares a source-only zip (the default) to a precompiled one (`create_incorporated_zip --precompile`). Each import
+runs in a fresh interpreter and loads quicklib.setupapi, as the setup script's `quicklib.setup(...)` call does - `import
+quicklib` alone loads next to nothing. The startup time of an interpreter that imports nothing but setuptools (which
+quicklib.setupapi imports too) is reported separately.
+
+Run from the repository root:
+
+    python benchmarks/bench_incorporated_import.py [--repeat 20]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from setuptools.dist import Distribution  # noqa: E402
+
+from quicklib.incorporator import CreateIncorporatedZip  # noqa: E402
+
+IMPORT_CODE = (
+    "import sys; sys.path.insert(0, %r); import quicklib.setupapi; assert quicklib.setupapi.__file__.startswith(%r)")
+
+
+def create_zip(path, precompile):
+    cmd = CreateIncorporatedZip(Distribution())
+    cmd.create_zip(path, precompile=precompile)
+
+
+def time_python(code, cwd, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        # -I: isolated from the environment, so quicklib can only be imported from the zip
+        subprocess.check_call([sys.executable, "-I", "-c", code], cwd=cwd)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="quicklib-bench-") as temp_dir:
+        zips = {}
+        for name, precompile in [("source only", False), ("precompiled", True)]:
+            zips[name] = os.path.join(temp_dir, "quicklib_incorporated.%s.zip" % ("pyc" if precompile else "src"))
+            create_zip(zips[name], precompile)
+
+        results = {"interpreter + setuptools": time_python("import setuptools", temp_dir, args.repeat)}
+        for name, zip_path in zips.items():
+            results[name] = time_python(IMPORT_CODE % (zip_path, zip_path), temp_dir, args.repeat)
+
+    print("import quicklib.setupapi from the incorporated zip, %d fresh interpreters each:" % args.repeat)
+    for name, timings in results.items():
+        print("  %-25s min %7.1f ms  median %7.1f ms" % (
+            name, min(timings) * 1000, statistics.median(timings) * 1000))
+    for name in zips:
+        print("  %-25s %7.1f ms on top of interpreter + setuptools (median)" % (
+            name, (statistics.median(results[name]) - statistics.median(results["interpreter + setuptools"])) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,410 @@
+"""
+Benchmark suite: times each quicklib build stage against synthetic libraries of configurable size, and end-to-end
+`sdist` builds of the examples.
+
+Results are printed and written as JSON (--output). Given a previous results file (--baseline), stages whose median
+time grew by more than --max-slowdown are reported and the exit code is non-zero.
+
+Run from the repository root:
+
+    python benchmarks/bench_stages.py [--packages 10] [--modules 20] [--requirements 20] [--tags 10] [--history 500]
+                                      [--repeat 5] [--stages discovery,git_version] [--output results.json]
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from argparse import ArgumentParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+EXAMPLES_DIR = os.path.join(REPO_ROOT, "examples")
+sys.path.insert(0, REPO_ROOT)
+
+from setuptools.dist import Distribution  # noqa: E402
+from setuptools.command.egg_info import FileList  # noqa: E402
+from distutils.archive_util import make_tarball  # noqa: E402
+
+from quicklib import archiving  # noqa: E402
+from quicklib.datafiles import ManifestInRewriter  # noqa: E402
+from quicklib.gitrepo import GitRepository  # noqa: E402
+from quicklib.incorporator import CreateIncorporatedZip, INCORPORATED_ZIP, INCORPORATED_ZIP_ENV  # noqa: E402
+from quicklib.manifest import CompiledManifest  # noqa: E402
+from quicklib.requirements import FreezeRequirementsCommand  # noqa: E402
+from quicklib.setupapi import SetupModifier  # noqa: E402
+from quicklib.versioning import (  # noqa: E402
+    GitVersionCalculator, PureGitVersionCalculator, VersionScope, get_work_tree_paths,
+)
+from quicklib.virtualfiles import undo_virtual_files  # noqa: E402
+
+from synthetic import create_synthetic_library, run_git  # noqa: E402
+
+RESULTS_FORMAT_VERSION = 1
+
+# (library, example directory, build command) - the same builds as tests/setup_examples.sh
+QUICKLIB_SETUP = ["-m", "quicklib.cli.quicklibsetup"]
+EXAMPLE_BUILDS = [
+    ("examplelibrary", "examplelibrary", ["setup.py"]),
+    ("examplelibrary_2a", "examplelibrary2", ["setup_examplelibrary_2a.py"]),
+    ("examplelibrary_2b", "examplelibrary2", ["subdir/setup_examplelibrary_2b.py"]),
+    ("include-by-import", "include_by_import", QUICKLIB_SETUP),
+    ("manifested", "manifested", QUICKLIB_SETUP),
+    ("minimal", "minimal", QUICKLIB_SETUP),
+]
+
+# freeze_requirements must not reach out to pypi while benchmarking
+STUB_PLUGIN_SETUP_CFG = "[freeze_requirements]\nserver_plugin = synthetic:StubServerPlugin\ncache_ttl = 0\n"
+
+MANIFEST_TEMPLATE_LINES = [
+    "include *.md *.txt",
+    "recursive-include pkg_* *.py",
+    "graft data",
+    "prune docs",
+    "global-exclude *.py[cod] *.tmp",
+]
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    orig_cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(orig_cwd)
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+class Context:
+    """shared state of a benchmark run: the synthetic library and a work area"""
+    def __init__(self, work_dir, args):
+        self.work_dir = work_dir
+        self.args = args
+        self.library_path = os.path.join(work_dir, "synthetic")
+        self.incorporated_zip = os.path.join(work_dir, INCORPORATED_ZIP)
+        self.env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join([REPO_ROOT, BENCHMARKS_DIR]),
+            **{INCORPORATED_ZIP_ENV: self.incorporated_zip}
+        )
+
+    def prepare(self):
+        create_synthetic_library(
+            self.library_path, packages=self.args.packages, modules=self.args.modules,
+            requirements=self.args.requirements, tags=self.args.tags, history=self.args.history,
+        )
+        CreateIncorporatedZip(Distribution()).create_zip(self.incorporated_zip)
+
+    def run_setup(self, cwd, command_line, setup_args):
+        subprocess.run([sys.executable] + command_line + setup_args, cwd=cwd, env=self.env, check=True,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+# ---- stages: each returns a dict of {case name: function to time}
+
+def stage_sdist_examples(ctx):
+    cases = {}
+    for library, example, command_line in EXAMPLE_BUILDS:
+        example_copy = os.path.join(ctx.work_dir, "examples", example)
+        if not os.path.exists(example_copy):
+            shutil.copytree(os.path.join(EXAMPLES_DIR, example), example_copy)
+            with open(os.path.join(example_copy, "setup.cfg"), "w") as f:
+                f.write(STUB_PLUGIN_SETUP_CFG)
+            run_git(["init", "-q"], example_copy)
+            run_git(["add", "-A"], example_copy)
+            run_git(["commit", "-q", "-m", "example"], example_copy)
+            run_git(["tag", "-a", "1.0", "-m", "version 1.0"], example_copy)
+
+        def build(example_copy=example_copy, command_line=command_line):
+            ctx.run_setup(example_copy, command_line, ["sdist", "--dist-dir", os.path.join(ctx.work_dir, "dist")])
+        cases[library] = build
+    return cases
+
+
+def stage_sdist_synthetic(ctx):
+    def build():
+        ctx.run_setup(ctx.library_path, ["setup.py"], ["sdist", "--dist-dir", os.path.join(ctx.work_dir, "dist")])
+    return {"synthetic": build}
+
+
+def stage_wheel_synthetic(ctx):
+    wheel_dir = os.path.join(ctx.work_dir, "wheels")
+    backend_command_line = ["-c", "import sys, quicklib.build_backend as b; b.build_wheel(sys.argv[1])"]
+
+    def build_with_setuptools():
+        ctx.run_setup(ctx.library_path, ["setup.py"], ["bdist_wheel", "--dist-dir", wheel_dir])
+
+    def build_with_backend():
+        ctx.run_setup(ctx.library_path, backend_command_line, [wheel_dir])
+
+    return {"setup.py bdist_wheel": build_with_setuptools, "quicklib.build_backend": build_with_backend}
+
+
+def stage_discovery(ctx):
+    def discover(**setup_kwargs):
+        kwargs = dict(name="synthetic", version="1.0", **setup_kwargs)
+        with working_directory(ctx.library_path), quiet():
+            SetupModifier()._modify_setup_kwargs(kwargs)
+        return kwargs['packages']
+
+    return {
+        "auto": lambda: discover(),
+        "top_packages": lambda: discover(top_packages=["pkg_0", "pkg_1"]),
+    }
+
+
+def stage_git_version(ctx):
+    def calculate(calculator, cold, scopes=None):
+        if cold:
+            GitRepository._describe_memo.clear()
+            shutil.rmtree(os.path.join(ctx.library_path, ".git", "quicklib"), ignore_errors=True)
+        with working_directory(ctx.library_path), quiet():
+            if scopes:
+                return calculator.getVersions(scopes)
+            return calculator.getVersion()
+
+    def is_dirty(paths=None):
+        with working_directory(ctx.library_path), quiet():
+            return GitRepository.discover(".").is_dirty(paths)
+
+    # one scope per package, as a monorepo releasing each package as its own library would have
+    with working_directory(ctx.library_path):
+        package_scopes = [VersionScope.from_paths("", ["pkg_%d" % i]) for i in range(ctx.args.packages)]
+        package_files = get_work_tree_paths(
+            os.path.join(dir_path, name) for dir_path, _, names in os.walk("pkg_0") for name in names)
+    return {
+        "git describe": lambda: calculate(GitVersionCalculator(), cold=False),
+        "python (cold)": lambda: calculate(PureGitVersionCalculator(), cold=True),
+        "python (warm)": lambda: calculate(PureGitVersionCalculator(), cold=False),
+        "git, per package scope": lambda: calculate(GitVersionCalculator(), cold=False, scopes=package_scopes),
+        "python, per package scope (cold)": lambda: calculate(PureGitVersionCalculator(), cold=True,
+                                                              scopes=package_scopes),
+        "python, dirty check (whole tree)": lambda: is_dirty(),
+        "python, dirty check (one package)": lambda: is_dirty(package_files),
+        "git, dirty check (one package)": lambda: GitVersionCalculator().isDirty(package_files),
+    }
+
+
+def stage_freeze_requirements(ctx):
+    with open(os.path.join(ctx.library_path, "requirements.txt")) as f:
+        install_requires = f.read().splitlines()
+
+    def freeze():
+        dist = Distribution(dict(name="synthetic", install_requires=list(install_requires)))
+        cmd = FreezeRequirementsCommand(dist)
+        cmd.server_plugin = "synthetic:StubServerPlugin"
+        cmd.cache_ttl = 0
+        with quiet():
+            cmd.ensure_finalized()
+            cmd.run()
+        return dist.install_requires
+
+    return {"stub plugin": freeze}
+
+
+def stage_manifest(ctx):
+    def rewrite():
+        with working_directory(ctx.library_path):
+            rewriter = ManifestInRewriter("MANIFEST.in")
+            for line in MANIFEST_TEMPLATE_LINES:
+                rewriter.add_line(line)
+            rewriter.rewrite()
+            undo_virtual_files()
+
+    def evaluate():
+        with working_directory(ctx.library_path), quiet():
+            file_list = FileList()
+            file_list.findall()
+            for line in MANIFEST_TEMPLATE_LINES:
+                file_list.process_template_line(line)
+        return file_list.files
+
+    def evaluate_compiled():
+        with working_directory(ctx.library_path), quiet():
+            return CompiledManifest(MANIFEST_TEMPLATE_LINES).evaluate([])
+
+    return {
+        "ManifestInRewriter": rewrite, "evaluate template": evaluate, "evaluate compiled template": evaluate_compiled,
+    }
+
+
+def stage_archive(ctx):
+    archive_dir = os.path.join(ctx.work_dir, "archives")
+    tree_dir = os.path.join(ctx.work_dir, "release-tree")
+
+    def copy_tree():
+        # into a fresh directory, like link_tree (copytree only accepts an existing one from python 3.8)
+        shutil.rmtree(tree_dir + "-copy", ignore_errors=True)
+        shutil.copytree(ctx.library_path, tree_dir + "-copy", ignore=shutil.ignore_patterns(".git"))
+
+    def link_tree():
+        shutil.rmtree(tree_dir, ignore_errors=True)
+        shutil.copytree(ctx.library_path, tree_dir, copy_function=archiving.link_or_copy,
+                        ignore=shutil.ignore_patterns(".git"))
+
+    def archive(parallel):
+        if not os.path.exists(tree_dir):
+            link_tree()
+        with working_directory(ctx.work_dir), quiet():
+            if parallel:
+                archiving.make_tarball(os.path.join(archive_dir, "parallel"), "release-tree")
+            else:
+                make_tarball(os.path.join(archive_dir, "distutils"), "release-tree", compress="gzip")
+
+    return {
+        "copy tree": copy_tree,
+        "link tree": link_tree,
+        "distutils tarball": lambda: archive(parallel=False),
+        "parallel tarball": lambda: archive(parallel=True),
+    }
+
+
+STAGES = {
+    "sdist_examples": stage_sdist_examples,
+    "sdist_synthetic": stage_sdist_synthetic,
+    "wheel_synthetic": stage_wheel_synthetic,
+    "discovery": stage_discovery,
+    "git_version": stage_git_version,
+    "freeze_requirements": stage_freeze_requirements,
+    "manifest": stage_manifest,
+    "archive": stage_archive,
+}
+
+
+def time_case(func, repeat):
+    # one untimed warm-up round, so one-time costs (imports, first-run caches) don't skew the results
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_stages(ctx, stage_names, repeat):
+    results = []
+    for stage_name in stage_names:
+        try:
+            cases = STAGES[stage_name](ctx)
+        except Exception:
+            results.append(dict(stage=stage_name, case=None, ok=False, error=traceback.format_exc()))
+            continue
+        for case_name, func in cases.items():
+            result = dict(stage=stage_name, case=case_name, repeat=repeat)
+            try:
+                timings = time_case(func, repeat)
+            except Exception as exc:
+                if isinstance(exc, subprocess.CalledProcessError) and exc.output:
+                    error = exc.output.decode("utf-8", "replace")
+                else:
+                    error = traceback.format_exc()
+                result.update(ok=False, error=error)
+            else:
+                result.update(
+                    ok=True, seconds=timings,
+                    min=min(timings), median=statistics.median(timings), mean=statistics.mean(timings),
+                )
+            print("  %-22s %-26s %s" % (stage_name, case_name, (
+                "median %9.2f ms  min %9.2f ms" % (result['median'] * 1000, result['min'] * 1000) if result['ok'] else
+                "FAILED")))
+            results.append(result)
+    return results
+
+
+def get_environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, encoding='ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        python=sys.version.split()[0],
+        implementation=platform.python_implementation(),
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        quicklib_commit=commit,
+    )
+
+
+def compare_to_baseline(results, baseline_path, max_slowdown):
+    """:return: list of (stage, case, baseline median, median) that got slower than allowed"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    baseline_medians = {(r['stage'], r['case']): r['median'] for r in baseline['results'] if r.get('ok')}
+    regressions = []
+    for result in results:
+        baseline_median = baseline_medians.get((result['stage'], result['case']))
+        if result.get('ok') and baseline_median and result['median'] > baseline_median * max_slowdown:
+            regressions.append((result['stage'], result['case'], baseline_median, result['median']))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--packages", type=int, default=10, help="top-level packages (N)")
+    parser.add_argument("--modules", type=int, default=20, help="modules per package (M)")
+    parser.add_argument("--requirements", type=int, default=20, help="requirements (K)")
+    parser.add_argument("--tags", type=int, default=10, help="version tags (T)")
+    parser.add_argument("--history", type=int, default=500, help="commits of history")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated, out of: %s" % ", ".join(STAGES))
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="results JSON file of a previous run to compare to")
+    parser.add_argument("--max-slowdown", type=float, default=1.25,
+                        help="slowdown (median time ratio) compared to the baseline that counts as a regression")
+    args = parser.parse_args()
+    stage_names = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown_stages = [s for s in stage_names if s not in STAGES]
+    if unknown_stages:
+        parser.error("unknown stages: %s" % ", ".join(unknown_stages))
+
+    parameters = dict(packages=args.packages, modules=args.modules, requirements=args.requirements, tags=args.tags,
+                      history=args.history, repeat=args.repeat)
+    print("quicklib stage benchmarks (%s)" % ", ".join("%s=%s" % item for item in parameters.items()))
+    with tempfile.TemporaryDirectory(prefix="quicklib-bench-") as work_dir:
+        ctx = Context(work_dir, args)
+        ctx.prepare()
+        results = run_stages(ctx, stage_names, args.repeat)
+
+    report = dict(
+        format=RESULTS_FORMAT_VERSION,
+        created_at=time.time(),
+        environment=get_environment(),
+        parameters=parameters,
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("results written to %s" % args.output)
+
+    exit_code = 0
+    for result in results:
+        if not result['ok']:
+            print("\n%s / %s failed:\n%s" % (result['stage'], result['case'], result['error']))
+            exit_code = 1
+    if args.baseline:
+        regressions = compare_to_baseline(results, args.baseline, args.max_slowdown)
+        for stage, case, baseline_median, median in regressions:
+            print("regression: %s / %s median %.2f ms, was %.2f ms (x%.2f)" % (
+                stage, case, median * 1000, baseline_median * 1000, median / baseline_median))
+        if regressions:
+            exit_code = 1
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
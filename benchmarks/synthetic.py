@@ -0,0 +1,125 @@
+"""
+Synthetic quicklib libraries for benchmarking: a git repository with N top-level packages of M modules each,
+K requirements, T version tags and a history of H commits, plus a requirements server plugin that answers without
+touching the network.
+"""
+import os
+import subprocess
+import textwrap
+
+SETUP_PY = textwrap.dedent("""
+    import quicklib
+
+    quicklib.setup(
+        name="synthetic",
+        description="a synthetic library for benchmarking quicklib",
+        version_module_paths=["pkg_0/version.py"],
+        freeze_requirements={
+            'server_plugin': 'synthetic:StubServerPlugin',
+            'cache_ttl': 0,
+        },
+        manifest_extra=[
+            "graft data",
+            "global-exclude *.tmp",
+        ],
+    )
+    """)[1:]
+
+MODULE_TEMPLATE = textwrap.dedent('''
+    """synthetic module %(index)d"""
+    import os
+
+
+    def function_%(index)d(value):
+        return [os.path.join(str(value), str(i)) for i in range(%(index)d + 1)]
+
+
+    class Class%(index)d:
+        def __init__(self, value):
+            self.value = value
+
+        def method(self):
+            return function_%(index)d(self.value)
+    ''')[1:]
+
+
+class StubServerPlugin:
+    """a freeze_requirements plugin with a fixed, long release history for every package"""
+    CACHEABLE = False
+    RELEASES = ["1.%d.%d" % (minor, micro) for minor in range(30) for micro in range(10)]
+
+    @classmethod
+    def get_ordered_package_versions(cls, package_name, pypi_server=None):
+        return list(cls.RELEASES)
+
+
+def run_git(args, cwd, input=None):
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="bench", GIT_AUTHOR_EMAIL="bench@example.com",
+        GIT_COMMITTER_NAME="bench", GIT_COMMITTER_EMAIL="bench@example.com",
+    )
+    return subprocess.run(["git"] + list(args), cwd=cwd, env=env, input=input, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _history_stream(commits, tags):
+    """a git fast-import stream of `commits` commits to history.txt, with `tags` annotated tags spread among them"""
+    tagged = {commits * (i + 1) // (tags + 1): "1.%d" % i for i in range(tags)} if commits else {}
+    lines = []
+    for i in range(commits):
+        timestamp = 1500000000 + i * 60
+        message = "commit %d\n" % i
+        content = "line %d\n" % i
+        lines.append("commit refs/heads/master\nmark :%d\ncommitter bench <bench@example.com> %d +0000\n"
+                     "data %d\n%s" % (i + 1, timestamp, len(message), message))
+        if i:
+            lines.append("from :%d\n" % i)
+        lines.append("M 100644 inline history.txt\ndata %d\n%s\n" % (len(content), content))
+        if i in tagged:
+            tag_message = "version %s\n" % tagged[i]
+            lines.append("tag %s\nfrom :%d\ntagger bench <bench@example.com> %d +0000\ndata %d\n%s\n" % (
+                tagged[i], i + 1, timestamp, len(tag_message), tag_message))
+    return "".join(lines).encode("utf-8")
+
+
+def create_synthetic_library(path, packages=10, modules=20, requirements=20, tags=10, history=500):
+    """
+    create a library at `path` (which must not exist) and commit it to a new git repository.
+    the tags are spread over the history, so HEAD is some commits past the last one (unless there is no history, in
+    which case HEAD itself is tagged).
+    """
+    os.makedirs(path)
+    write_file(os.path.join(path, "setup.py"), SETUP_PY)
+    write_file(os.path.join(path, "requirements.txt"),
+               "".join("dependency-%d>=1.%d\n" % (i, i % 10) for i in range(requirements)))
+    write_file(os.path.join(path, "README.md"), "# synthetic\n")
+    for package_index in range(packages):
+        package_dir = os.path.join(path, "pkg_%d" % package_index)
+        write_file(os.path.join(package_dir, "__init__.py"), "")
+        write_file(os.path.join(package_dir, "sub", "__init__.py"), "")
+        for module_index in range(modules):
+            module_path = os.path.join(package_dir, "sub" if module_index % 2 else "", "mod_%d.py" % module_index)
+            write_file(module_path, MODULE_TEMPLATE % dict(index=module_index))
+    write_file(os.path.join(path, "pkg_0", "version.py"), '# quicklib version boilerplate\n'
+                                                           'DEV_VERSION = "0.0.0.dev0"\n__version__ = DEV_VERSION\n')
+    for data_index in range(modules):
+        write_file(os.path.join(path, "data", "file_%d.txt" % data_index), "data %d\n" % data_index)
+    # the kind of clutter a real checkout has, which package discovery has to walk past
+    for clutter_index in range(modules):
+        write_file(os.path.join(path, "docs", "_build", "page_%d.html" % clutter_index), "<html></html>\n")
+
+    run_git(["init", "-q", "-b", "master"], path)
+    run_git(["fast-import", "--quiet"], path, input=_history_stream(history, tags))
+    if history:
+        run_git(["reset", "-q", "--hard"], path)
+    run_git(["add", "-A"], path)
+    run_git(["commit", "-q", "-m", "synthetic library"], path)
+    if tags and not history:
+        run_git(["tag", "-a", "1.0", "-m", "version 1.0"], path)
@@ -1,3 +1,21 @@
-from .versioning import read_module_version
-from .setupapi import setup
-from .utils import is_packaging
+# the public names are imported on first use (PEP 562), so that `import quicklib` alone doesn't load setuptools
+_LAZY_NAMES = {
+    'read_module_version': 'quicklib.versioning',
+    'calculate_versions': 'quicklib.versioning',
+    'setup': 'quicklib.setupapi',
+    'build': 'quicklib.setupapi',
+    'is_packaging': 'quicklib.utils',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_NAMES:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    import importlib
+    value = getattr(importlib.import_module(_LAZY_NAMES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES))
@@ -0,0 +1,196 @@
+"""Zero-copy sdist release trees and multi-threaded gzip tarballs.
+
+setuptools copies every file of an sdist into a release tree, then archives it with single-threaded gzip. Here release
+tree files are hard links to the library's files (or reflinks, or copies when neither is possible), and the tarball is
+compressed in blocks on several threads, pigz-style: each block is raw-deflated on its own, primed with the last 32KB of
+the block before it, and the outputs are joined into a single gzip member. The tar stream inside is byte for byte what
+distutils writes, and the gzip header has the same fields tarfile's 'w|gz' mode writes.
+"""
+import collections
+import errno
+import os
+import shutil
+import struct
+import sys
+import tarfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from distutils import log
+from distutils.archive_util import _get_gid, _get_uid
+from distutils.dir_util import mkpath
+
+try:
+    import fcntl
+except ImportError:
+    # not available on windows
+    fcntl = None
+
+# ioctl cloning a file's extents into another file, on btrfs, xfs, and other copy-on-write file systems (linux)
+FICLONE = 0x40049409
+
+GZIP_BLOCK_SIZE = 1 << 20
+DEFLATE_WINDOW_SIZE = 1 << 15
+MAX_ARCHIVE_WORKERS = 8
+
+
+def reflink(source_path, target_path):
+    """clone source_path into target_path sharing its data blocks, raises OSError where that isn't supported"""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    try:
+        with open(source_path, "rb") as source, open(target_path, "wb") as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    except OSError:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        raise
+    shutil.copystat(source_path, target_path)
+
+
+def link_or_copy(source_path, target_path):
+    """:return: how target_path was made from source_path - 'hardlink', 'reflink' or 'copy'"""
+    try:
+        os.link(source_path, target_path)
+        return 'hardlink'
+    except OSError:
+        # other file system, links not supported or not allowed
+        pass
+    try:
+        reflink(source_path, target_path)
+        return 'reflink'
+    except OSError:
+        pass
+    shutil.copy2(source_path, target_path)
+    return 'copy'
+
+
+def unlink_if_exists(path):
+    """make way for writing a new file at path, which may be a link to a file of the library tree"""
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+class ParallelGzipFile:
+    """a write-only gzip file whose blocks are compressed on a thread pool (zlib releases the GIL while compressing)"""
+    def __init__(self, path, compresslevel=9, workers=None, mtime=None, block_size=GZIP_BLOCK_SIZE):
+        self.name = os.path.abspath(path)
+        self.mode = "wb"
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        workers = workers or min(os.cpu_count() or 1, MAX_ARCHIVE_WORKERS)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # compressed blocks not written yet, in order - bounded, so memory use is too
+        self.max_pending = workers * 2
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.window = b""
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        self.fileobj = open(path, "wb")
+        try:
+            self._write_header(mtime)
+        except BaseException:
+            self.abort()
+            raise
+
+    def _write_header(self, mtime):
+        # the same header tarfile's 'w|gz' mode writes: with the archive's name, maximal compression flag, unknown OS
+        name = os.path.basename(self.name)
+        if name.endswith(".gz"):
+            name = name[:-3]
+        timestamp = struct.pack("<L", int(time.time() if mtime is None else mtime))
+        self.fileobj.write(b"\037\213\010\010" + timestamp + b"\002\377" + name.encode("iso-8859-1", "replace") + b"\0")
+
+    def _compress(self, block, window, last):
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0,
+                                      *([window] if window else []))
+        # a sync flush ends a block on a byte boundary without ending the stream, so the next block can follow it
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def _submit(self, block, last=False):
+        self.pending.append(self.executor.submit(self._compress, block, self.window, last))
+        self.window = block[-DEFLATE_WINDOW_SIZE:]
+        while len(self.pending) > (0 if last else self.max_pending):
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self.buffer), last=True)
+            self.fileobj.write(struct.pack("<LL", self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.closed = True
+            self.executor.shutdown()
+            self.fileobj.close()
+
+    def abort(self):
+        """close without finishing the file, and remove it"""
+        self.closed = True
+        # what shutdown(cancel_futures=True) does, which needs python 3.9
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+        self.fileobj.close()
+        unlink_if_exists(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def make_tarball(base_name, base_dir, owner=None, group=None, workers=None, dry_run=0, linked_paths=()):
+    """
+    like distutils' make_tarball(..., compress="gzip"), compressing on several threads
+    :param linked_paths: files of base_dir linked rather than copied there - stored with their mtimes truncated to whole
+        seconds, as distutils' copy_file would have left them
+    """
+    archive_name = base_name + ".tar.gz"
+    mkpath(os.path.dirname(archive_name), dry_run=dry_run)
+    log.info("Creating tar archive")
+    if dry_run:
+        return archive_name
+
+    uid = _get_uid(owner)
+    gid = _get_gid(group)
+
+    linked_paths = set(os.path.normpath(path) for path in linked_paths)
+
+    def _set_uid_gid(tarinfo):
+        if tarinfo.isfile() and os.path.normpath(tarinfo.name) in linked_paths:
+            tarinfo.mtime = float(int(tarinfo.mtime))
+        if gid is not None:
+            tarinfo.gid = gid
+            tarinfo.gname = group
+        if uid is not None:
+            tarinfo.uid = uid
+            tarinfo.uname = owner
+        return tarinfo
+
+    with ParallelGzipFile(archive_name, workers=workers) as fileobj:
+        # dereference: release tree files linked to the same library file are stored as files, as if they were copies
+        with tarfile.open(fileobj=fileobj, mode="w", dereference=True) as tar:
+            tar.add(base_dir, filter=_set_uid_gid)
+    return archive_name
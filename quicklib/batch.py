@@ -0,0 +1,265 @@
+"""Build many libraries (setup scripts and YAML files) from one checkout in parallel.
+"""
+import fnmatch
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .cli.setupyml import SetupYml
+from .gitrepo import find_git_dir
+from .isolation import ISOLATED_BUILD_ENV
+from .incorporator import INCORPORATED_ZIP_ENV, find_incorporated_zip
+from .versioning import PRECOMPUTED_VERSION_ENV, PRECOMPUTED_VERSIONS_ENV, VersionScope, calculate_versions
+
+DEFAULT_SETUP_YML = "quicklib_setup.yml"
+DEFAULT_SETUP_SCRIPT = "setup.py"
+# setup scripts in non-standard locations, like examples/examplelibrary2's
+NAMED_SETUP_SCRIPT_PATTERN = "setup_*.py"
+# never searched when discovering targets with --all
+SKIPPED_DIRS = {"build", "dist", "node_modules", "__pycache__"}
+
+
+class BuildTarget:
+    """a setup script or a setup YAML file, built by running it from `cwd`"""
+    def __init__(self, path, cwd):
+        self.path = os.path.abspath(path)
+        self.cwd = os.path.abspath(cwd)
+        self.is_yml = os.path.splitext(path)[1].lower() in (".yml", ".yaml")
+
+    @classmethod
+    def from_arg(cls, arg, cwd="."):
+        """
+        a directory stands for the setup.py or quicklib_setup.yml in it, built from that directory (the usual way).
+        a file is built from `cwd`, just like running `python path/to/setup_script.py ...` would.
+        """
+        if os.path.isdir(arg):
+            for name in (DEFAULT_SETUP_YML, DEFAULT_SETUP_SCRIPT):
+                if os.path.isfile(os.path.join(arg, name)):
+                    return cls(os.path.join(arg, name), arg)
+            raise ValueError("no %s or %s found in directory %s" % (DEFAULT_SETUP_YML, DEFAULT_SETUP_SCRIPT, arg))
+        if not os.path.isfile(arg):
+            raise ValueError("build target %s not found" % arg)
+        return cls(arg, cwd)
+
+    @property
+    def name(self):
+        return os.path.relpath(self.path)
+
+    def get_command_line(self, setup_args):
+        if self.is_yml:
+            return [sys.executable, "-m", "quicklib.cli.quicklibsetup", "-s", self.path] + list(setup_args)
+        return [sys.executable, os.path.relpath(self.path, self.cwd)] + list(setup_args)
+
+
+def _is_quicklib_setup_script(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return "quicklib.setup(" in f.read()
+    except OSError:
+        return False
+
+
+def _has_packages(dir_path):
+    try:
+        names = os.listdir(dir_path)
+    except OSError:
+        return False
+    return any(os.path.isfile(os.path.join(dir_path, name, "__init__.py")) for name in names)
+
+
+def find_library_dir(script_dir, root="."):
+    """
+    :return: the directory a setup script in script_dir is run from - the nearest one (up to root) with packages in
+             it, e.g. the library's directory for a script kept in a sub-directory of it
+    """
+    root = os.path.abspath(root)
+    dir_path = os.path.abspath(script_dir)
+    while not _has_packages(dir_path):
+        if dir_path == root or os.path.dirname(dir_path) == dir_path:
+            return os.path.abspath(script_dir)
+        dir_path = os.path.dirname(dir_path)
+    return dir_path
+
+
+def discover_targets(root="."):
+    """
+    all setup.py and quicklib_setup.yml files under root, each built from its own directory, and all setup_*.py
+    scripts calling quicklib.setup, each built from its library's directory (see find_library_dir)
+    """
+    targets = []
+    for dir_path, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d not in SKIPPED_DIRS and not d.startswith(".") and
+                         not d.endswith(".egg-info"))
+        for name in (DEFAULT_SETUP_YML, DEFAULT_SETUP_SCRIPT):
+            if name in files:
+                targets.append(BuildTarget(os.path.join(dir_path, name), dir_path))
+                # a YAML-based library may keep a setup.py around for other purposes, build it once
+                break
+        if "__init__.py" in files:
+            # modules of a package, not setup scripts
+            continue
+        for name in sorted(fnmatch.filter(files, NAMED_SETUP_SCRIPT_PATTERN)):
+            path = os.path.join(dir_path, name)
+            if _is_quicklib_setup_script(path):
+                targets.append(BuildTarget(path, find_library_dir(dir_path, root)))
+    return targets
+
+
+class BuildResult:
+    def __init__(self, target, returncode=None, output="", duration=0.0, skipped_reason=None):
+        self.target = target
+        self.returncode = returncode
+        self.output = output
+        self.duration = duration
+        self.skipped_reason = skipped_reason
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+class BatchBuilder:
+    """
+    builds targets concurrently, each in its own subprocess.
+    targets sharing a working directory are built one after the other, since a build temporarily creates and modifies
+    files (version modules, egg-info, the bundled quicklib zip) in its working directory - unless builds are isolated
+    (see quicklib.isolation).
+    the git versions (of the whole repository and of every version scope YAML targets declare) are calculated in one walk
+    of the history, and they and the incorporated quicklib zip are resolved once up front and handed to all builds.
+    """
+    def __init__(self, targets, setup_args, jobs=None, stop_on_failure=False, verbose=False, isolated=False):
+        self.targets = list(targets)
+        self.setup_args = list(setup_args)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.stop_on_failure = stop_on_failure
+        self.verbose = verbose
+        self.isolated = isolated
+        self._failed = False
+
+    def get_version_scope(self, target):
+        """:return: the VersionScope of a target - only YAML ones can be read without running them"""
+        if not target.is_yml:
+            return VersionScope()
+        try:
+            setup_kwargs = SetupYml.load_from_file(target.path).setup
+            return VersionScope.from_setup_value(setup_kwargs.get('version_scope'), target.cwd)
+        except Exception:
+            # the build itself reports what's wrong
+            return VersionScope()
+
+    def precompute_versions(self):
+        """:return: {work tree: {version scope key: version}}, from a single walk of each work tree's history"""
+        scopes_by_work_tree = OrderedDict()
+        for target in self.targets:
+            try:
+                work_tree = find_git_dir(target.cwd)[1]
+            except Exception:
+                continue
+            scopes = scopes_by_work_tree.setdefault(work_tree, [VersionScope()])
+            scope = self.get_version_scope(target)
+            if scope not in scopes:
+                scopes.append(scope)
+        versions = {}
+        for work_tree, scopes in scopes_by_work_tree.items():
+            orig_cwd = os.getcwd()
+            os.chdir(work_tree)
+            try:
+                versions[work_tree] = dict(zip([scope.key for scope in scopes], calculate_versions(scopes)))
+            except Exception as exc:
+                print("warning: could not calculate git versions of %s up front (%s), builds will calculate them" % (
+                    work_tree, exc))
+                versions[work_tree] = {}
+            finally:
+                os.chdir(orig_cwd)
+        return versions
+
+    def get_target_env(self, target, versions, incorporated_zip):
+        env = dict(os.environ)
+        if incorporated_zip is not None:
+            env[INCORPORATED_ZIP_ENV] = incorporated_zip
+        try:
+            work_tree_versions = versions.get(find_git_dir(target.cwd)[1]) or {}
+        except Exception:
+            work_tree_versions = {}
+        if work_tree_versions:
+            # builds of libraries with scopes unknown up front (in setup scripts) calculate their own version
+            env[PRECOMPUTED_VERSIONS_ENV] = json.dumps(work_tree_versions)
+            if work_tree_versions.get(VersionScope().key) is not None:
+                env[PRECOMPUTED_VERSION_ENV] = work_tree_versions[VersionScope().key]
+        if self.isolated:
+            env[ISOLATED_BUILD_ENV] = "1"
+        return env
+
+    def get_group_key(self, target):
+        """targets with the same key are built one after the other"""
+        if self.isolated:
+            return target.path
+        return target.cwd
+
+    def build_target(self, target, env):
+        if self._failed and self.stop_on_failure:
+            return BuildResult(target, skipped_reason="an earlier build failed")
+        start = time.perf_counter()
+        proc = subprocess.run(target.get_command_line(self.setup_args), cwd=target.cwd, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8', errors='replace')
+        result = BuildResult(target, proc.returncode, proc.stdout, time.perf_counter() - start)
+        if not result.ok:
+            self._failed = True
+        print("%s %s (%.1fs)" % ("built" if result.ok else "FAILED", target.name, result.duration))
+        if self.verbose or not result.ok:
+            print(result.output)
+        return result
+
+    def build_group(self, group, versions, incorporated_zip):
+        return [self.build_target(target, self.get_target_env(target, versions, incorporated_zip))
+                for target in group]
+
+    def run(self):
+        """:return: list of BuildResult, in target order"""
+        versions = self.precompute_versions()
+        try:
+            incorporated_zip = find_incorporated_zip()
+        except Exception:
+            # e.g. building from a quicklib source tree, each build reports this on its own
+            incorporated_zip = None
+        groups = OrderedDict()
+        for target in self.targets:
+            groups.setdefault(self.get_group_key(target), []).append(target)
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self.build_group, group, versions, incorporated_zip)
+                       for group in groups.values()]
+            results = {}
+            for future in futures:
+                for result in future.result():
+                    results[result.target] = result
+        return [results[target] for target in self.targets]
+
+
+def print_report(results):
+    print("")
+    print("%-50s %-8s %9s" % ("library", "status", "seconds"))
+    for result in results:
+        if result.skipped_reason is not None:
+            status = "skipped"
+        else:
+            status = "ok" if result.ok else "FAILED"
+        print("%-50s %-8s %9.1f" % (result.target.name, status, result.duration))
+    failed = [r for r in results if not r.ok]
+    print("%d built, %d failed or skipped, %.1f seconds of build time" % (
+        len(results) - len(failed), len(failed), sum(r.duration for r in results)))
+
+
+def run_batch(targets, setup_args, jobs=None, stop_on_failure=False, verbose=False, isolated=False):
+    """:return: process exit code - non-zero if any target failed"""
+    if not targets:
+        print("error: no build targets found")
+        return 2
+    builder = BatchBuilder(targets, setup_args, jobs=jobs, stop_on_failure=stop_on_failure, verbose=verbose,
+                           isolated=isolated)
+    results = builder.run()
+    print_report(results)
+    return 0 if all(r.ok for r in results) else 1
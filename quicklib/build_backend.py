@@ -0,0 +1,507 @@
+"""PEP 517 build backend, driven by the same settings as quicklib.setup / quicklib_setup.yml.
+
+Wheels are written directly: packages are discovered and the version and requirements calculated just like
+quicklib.setup does, and the wheel is assembled from them in memory - without running setuptools' build, egg_info or
+manifest commands, and without virtually changing any file in the library tree. Sdists are built by the regular
+quicklib sdist build, so they stay installable without quicklib.
+
+Use it from a library's pyproject.toml:
+
+    [build-system]
+    requires = ["quicklib"]
+    build-backend = "quicklib.build_backend"
+
+Settings are read from quicklib_setup.yml if there is one, otherwise from the quicklib.setup(...) call of setup.py.
+The `setup-yml` and `setup-script` config settings select another file.
+"""
+import base64
+import contextlib
+import hashlib
+import os
+import posixpath
+import re
+import runpy
+import sys
+import zipfile
+from distutils.filelist import FileList
+
+from distutils import log
+
+import quicklib
+import quicklib.version
+from .utils import is_packaging
+from .scripting import CreateScriptHooks
+from .versioning import (
+    VersionScope, VersionSetByGit, calculate_version, get_precomputed_version, get_versioned_module_code,
+    get_work_tree_paths, normalize_version_module_path, read_module_version,
+)
+from .requirements import (
+    Requirement, UseRequirementsTxtCommand, FreezeRequirementsCommand, canonicalize_name, parse_version,
+    read_dynamic_requirements,
+)
+from .manifest import CompiledManifest
+from .setupapi import SetupModifier, create_setup_modifier, setup_from_yml
+
+SETUP_YML_SETTING = "setup-yml"
+SETUP_SCRIPT_SETTING = "setup-script"
+DEFAULT_SETUP_YML = "quicklib_setup.yml"
+DEFAULT_SETUP_SCRIPT = "setup.py"
+
+# setup kwargs describing things a pure python wheel built by this backend can't hold
+UNSUPPORTED_KWARGS = ("ext_modules", "libraries", "package_dir", "data_files", "scripts")
+
+WHEEL_TAG = "py3-none-any"
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def _get_setting(config_settings, name):
+    value = (config_settings or {}).get(name)
+    if isinstance(value, list):
+        # given more than once, the last one wins
+        value = value[-1]
+    return value
+
+
+def get_setup_source(config_settings=None):
+    """:return: (path, is_yml) of the file holding the library's quicklib settings"""
+    setup_yml = _get_setting(config_settings, SETUP_YML_SETTING)
+    setup_script = _get_setting(config_settings, SETUP_SCRIPT_SETTING)
+    if setup_yml and setup_script:
+        raise ValueError("give either %s or %s, not both" % (SETUP_YML_SETTING, SETUP_SCRIPT_SETTING))
+    if setup_yml:
+        return setup_yml, True
+    if setup_script:
+        return setup_script, False
+    if os.path.exists(DEFAULT_SETUP_YML):
+        return DEFAULT_SETUP_YML, True
+    return DEFAULT_SETUP_SCRIPT, False
+
+
+@contextlib.contextmanager
+def _script_argv(script_path):
+    # quicklib.setup looks at sys.argv[0] for the script location (requirements.txt, manifest template, ...)
+    orig_argv = sys.argv
+    sys.argv = [script_path]
+    try:
+        yield
+    finally:
+        sys.argv = orig_argv
+
+
+def capture_setup_kwargs(script_path):
+    """:return: the kwargs a setup script passes to quicklib.setup, captured by running it without building"""
+    if not os.path.exists(script_path):
+        raise Exception("setup script %s not found" % script_path)
+    captured = []
+    orig_setup = quicklib.setup
+    quicklib.setup = lambda **kwargs: captured.append(kwargs)
+    try:
+        with _script_argv(script_path):
+            runpy.run_path(script_path, run_name="__main__")
+    finally:
+        quicklib.setup = orig_setup
+    if len(captured) != 1:
+        raise Exception("expected setup script %s to call quicklib.setup once, but it was called %d times" % (
+            script_path, len(captured)))
+    return captured[0]
+
+
+def load_setup_kwargs(config_settings=None):
+    """:return: (setup script path, quicklib.setup kwargs) of the library in the current directory"""
+    path, is_yml = get_setup_source(config_settings)
+    if is_yml:
+        from .cli.setupyml import SetupYml
+        if not os.path.exists(path):
+            raise Exception("setup YAML file %s not found" % path)
+        # quicklib-setup builds as if a setup.py in the current directory was run
+        return DEFAULT_SETUP_SCRIPT, SetupYml.load_from_file(path).setup
+    return path, capture_setup_kwargs(path)
+
+
+def escape_name(name):
+    """the distribution name as used in wheel and .dist-info names"""
+    return canonicalize_name(name).replace("-", "_")
+
+
+def escape_version(version):
+    """the (normalized) version as used in wheel and .dist-info names"""
+    parsed_version = parse_version(version)
+    if parsed_version is not None:
+        return str(parsed_version).replace("-", "_")
+    # not a PEP 440 version, e.g. of a dirty work tree
+    return re.sub(r"[^A-Za-z0-9.]+", "_", version)
+
+
+def _record_hash(data):
+    digest = hashlib.sha256(data).digest()
+    return "sha256=" + base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+
+class WheelBuilder:
+    """
+    everything going into a library's wheel, calculated from its quicklib.setup kwargs.
+    files quicklib generates while packaging (version modules, script hooks) are generated in memory rather than
+    virtually created in the library tree.
+    """
+    def __init__(self, script_path, kwargs):
+        self.script_path = script_path
+        self.kwargs = dict(kwargs)
+        self.setup_modifier = create_setup_modifier(self.kwargs)
+        unsupported = [k for k in UNSUPPORTED_KWARGS if self.kwargs.get(k)]
+        if unsupported:
+            raise ValueError("setup kwargs %s are not supported by the quicklib build backend, build with the setup "
+                             "script instead" % ", ".join(unsupported))
+        if not self.kwargs.get('name'):
+            raise ValueError("the library has no name")
+        self.name = self.kwargs['name']
+        self.packages = self._find_packages()
+        # generated files depend on the version, the version may depend on the package files (without them)
+        self.generated_files = {}
+        with _script_argv(self.script_path):
+            self.version = self._calculate_version()
+            self.install_requires, self.extras_require = self._calculate_requirements()
+        self.generated_files = self._generate_files()
+
+    @property
+    def dist_info_dir(self):
+        return "%s-%s.dist-info" % (escape_name(self.name), escape_version(self.version))
+
+    @property
+    def wheel_filename(self):
+        return "%s-%s-%s.whl" % (escape_name(self.name), escape_version(self.version), WHEEL_TAG)
+
+    def _calculate_version(self):
+        sm = self.setup_modifier
+        if self.kwargs.get('version') is not None and sm.version_module_paths:
+            raise ValueError("when specifying version modules, you must not also specify hard-coded `version` in setup")
+        if not sm.version_module_paths:
+            if self.kwargs.get('version') is None:
+                raise ValueError("you must either specify version modules or give a hard-coded `version` in setup")
+            return str(self.kwargs['version'])
+        if not is_packaging():
+            # an sdist, its version modules were already set
+            return read_module_version(sm.version_module_paths[0])
+        scope = VersionScope.from_setup_value(sm.version_scope)
+        calculator = sm.version_calculator or 'git'
+        if calculator not in VersionSetByGit.VERSION_CALCULATORS:
+            raise ValueError("unknown version calculator %r, expected one of %s" % (
+                calculator, sorted(VersionSetByGit.VERSION_CALCULATORS)))
+        calculator = VersionSetByGit.VERSION_CALCULATORS[calculator]
+        dirty_scope = sm.version_dirty_scope or 'repository'
+        if dirty_scope not in VersionSetByGit.DIRTY_SCOPES:
+            raise ValueError("unknown dirty scope %r, expected one of %s" % (
+                dirty_scope, list(VersionSetByGit.DIRTY_SCOPES)))
+        precomputed_version = get_precomputed_version(scope)
+        is_precomputed_dirty = precomputed_version is not None and precomputed_version.endswith(".dirty")
+        if precomputed_version is not None and (dirty_scope == 'repository' or not is_precomputed_dirty):
+            return precomputed_version
+        # the files going into the wheel
+        dirty_paths = get_work_tree_paths(self.get_package_files()) if dirty_scope == 'manifest' else None
+        if precomputed_version is not None:
+            # precomputed for the whole work tree, but the library's own files may be unmodified
+            return precomputed_version if calculator.isDirty(dirty_paths) else precomputed_version[:-len(".dirty")]
+        return calculate_version(calculator, scope, dirty_paths)
+
+    def _calculate_requirements(self):
+        if not is_packaging():
+            return read_dynamic_requirements()
+        from setuptools.dist import Distribution
+        # the requirement commands only need a distribution to hold the requirements they work on
+        dist = Distribution(dict(
+            name=self.name,
+            # given, so that setuptools doesn't go looking for packages
+            packages=[],
+            py_modules=[],
+            install_requires=list(self.kwargs.get('install_requires') or []),
+            extras_require=dict(self.kwargs.get('extras_require') or {}),
+            cmdclass=SetupModifier.get_quicklib_commands(),
+        ))
+        sm = self.setup_modifier
+        freeze_options = dist.get_option_dict(FreezeRequirementsCommand.SHORTNAME)
+        for key, value in sm.freeze_requirements_params.items():
+            freeze_options[key] = (self.script_path, value)
+        if sm.use_requirements_txt:
+            dist.run_command(UseRequirementsTxtCommand.SHORTNAME)
+        if sm.freeze_requirements:
+            dist.run_command(FreezeRequirementsCommand.SHORTNAME)
+        return list(dist.install_requires), dict(dist.extras_require)
+
+    def _generate_files(self):
+        """:return: {path: content} of files that are generated rather than taken from the tree"""
+        sm = self.setup_modifier
+        generated = {}
+        if is_packaging():
+            for version_module_path in sm.version_module_paths:
+                version_module_path = normalize_version_module_path(version_module_path)
+                generated[version_module_path.replace(os.sep, "/")] = get_versioned_module_code(
+                    version_module_path, self.version)
+        if sm.module_level_scripts:
+            hook_functions = {}
+            for target_module, hook_module, func_name in \
+                    CreateScriptHooks.target_module_names_to_hook_module_and_func_name(
+                        list(sm.module_level_scripts.values())):
+                hook_functions.setdefault(hook_module, {})[func_name] = target_module
+            for hook_module, functions in hook_functions.items():
+                generated[hook_module.replace(".", "/") + ".py"] = \
+                    CreateScriptHooks.create_script_hooks_module_text(functions)
+        return {path: content.encode("utf-8") for path, content in generated.items()}
+
+    def _find_packages(self):
+        if 'packages' in self.kwargs:
+            return list(self.kwargs['packages'])
+        packages, _ = SetupModifier.discover_packages(self.kwargs.get('top_packages'))
+        return packages
+
+    def get_entry_points(self):
+        """:return: {group: [entry point lines]}"""
+        entry_points = self.kwargs.get('entry_points') or {}
+        if isinstance(entry_points, str):
+            raise ValueError("entry_points must be given as a dict when building with the quicklib build backend")
+        entry_points = {group: list(lines) for group, lines in entry_points.items()}
+        scripts = self.setup_modifier.module_level_scripts
+        if scripts:
+            hooks = CreateScriptHooks.target_module_names_to_hook_module_and_func_name(list(scripts.values()))
+            entry_points.setdefault('console_scripts', []).extend(
+                "%s=%s:%s" % (script_name, hook_module, func_name)
+                for script_name, (_, hook_module, func_name) in zip(scripts.keys(), hooks)
+            )
+        return entry_points
+
+    def _get_manifest_lines(self):
+        if 'manifest' in self.kwargs:
+            lines = list(self.kwargs['manifest'])
+        else:
+            template = "MANIFEST.in"
+            if os.path.basename(self.script_path).lower() != DEFAULT_SETUP_SCRIPT:
+                matching_template = os.path.splitext(self.script_path)[0] + ".MANIFEST.in"
+                if os.path.exists(matching_template):
+                    template = matching_template
+            lines = open(template, "r").read().splitlines() if os.path.exists(template) else []
+        lines += list(self.kwargs.get('manifest_extra') or [])
+        return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+    def get_package_files(self):
+        """
+        :return: sorted paths of the files going into the wheel, as an sdist followed by a wheel build would pick them:
+                 the modules of the packages, and when include_package_data is on (the quicklib default), any file
+                 under a package directory that the manifest includes.
+        """
+        package_dirs = set(package.replace(".", "/") for package in self.packages)
+        top_dirs = sorted(set(package_dir.split("/", 1)[0] for package_dir in package_dirs))
+        all_files = []
+        for top_dir in top_dirs:
+            for dir_path, dirs, files in os.walk(top_dir):
+                dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+                rel_dir = dir_path.replace(os.sep, "/")
+                all_files.extend(rel_dir + "/" + f for f in sorted(files) if not f.endswith((".pyc", ".pyo")))
+        all_files.extend(path for path in self.generated_files if path not in all_files)
+
+        filelist = FileList()
+        filelist.set_allfiles(all_files)
+        for path in all_files:
+            if path.endswith(".py") and path.rsplit("/", 1)[0] in package_dirs:
+                filelist.append(path)
+        for module in self.kwargs.get('py_modules') or []:
+            filelist.append(module.replace(".", "/") + ".py")
+        if self.kwargs.get('include_package_data', True):
+            # only package directories are listed, so lines about anything else would warn about finding nothing
+            lines = self._get_manifest_lines()
+            compiled = CompiledManifest(lines)
+            for index, msg in compiled.errors:
+                log.error("error: manifest line %r: %s" % (lines[index], msg))
+            orig_threshold = log.set_threshold(log.ERROR)
+            try:
+                compiled.apply_to(filelist)
+            finally:
+                log.set_threshold(orig_threshold)
+        for package, patterns in (self.kwargs.get('package_data') or {}).items():
+            for package_dir in ([package.replace(".", "/")] if package else sorted(package_dirs)):
+                for pattern in patterns:
+                    filelist.include_pattern(package_dir + "/" + pattern, anchor=True)
+        for package, patterns in (self.kwargs.get('exclude_package_data') or {}).items():
+            for package_dir in ([package.replace(".", "/")] if package else sorted(package_dirs)):
+                for pattern in patterns:
+                    filelist.exclude_pattern(package_dir + "/" + pattern, anchor=True)
+
+        py_module_files = set(module.replace(".", "/") + ".py" for module in self.kwargs.get('py_modules') or [])
+
+        def in_package(path):
+            if path in py_module_files:
+                return True
+            parent = posixpath.dirname(path)
+            while parent:
+                if parent in package_dirs:
+                    return True
+                parent = posixpath.dirname(parent)
+            return False
+
+        files = set(path.replace(os.sep, "/") for path in filelist.files)
+        return sorted(path for path in files if in_package(path))
+
+    def get_long_description(self):
+        """:return: (long description, its content type)"""
+        long_description = self.kwargs.get('long_description')
+        if isinstance(long_description, dict):
+            assert set(long_description.keys()) == {'filename', 'content_type'}, \
+                "please provide the keys 'filename' and 'content_type' under the 'long_description' parameter"
+            return (open(long_description['filename'], "r", encoding='utf-8').read(),
+                    long_description['content_type'])
+        return long_description, self.kwargs.get('long_description_content_type')
+
+    def get_requires_dist(self):
+        requires_dist = list(self.install_requires)
+        for extra, requirements in sorted(self.extras_require.items()):
+            # setuptools style "extra:marker" keys, where an empty extra means a conditional install requirement
+            extra, _, extra_marker = extra.partition(":")
+            for line in requirements:
+                req = Requirement(line)
+                markers = ["(%s)" % m for m in (req.marker, extra_marker) if m]
+                if extra:
+                    markers.append('extra == "%s"' % extra)
+                req.marker = None
+                requires_dist.append("%s; %s" % (req, " and ".join(markers)) if markers else str(req))
+        return requires_dist
+
+    def get_metadata(self):
+        """:return: the METADATA file content (core metadata 2.1)"""
+        kwargs = self.kwargs
+        lines = [
+            "Metadata-Version: 2.1",
+            "Name: %s" % self.name,
+            "Version: %s" % self.version,
+        ]
+        for field, key in [("Summary", 'description'), ("Home-page", 'url'), ("Author", 'author'),
+                           ("Author-email", 'author_email'), ("Maintainer", 'maintainer'),
+                           ("Maintainer-email", 'maintainer_email'), ("License", 'license'),
+                           ("Requires-Python", 'python_requires')]:
+            if kwargs.get(key):
+                lines.append("%s: %s" % (field, str(kwargs[key]).replace("\n", " ")))
+        keywords = kwargs.get('keywords')
+        if keywords:
+            lines.append("Keywords: %s" % (keywords if isinstance(keywords, str) else ",".join(keywords)))
+        for label, url in (kwargs.get('project_urls') or {}).items():
+            lines.append("Project-URL: %s, %s" % (label, url))
+        platforms = kwargs.get('platforms') or []
+        for platform in ([platforms] if isinstance(platforms, str) else platforms):
+            lines.append("Platform: %s" % platform)
+        for classifier in kwargs.get('classifiers') or []:
+            lines.append("Classifier: %s" % classifier)
+        for requirement in self.get_requires_dist():
+            lines.append("Requires-Dist: %s" % requirement)
+        for extra in sorted(set(e.partition(":")[0] for e in self.extras_require) - {""}):
+            lines.append("Provides-Extra: %s" % extra)
+        long_description, content_type = self.get_long_description()
+        if content_type:
+            lines.append("Description-Content-Type: %s" % content_type)
+        text = "\n".join(lines) + "\n"
+        if long_description:
+            text += "\n" + long_description.rstrip("\n") + "\n"
+        return text
+
+    def get_dist_info_files(self):
+        """:return: {file name: content} of the .dist-info directory, except RECORD"""
+        top_level = sorted(set(
+            [package.split(".", 1)[0] for package in self.packages] + list(self.kwargs.get('py_modules') or [])))
+        files = {
+            "METADATA": self.get_metadata(),
+            "WHEEL": "Wheel-Version: 1.0\nGenerator: quicklib (%s)\nRoot-Is-Purelib: true\nTag: %s\n" % (
+                quicklib.version.__version__, WHEEL_TAG),
+            "top_level.txt": "".join(name + "\n" for name in top_level),
+        }
+        entry_points = self.get_entry_points()
+        if entry_points:
+            files["entry_points.txt"] = "".join(
+                "[%s]\n%s\n" % (group, "".join(line.strip() + "\n" for line in entry_points[group]))
+                for group in sorted(entry_points))
+        return {name: content.encode("utf-8") for name, content in files.items()}
+
+    def write_metadata(self, metadata_directory):
+        """:return: name of the .dist-info directory written into metadata_directory"""
+        dist_info_path = os.path.join(metadata_directory, self.dist_info_dir)
+        os.makedirs(dist_info_path, exist_ok=True)
+        for name, content in self.get_dist_info_files().items():
+            with open(os.path.join(dist_info_path, name), "wb") as f:
+                f.write(content)
+        return self.dist_info_dir
+
+    def write_wheel(self, wheel_directory, metadata_directory=None):
+        """:return: file name of the wheel written into wheel_directory"""
+        dist_info_files = self.get_dist_info_files()
+        if metadata_directory is not None:
+            # the wheel must carry the exact metadata prepared earlier (e.g. frozen requirements)
+            prepared_path = os.path.join(metadata_directory, self.dist_info_dir)
+            if os.path.isdir(prepared_path):
+                for name in os.listdir(prepared_path):
+                    if name != "RECORD":
+                        with open(os.path.join(prepared_path, name), "rb") as f:
+                            dist_info_files[name] = f.read()
+        entries = []
+        for path in self.get_package_files():
+            if path in self.generated_files:
+                entries.append((path, self.generated_files[path]))
+            else:
+                with open(path, "rb") as f:
+                    entries.append((path, f.read()))
+        entries += [(self.dist_info_dir + "/" + name, dist_info_files[name]) for name in sorted(dist_info_files)]
+        record_path = self.dist_info_dir + "/RECORD"
+        record = "".join("%s,%s,%d\n" % (path, _record_hash(data), len(data)) for path, data in entries)
+        entries.append((record_path, (record + "%s,,\n" % record_path).encode("utf-8")))
+
+        os.makedirs(wheel_directory, exist_ok=True)
+        wheel_path = os.path.join(wheel_directory, self.wheel_filename)
+        temp_path = wheel_path + ".tmp"
+        with zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+            for path, data in entries:
+                info = zipfile.ZipInfo(path, date_time=ZIP_DATE_TIME)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                zipf.writestr(info, data)
+        os.replace(temp_path, wheel_path)
+        log.info("wrote %s (%d files)" % (wheel_path, len(entries)))
+        return self.wheel_filename
+
+
+def create_wheel_builder(config_settings=None):
+    script_path, kwargs = load_setup_kwargs(config_settings)
+    return WheelBuilder(script_path, kwargs)
+
+
+# ---- PEP 517 hooks
+
+def get_requires_for_build_wheel(config_settings=None):
+    return []
+
+
+def get_requires_for_build_sdist(config_settings=None):
+    return []
+
+
+def prepare_metadata_for_build_wheel(metadata_directory, config_settings=None):
+    return create_wheel_builder(config_settings).write_metadata(metadata_directory)
+
+
+def build_wheel(wheel_directory, config_settings=None, metadata_directory=None):
+    return create_wheel_builder(config_settings).write_wheel(wheel_directory, metadata_directory)
+
+
+def build_sdist(sdist_directory, config_settings=None):
+    sdist_directory = os.path.abspath(sdist_directory)
+    os.makedirs(sdist_directory, exist_ok=True)
+
+    def list_sdists():
+        return {name: os.stat(os.path.join(sdist_directory, name)).st_mtime_ns
+                for name in os.listdir(sdist_directory) if name.endswith(".tar.gz")}
+
+    before = list_sdists()
+    setup_args = ["sdist", "--formats=gztar", "--dist-dir", sdist_directory]
+    path, is_yml = get_setup_source(config_settings)
+    if is_yml:
+        from .cli.setupyml import SetupYml
+        setup_from_yml(SetupYml.load_from_file(path).setup, setup_args)
+    else:
+        from distutils.core import run_setup
+        run_setup(path, script_args=setup_args)
+    created = sorted(name for name, mtime_ns in list_sdists().items() if before.get(name) != mtime_ns)
+    if len(created) != 1:
+        raise Exception("expected the sdist build to create one sdist in %s, found %s" % (sdist_directory, created))
+    return created[0]
@@ -0,0 +1,138 @@
+"""Opt-in cache of built sdists and wheels, keyed by the content of everything they are built from.
+
+Enabled by setting the QUICKLIB_BUILD_CACHE_DIR environment variable or the `build_cache` setup kwarg (True, or a dict
+with `path` and/or `max_size_mb`). Before an sdist, bdist_wheel or bdist_egg command runs, a key is computed from the
+command and its options, the library's metadata and setup kwargs, the quicklib, setuptools (and, for binary artifacts,
+python and platform) versions, and the content of every file egg_info's manifest selected. When an artifact with that
+key was already built, it's copied into the dist directory instead of being built again.
+
+Libraries with extension modules are never cached as binary artifacts: their builds depend on compilers and headers
+this key doesn't cover.
+"""
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import sysconfig
+
+import setuptools
+from setuptools.dist import Distribution
+
+import quicklib.version
+from .caching import ArtifactCache, user_cache_dir
+
+BUILD_CACHE_DIR_ENV = "QUICKLIB_BUILD_CACHE_DIR"
+DEFAULT_MAX_SIZE_MB = 1024
+KEY_FORMAT_VERSION = 1
+
+CACHED_COMMANDS = frozenset(["sdist", "bdist_wheel", "bdist_egg"])
+# options that only tell a command where to put its artifacts or temporary files
+IGNORED_OPTIONS = frozenset(["dist_dir", "bdist_dir", "keep_temp", "skip_build"])
+DIST_ATTRIBUTES = (
+    "install_requires", "extras_require", "entry_points", "packages", "py_modules", "package_dir", "package_data",
+    "exclude_package_data", "include_package_data", "python_requires", "data_files", "scripts", "zip_safe",
+)
+
+
+def get_build_cache(build_cache=None):
+    """:return: the ArtifactCache to use according to the `build_cache` setup kwarg and the environment, or None"""
+    if build_cache is False:
+        return None
+    if isinstance(build_cache, dict):
+        params = dict(build_cache)
+    elif build_cache:
+        params = {}
+    elif os.environ.get(BUILD_CACHE_DIR_ENV):
+        params = {}
+    else:
+        return None
+    path = params.get('path') or os.environ.get(BUILD_CACHE_DIR_ENV) or user_cache_dir("artifacts")
+    max_size_mb = float(params.get('max_size_mb', DEFAULT_MAX_SIZE_MB))
+    return ArtifactCache(path, int(max_size_mb * 1024 * 1024))
+
+
+def _hash_file(hasher, path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+
+
+def compute_artifact_key(dist, command):
+    """:return: the cache key of the artifacts `command` would build for dist (egg_info must have run already)"""
+    hasher = hashlib.sha256()
+
+    def add(label, value):
+        hasher.update(json.dumps([label, value], sort_keys=True, default=repr).encode('utf-8'))
+
+    add("format", KEY_FORMAT_VERSION)
+    add("command", command)
+    add("options", {opt: value for opt, (_, value) in dist.get_option_dict(command).items()
+                    if opt not in IGNORED_OPTIONS})
+    add("tools", [quicklib.version.__version__, setuptools.__version__])
+    if command != "sdist":
+        add("python", [sys.implementation.cache_tag, sysconfig.get_platform()])
+    metadata = io.StringIO()
+    dist.metadata.write_pkg_file(metadata)
+    add("metadata", metadata.getvalue())
+    add("dist", {attr: getattr(dist, attr, None) for attr in DIST_ATTRIBUTES})
+
+    paths = set(dist.get_command_obj('egg_info').filelist.files)
+    # an alternative setup script or manifest template is copied into the sdist under another name
+    paths.add(sys.argv[0])
+    template = dist.get_command_obj('sdist').template
+    if template:
+        paths.add(template)
+    for path in sorted(paths):
+        if not os.path.isfile(path):
+            continue
+        add("file", [path, os.path.getsize(path)])
+        _hash_file(hasher, path)
+    return hasher.hexdigest()
+
+
+class BuildCacheDistributionMixin:
+    """restores artifacts from the build cache instead of building them again, stores the ones it had to build"""
+    build_cache = None
+
+    def _is_cacheable(self, command):
+        if self.build_cache is None or command not in CACHED_COMMANDS or self.have_run.get(command):
+            return False
+        return command == "sdist" or not self.has_ext_modules()
+
+    def run_command(self, command):
+        if not self._is_cacheable(command):
+            return super().run_command(command)
+        self.run_command('egg_info')
+        key = compute_artifact_key(self, command)
+        cmd_obj = self.get_command_obj(command)
+        cmd_obj.ensure_finalized()
+        artifacts = self.build_cache.get(key)
+        if artifacts is not None:
+            os.makedirs(cmd_obj.dist_dir, exist_ok=True)
+            restored = []
+            for cached_path, (cmd_name, pyversion) in artifacts:
+                target_path = os.path.join(cmd_obj.dist_dir, os.path.basename(cached_path))
+                shutil.copyfile(cached_path, target_path)
+                self.dist_files.append((cmd_name, pyversion, target_path))
+                restored.append(target_path)
+            self.have_run[command] = 1
+            print("note: build cache hit for %s (%s), restored %s" % (command, key[:12], ", ".join(restored)))
+            return
+        print("note: build cache miss for %s (%s), building it" % (command, key[:12]))
+        known_dist_files = len(self.dist_files)
+        result = super().run_command(command)
+        built = [(path, [cmd_name, pyversion]) for cmd_name, pyversion, path in self.dist_files[known_dist_files:]
+                 if os.path.isfile(path)]
+        if built:
+            self.build_cache.put(key, built)
+            self.build_cache.evict()
+        return result
+
+
+def get_build_cache_distclass(distclass, build_cache):
+    """:return: a version of the given Distribution class (or of the default one) using the given build cache"""
+    distclass = distclass or Distribution
+    return type("BuildCache" + distclass.__name__, (BuildCacheDistributionMixin, distclass),
+                dict(build_cache=build_cache))
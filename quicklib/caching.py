@@ -0,0 +1,225 @@
+"""Helper module for on-disk caches shared between builds running on the same machine.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from distutils import log
+
+
+def user_cache_dir(*subdirs):
+    """the root of quicklib's per-user caches, overridable using the QUICKLIB_CACHE_DIR environment variable"""
+    root = os.environ.get("QUICKLIB_CACHE_DIR")
+    if not root:
+        xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        root = os.path.join(xdg_cache_home, "quicklib")
+    return os.path.join(root, *subdirs)
+
+
+def atomic_write(path, data, binary=False):
+    """write a file so that concurrent readers see either the previous or the new content, never a partial one"""
+    dir_name = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dir_name, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=dir_name)
+    try:
+        with os.fdopen(fd, "wb" if binary else "w") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+class PackageVersionsCache:
+    """
+    ordered package version listings, stored one entry per file and keyed by (plugin, pypi server, package name) -
+    names are given canonicalized (PEP 503), so all spellings of a package share an entry.
+    entries older than `ttl` seconds are stale and ignored. once more than `max_entries` entries are stored, the least
+    recently used ones are evicted (an entry's file mtime marks its last use).
+    """
+    FORMAT_VERSION = 1
+    ENTRY_EXT = ".json"
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def _entry_path(self, plugin, pypi_server, package_name):
+        key = json.dumps([plugin, repr(pypi_server), package_name])
+        return os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest() + self.ENTRY_EXT)
+
+    def get(self, plugin, pypi_server, package_name):
+        entry_path = self._entry_path(plugin, pypi_server, package_name)
+        try:
+            with open(entry_path, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(entry, dict):
+            log.warn("warning: ignoring malformed package versions cache entry %s" % entry_path)
+            return None
+        if entry.get('format') != self.FORMAT_VERSION:
+            # written by another quicklib version
+            return None
+        fetched_at, versions = entry.get('fetched_at'), entry.get('versions')
+        if not isinstance(fetched_at, (int, float)) or not isinstance(versions, list):
+            log.warn("warning: ignoring malformed package versions cache entry %s" % entry_path)
+            return None
+        if time.time() - fetched_at > self.ttl:
+            return None
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return versions
+
+    def put(self, plugin, pypi_server, package_name, versions):
+        entry = dict(
+            format=self.FORMAT_VERSION,
+            fetched_at=time.time(),
+            package_name=package_name,
+            versions=list(versions),
+        )
+        entry_path = self._entry_path(plugin, pypi_server, package_name)
+        try:
+            atomic_write(entry_path, json.dumps(entry))
+        except OSError as exc:
+            # e.g. an unwritable cache dir, the versions will just be fetched again next time
+            log.warn("warning: could not save package versions cache entry %s (%s)" % (entry_path, exc))
+
+    def evict(self):
+        try:
+            entries = [e for e in os.scandir(self.path) if e.name.endswith(self.ENTRY_EXT)]
+        except FileNotFoundError:
+            return 0
+        if len(entries) <= self.max_entries:
+            return 0
+
+        def last_used(dir_entry):
+            try:
+                return dir_entry.stat().st_mtime
+            except OSError:
+                return 0
+        entries.sort(key=last_used)
+        evicted = 0
+        for dir_entry in entries[:len(entries) - self.max_entries]:
+            try:
+                os.unlink(dir_entry.path)
+                evicted += 1
+            except OSError:
+                # most likely removed by a concurrent build
+                pass
+        return evicted
+
+
+class ArtifactCache:
+    """
+    build artifacts (sdists, wheels...) stored under the key of everything they were built from, one directory per
+    entry holding the artifact files and an entry.json. once the entries take more than `max_bytes`, the least recently
+    used ones are evicted (the mtime of an entry's entry.json marks its last use).
+    """
+    FORMAT_VERSION = 1
+    ENTRY_FILE = "entry.json"
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _entry_dir(self, key):
+        return os.path.join(self.path, key)
+
+    @staticmethod
+    def _is_valid_artifact_list(artifacts):
+        """whether an entry's artifacts are a list of [file name, [command name, python version]]"""
+        def is_valid(artifact):
+            if not isinstance(artifact, list) or len(artifact) != 2:
+                return False
+            name, info = artifact
+            return (isinstance(name, str) and name not in ("", os.curdir, os.pardir) and os.path.basename(name) == name
+                    and isinstance(info, list) and len(info) == 2 and all(isinstance(item, str) for item in info))
+        return isinstance(artifacts, list) and all(is_valid(artifact) for artifact in artifacts)
+
+    def get(self, key):
+        """:return: list of (artifact path in the cache, [command name, python version]), or None if key isn't cached"""
+        entry_dir = self._entry_dir(key)
+        entry_path = os.path.join(entry_dir, self.ENTRY_FILE)
+        try:
+            with open(entry_path, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if isinstance(entry, dict) and entry.get('format') != self.FORMAT_VERSION:
+            # written by another quicklib version
+            return None
+        if not isinstance(entry, dict) or not self._is_valid_artifact_list(entry.get('artifacts')):
+            log.warn("warning: removing malformed build cache entry %s" % entry_path)
+            # so that the artifacts built instead can be stored in its place
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        artifacts = [(os.path.join(entry_dir, name), info) for name, info in entry['artifacts']]
+        if not all(os.path.isfile(path) for path, _ in artifacts):
+            # partially evicted by a concurrent build
+            return None
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return artifacts
+
+    def put(self, key, artifacts):
+        """store artifacts given as a list of (file path, [name of the command that built it, its python version])"""
+        os.makedirs(self.path, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.path)
+        try:
+            names = []
+            for path, info in artifacts:
+                name = os.path.basename(path)
+                shutil.copyfile(path, os.path.join(temp_dir, name))
+                names.append([name, info])
+            with open(os.path.join(temp_dir, self.ENTRY_FILE), "w") as f:
+                json.dump(dict(format=self.FORMAT_VERSION, created_at=time.time(), artifacts=names), f)
+            try:
+                os.rename(temp_dir, self._entry_dir(key))
+            except OSError:
+                # stored by a concurrent build in the meantime - same key, same content
+                pass
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    @staticmethod
+    def _dir_size(path):
+        size = 0
+        for dir_entry in os.scandir(path):
+            try:
+                size += dir_entry.stat().st_size
+            except OSError:
+                pass
+        return size
+
+    def evict(self):
+        """:return: number of entries evicted to bring the cache size under max_bytes"""
+        try:
+            entries = [e for e in os.scandir(self.path) if e.is_dir() and not e.name.startswith(".")]
+        except FileNotFoundError:
+            return 0
+
+        def last_used(dir_entry):
+            try:
+                return os.stat(os.path.join(dir_entry.path, self.ENTRY_FILE)).st_mtime
+            except OSError:
+                return 0
+        sizes = {e.path: self._dir_size(e.path) for e in entries}
+        total = sum(sizes.values())
+        evicted = 0
+        for dir_entry in sorted(entries, key=last_used):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(dir_entry.path, ignore_errors=True)
+            total -= sizes[dir_entry.path]
+            evicted += 1
+        return evicted
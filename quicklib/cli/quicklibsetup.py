@@ -1,44 +1,77 @@
 import os
-import textwrap
+import sys
 from argparse import ArgumentParser
-from distutils.core import run_setup
 
-from .. import incorporator
 from .setupyml import SetupYml
 
-TEMP_SETUP_FILE_PATH = "quicklib_setup_from_yml.py"
 
-
-def create_package_from_kwargs(ql_setup_kwargs, args_for_setup_script):
-    virtual_setup_py_code = textwrap.dedent("""\
-        %(bootstrap_block)s
-
-        ql_setup_kwargs = %(ql_setup_kwargs)r    
-
-        quicklib.setup(
-            **ql_setup_kwargs
-        )
-    """) % dict(
-        bootstrap_block=incorporator.create_bootstrap_block(),
-        ql_setup_kwargs=ql_setup_kwargs,
-    )
-
-    try:
-        open(TEMP_SETUP_FILE_PATH, "w").write(virtual_setup_py_code)
-        run_setup(TEMP_SETUP_FILE_PATH, script_args=args_for_setup_script)
-    finally:
-        if os.path.exists(TEMP_SETUP_FILE_PATH):
-            os.remove(TEMP_SETUP_FILE_PATH)
+def parse_batch_options(args_for_setup_script):
+    """
+    :return: (batch options, args for the setup scripts). -j and -v are the batch's only before the first setup
+             command, after it they belong to the commands (e.g. `build_ext -j 4`), and outside batch mode they are
+             never taken.
+    """
+    from ..watch import split_commands
+    global_args, commands = split_commands(args_for_setup_script)
+    parser = ArgumentParser(prog="quicklib-setup", add_help=False)
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    options, global_args = parser.parse_known_args(global_args)
+    return options, global_args + [arg for command, command_args in commands for arg in [command] + command_args]
 
 
 def main():
     parser = ArgumentParser(prog="quicklib-setup", description="package a library from a YAML file")
     parser.add_argument("-s", "--setup-yml", default="quicklib_setup.yml", help="setup YAML file")
+    parser.add_argument("--preview-manifest", action="store_true",
+                        help="print the files the manifest selects and how long resolving them took, without building")
+    watch_group = parser.add_argument_group("watch mode", "keep running, and build again whenever the inputs change")
+    watch_group.add_argument("--watch", action="store_true",
+                             help="build, then rebuild the artifacts affected by every change to the library's inputs")
+    watch_group.add_argument("--watch-interval", type=float, default=1.0, metavar="SECONDS",
+                             help="how often to look for changes (default: %(default)s)")
+    batch_group = parser.add_argument_group(
+        "batch builds", "build many libraries in parallel, one process each. before the setup commands, -j/--jobs N "
+                        "sets the number of parallel builds (default: number of cores) and -v/--verbose shows the "
+                        "output of successful builds too")
+    batch_group.add_argument("--batch", metavar="TARGET", action="append", default=[],
+                             help="setup script or YAML file to build from the current directory, or a directory "
+                                  "to build its setup.py/quicklib_setup.yml from (can be repeated)")
+    batch_group.add_argument("--all", action="store_true",
+                             help="build every setup.py, quicklib_setup.yml and setup_*.py script (calling quicklib.setup) "
+                                  "found under the current directory")
+    batch_group.add_argument("--stop-on-failure", action="store_true", help="don't start more builds once one fails")
+    batch_group.add_argument("--isolated", action="store_true",
+                             help="build in overlay directories, so setup scripts sharing a directory build in parallel")
     args, args_for_setup_script = parser.parse_known_args()
+    if args.batch or args.all:
+        from .. import batch
+        batch_options, args_for_setup_script = parse_batch_options(args_for_setup_script)
+        try:
+            targets = [batch.BuildTarget.from_arg(arg) for arg in args.batch]
+        except ValueError as exc:
+            parser.error(str(exc))
+        if args.all:
+            targets.extend(t for t in batch.discover_targets() if t.path not in {bt.path for bt in targets})
+        sys.exit(batch.run_batch(targets, args_for_setup_script, jobs=batch_options.jobs,
+                                 stop_on_failure=args.stop_on_failure, verbose=batch_options.verbose,
+                                 isolated=args.isolated))
     if not os.path.exists(args.setup_yml):
         parser.error("file '%s' not found" % args.setup_yml)
+    if args.watch:
+        from ..watch import WatchSession
+        try:
+            session = WatchSession(args.setup_yml, args_for_setup_script, interval=args.watch_interval)
+        except ValueError as exc:
+            parser.error(str(exc))
+        sys.exit(session.run())
     setup_yml = SetupYml.load_from_file(args.setup_yml)
-    create_package_from_kwargs(setup_yml.setup, args_for_setup_script)
+    if args.preview_manifest:
+        from ..manifest import PreviewManifest
+        args_for_setup_script = [PreviewManifest.SHORTNAME]
+    # built in-process, as if a setup.py calling quicklib.setup with the YAML's kwargs was run
+    from ..setupapi import setup_from_yml
+    setup_from_yml(setup_yml.setup, args_for_setup_script)
 
 
 if __name__ == '__main__':
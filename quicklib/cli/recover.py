@@ -0,0 +1,38 @@
+import sys
+from argparse import ArgumentParser
+
+from .. import virtualfiles
+
+
+def main():
+    parser = ArgumentParser(prog="quicklib-recover",
+                            description="undo the virtual file changes (version modules, MANIFEST.in etc.) of builds "
+                                        "that did not finish, e.g. because they were killed")
+    parser.add_argument("journals", nargs="*",
+                        help="journal files to replay (default: the journals of builds that are no longer running, "
+                             "found in %s)" % virtualfiles.get_journal_dir())
+    parser.add_argument("-n", "--dry-run", action="store_true", help="only list the journals that would be replayed")
+    args = parser.parse_args()
+    journals = args.journals or virtualfiles.find_unfinished_journals()
+    if not journals:
+        print("no unfinished journals found")
+        return
+    failed = False
+    for journal in journals:
+        if args.dry_run:
+            print(journal)
+            continue
+        print("replaying %s" % journal)
+        try:
+            undone = virtualfiles.recover_journal(journal, pre_callback=lambda msg: print("  %s" % msg))
+        except Exception as exc:
+            print("error: failed to replay %s (%s)" % (journal, exc))
+            failed = True
+            continue
+        print("  %d files restored or removed" % undone)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
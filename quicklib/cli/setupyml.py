@@ -1,13 +1,23 @@
+import copy
 import os
 from collections import defaultdict
 
 
+class IncludeCycleError(ValueError):
+    pass
+
+
 class SetupYml:
+    # {real path: ((mtime, size), parsed document)} - a base file included by many setup files is parsed once
+    _document_cache = {}
+
     def __init__(self, data_dict=None):
         if data_dict is None:
             data_dict = {}
         self._setup = data_dict.get('setup', {})
         self._env = {}
+        # the YAML files this was loaded from, includes first
+        self.source_paths = []
 
     def set_env_var(self, name, value):
         self._env[name] = value
@@ -28,24 +38,49 @@ class SetupYml:
         return self._setup.copy()
 
     @classmethod
-    def load_from_file(cls, yml_path):
-        import yaml
-        yml_document = yaml.safe_load(open(yml_path, "r"))
+    def read_document(cls, yml_path):
+        """:return: the parsed YAML file, reparsed only if it changed since it was last read"""
+        real_path = os.path.realpath(yml_path)
+        st = os.stat(real_path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = cls._document_cache.get(real_path)
+        if cached is None or cached[0] != stamp:
+            import yaml
+            # the libyaml-based loader is much faster, when available
+            loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+            with open(real_path, "rb") as f:
+                cached = (stamp, yaml.load(f, Loader=loader))
+            cls._document_cache[real_path] = cached
+        # callers get their own copy to modify
+        return copy.deepcopy(cached[1])
+
+    @classmethod
+    def clear_cache(cls):
+        cls._document_cache.clear()
+
+    @classmethod
+    def load_from_file(cls, yml_path, _including=()):
+        real_path = os.path.realpath(yml_path)
+        if real_path in _including:
+            cycle = list(_including[_including.index(real_path):]) + [real_path]
+            raise IncludeCycleError("include cycle in setup YAML files: %s" % " -> ".join(cycle))
+        yml_document = cls.read_document(yml_path)
         result = SetupYml()
-        result.overlay(
-            cls.load_includes(yml_document.get('include', ()), os.path.dirname(yml_path))
-        )
+        includes = cls.load_includes(yml_document.get('include', ()), os.path.dirname(yml_path),
+                                     _including + (real_path,))
+        result.overlay(includes)
         result.overlay(SetupYml(yml_document))
+        result.source_paths = includes.source_paths + [real_path]
         return result
 
     @classmethod
-    def load_includes(cls, include_expressions, base_dir):
+    def load_includes(cls, include_expressions, base_dir, _including=()):
         result = SetupYml()
         for include_expr in include_expressions:
             if isinstance(include_expr, str):
                 include_path = os.path.expanduser(include_expr)
                 include_path = os.path.join(base_dir, include_path)
-                included_setup_yml = SetupYml.load_from_file(include_path)
+                included_setup_yml = SetupYml.load_from_file(include_path, _including)
             elif isinstance(include_expr, dict):
                 if "from" in include_expr and "import" in include_expr:
                     exec_globals = {}
@@ -60,4 +95,5 @@ class SetupYml:
             else:
                 raise TypeError("malformatted include: %r" % (include_expr,))
             result.overlay(included_setup_yml)
+            result.source_paths.extend(included_setup_yml.source_paths)
         return result
@@ -1,9 +1,9 @@
 import glob
 import os
-import shutil
 
 from setuptools import Command
 from distutils import log
+from distutils.dir_util import remove_tree
 
 
 class CleanEggInfo(Command):
@@ -24,7 +24,8 @@ class CleanEggInfo(Command):
         egg_info_subdirs = list(map(os.path.abspath, glob.glob("*.egg-info")))
         for egg_info_subdir in egg_info_subdirs:
             log.info("Cleaning up egg_info directory %r..." % egg_info_subdir)
-            shutil.rmtree(egg_info_subdir)
+            # unlike shutil.rmtree, this tells mkpath the directory is gone (matters when building again in-process)
+            remove_tree(egg_info_subdir)
 
 
 class ExportMetadata(Command):
@@ -1,4 +1,3 @@
-import datetime
 import os
 import textwrap
 
@@ -74,21 +73,28 @@ class ManifestInRewriter:
     def prepend_lines(self, lines):
         self.lines = list(lines) + self.lines
 
-    def rewrite(self):
-        if self.rewritten:
-            raise Exception("cannot rewrite: %s has already been rewritten" % (self.path,))
+    def get_text(self):
+        """:return: the text the file will have once rewritten, None if it's left as it is"""
         if not self.lines:
-            self.rewritten = True
-            return
+            return None
         text = textwrap.dedent("""
-            # ---- AUTO-GENERATED: lines beyond this point were added by %(me)s at %(when)s
+            # ---- AUTO-GENERATED: lines beyond this point were added by %(me)s
             %(joined_lines)s
             # ---- AUTO-GENERATED: done
         """[1:-1]) % dict(
-            me=__name__, when=datetime.datetime.now().strftime("%c"), joined_lines="\n".join(self.lines),
+            me=__name__, joined_lines="\n".join(self.lines),
         )
         if self.append and os.path.exists(self.path):
             text = open(self.path, "r").read() + "\n" + text
+        return text
+
+    def rewrite(self):
+        if self.rewritten:
+            raise Exception("cannot rewrite: %s has already been rewritten" % (self.path,))
+        text = self.get_text()
+        if text is None:
+            self.rewritten = True
+            return
         if os.path.exists(self.path):
             modify_file(self.path, text)
         else:
@@ -117,13 +123,22 @@ class PrepareManifestIn(Command):
         if isinstance(self.extra_lines, str):
             self.extra_lines = self.extra_lines.split("\n")
 
-    def run(self):
-        template = self.get_finalized_command('sdist').template or "MANIFEST.in"
-        self.rewriter.set_path(template)
+    def _prepare(self, rewriter):
+        rewriter.set_path(self.get_finalized_command('sdist').template or "MANIFEST.in")
         if self.manifest_content is not None:
-            self.rewriter.set_append(False)
-            self.rewriter.prepend_lines(list(self.manifest_content) + [''] * 2)
+            rewriter.set_append(False)
+            rewriter.prepend_lines(list(self.manifest_content) + [''] * 2)
         for line in self.extra_lines:
-            self.rewriter.add_line(line)
+            rewriter.add_line(line)
+
+    def get_template_text(self):
+        """:return: the text the manifest template will have once this command runs (None if it won't change)"""
+        rewriter = ManifestInRewriter(append=self.rewriter.append)
+        rewriter.lines = list(self.rewriter.lines)
+        self._prepare(rewriter)
+        return rewriter.get_text()
+
+    def run(self):
+        self._prepare(self.rewriter)
         log.info("rewriting %s" % self.rewriter.path)
         self.rewriter.rewrite()
@@ -0,0 +1,326 @@
+"""Package discovery in a single pass over the library tree.
+
+Finds the same packages as quicklib.setup always has (`setuptools.find_packages()`, or with `top_packages`, the
+regular packages under the named top packages - including the ones under namespace directories), but scans each
+directory once and never enters directories it doesn't need to.
+"""
+import copy
+import json
+import os
+import re
+
+from distutils import log
+
+from .caching import atomic_write
+
+# directories that are never part of a package tree but can be huge (virtualenvs, build outputs, caches, vcs).
+# these, and directories matched by .gitignore, are pruned unless they hold an __init__.py.
+HEAVY_DIRS = frozenset([
+    ".git", ".hg", ".svn", ".tox", ".nox", ".venv", "venv", "node_modules", "build", "dist", "site-packages",
+    "__pycache__", ".mypy_cache", ".pytest_cache", ".ruff_cache", ".eggs",
+])
+
+# always excluded by setuptools.find_packages()
+EXCLUDED_PACKAGES = frozenset(["ez_setup"])
+
+GITIGNORE = ".gitignore"
+
+# relative to the library's top directory
+DISCOVERY_CACHE_PATH = os.path.join("build", "quicklib-discovery.json")
+
+
+def _gitignore_pattern_to_regex(pattern):
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            parts.append("/.*")
+            i += 3
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[":
+            end = pattern.find("]", i + 2)
+            if end == -1:
+                parts.append(re.escape("["))
+                i += 1
+            else:
+                char_class = pattern[i + 1:end]
+                if char_class.startswith("!"):
+                    char_class = "^" + char_class[1:]
+                parts.append("[%s]" % char_class.replace("\\", "\\\\"))
+                i = end + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile("".join(parts))
+
+
+class GitignoreRules:
+    """the subset of .gitignore semantics needed to decide whether a directory is ignored"""
+    def __init__(self):
+        # (base directory, regex, negated, anchored, directories only), in order of precedence (last wins)
+        self.rules = []
+
+    def add_file(self, gitignore_path, base_dir):
+        """add the rules of a .gitignore file, relative to base_dir ("" for the root)"""
+        try:
+            with open(gitignore_path, "r", encoding="utf-8", errors="replace") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            anchored = "/" in line
+            self.rules.append((base_dir, _gitignore_pattern_to_regex(line.lstrip("/")), negated, anchored, dir_only))
+
+    def is_ignored(self, rel_path, is_dir=True):
+        ignored = False
+        for base_dir, regex, negated, anchored, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if base_dir:
+                if not rel_path.startswith(base_dir + "/"):
+                    continue
+                path = rel_path[len(base_dir) + 1:]
+            else:
+                path = rel_path
+            if regex.fullmatch(path if anchored else path.rsplit("/", 1)[-1]):
+                ignored = not negated
+        return ignored
+
+
+def _is_package_dir(path):
+    return os.path.isfile(os.path.join(path, "__init__.py"))
+
+
+def _scan_subdirs(path):
+    """:return: sorted names of the sub-directories of path that may hold packages"""
+    try:
+        with os.scandir(path) as it:
+            names = [e.name for e in it if e.is_dir() and "." not in e.name and e.name != "__pycache__"]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    return sorted(names)
+
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class PackageScanner:
+    """
+    :param root: the library's top directory
+    everything the result depends on is recorded while scanning, so a DiscoveryCache can later tell whether the
+    result is still valid: the sub-directories of every listed directory, whether every checked directory has an
+    __init__.py, and the .gitignore files that were read.
+    """
+    def __init__(self, root="."):
+        self.root = root
+        self.gitignore = GitignoreRules()
+        # relative path: [mtime, sub-directory names]
+        self.scanned = {}
+        # relative path: [mtime, is a regular package]
+        self.checked = {}
+        # relative path: [mtime, size], or None when there is no such file
+        self.gitignore_files = {}
+
+    def _path(self, rel_path):
+        return os.path.join(self.root, rel_path) if rel_path else self.root
+
+    def _list(self, rel_path):
+        path = self._path(rel_path)
+        # taken before listing, so a change made while listing shows up as a changed mtime later
+        mtime_ns = _mtime_ns(path)
+        subdirs = _scan_subdirs(path)
+        self.scanned[rel_path] = [mtime_ns, subdirs]
+        return subdirs
+
+    def _is_package(self, rel_path):
+        path = self._path(rel_path)
+        mtime_ns = _mtime_ns(path)
+        is_package = _is_package_dir(path)
+        self.checked[rel_path] = [mtime_ns, is_package]
+        return is_package
+
+    def _add_gitignore(self, rel_path):
+        gitignore_rel_path = rel_path + "/" + GITIGNORE if rel_path else GITIGNORE
+        gitignore_path = self._path(gitignore_rel_path)
+        self.gitignore_files[gitignore_rel_path] = _file_stamp(gitignore_path)
+        self.gitignore.add_file(gitignore_path, rel_path)
+
+    def find_packages(self):
+        """same as setuptools.find_packages(): regular packages, only descending into regular packages"""
+        packages = []
+        pending = [("", "")]
+        while pending:
+            rel_path, package_prefix = pending.pop()
+            for name in self._list(rel_path):
+                child_rel_path = rel_path + "/" + name if rel_path else name
+                if not self._is_package(child_rel_path):
+                    continue
+                package = package_prefix + name
+                if package not in EXCLUDED_PACKAGES:
+                    packages.append(package)
+                pending.append((child_rel_path, package + "."))
+        return sorted(packages)
+
+    def find_top_packages(self, top_packages):
+        """
+        regular packages under (and including) the given top-level names, also found under namespace directories
+        (without an __init__.py) at any depth, e.g. `top.namespace.package`.
+        heavy directories and directories ignored by .gitignore files are skipped, unless they are packages.
+        """
+        self._add_gitignore("")
+        packages = []
+        root_subdirs = self._list("")
+        for top_package in top_packages:
+            if top_package not in root_subdirs:
+                continue
+            if self._is_package(top_package) and top_package not in EXCLUDED_PACKAGES:
+                packages.append(top_package)
+            pending = [top_package]
+            while pending:
+                rel_path = pending.pop()
+                self._add_gitignore(rel_path)
+                for name in self._list(rel_path):
+                    child_rel_path = rel_path + "/" + name
+                    if self._is_package(child_rel_path):
+                        packages.append(child_rel_path.replace("/", "."))
+                    elif name in HEAVY_DIRS or self.gitignore.is_ignored(child_rel_path):
+                        continue
+                    pending.append(child_rel_path)
+        return sorted(set(packages))
+
+    def get_state(self):
+        return dict(scanned=self.scanned, checked=self.checked, gitignore_files=self.gitignore_files)
+
+
+class DiscoveryCacheError(Exception):
+    pass
+
+
+class DiscoveryCache:
+    """
+    discovery results kept in a small JSON file, one entry per kind of discovery (automatic or per top_packages).
+    an entry is used only after validating it against the tree: directories whose mtime changed are listed again,
+    and the entry is discarded if their sub-directories (or __init__.py presence, or .gitignore files) changed.
+    a cache file that exists but can't be read or parsed is an error rather than silently ignored.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, path, root="."):
+        self.path = path
+        self.root = root
+
+    @staticmethod
+    def get_key(top_packages):
+        return "auto" if top_packages is None else "top_packages:" + ",".join(top_packages)
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            raise DiscoveryCacheError("package discovery cache %s can't be read (%s), delete it to rebuild it" % (
+                self.path, exc))
+        if not isinstance(data, dict) or not isinstance(data.get('entries'), dict):
+            raise DiscoveryCacheError("package discovery cache %s is malformed, delete it to rebuild it" % self.path)
+        if data.get('format') != self.FORMAT_VERSION or data.get('root') != os.path.abspath(self.root):
+            # written by another quicklib version, or copied along with the tree - rebuilt as needed
+            return {}
+        return data['entries']
+
+    def _save(self, entries):
+        data = dict(format=self.FORMAT_VERSION, root=os.path.abspath(self.root), entries=entries)
+        try:
+            atomic_write(self.path, json.dumps(data))
+        except OSError as exc:
+            # e.g. a read-only source tree, the next build will just discover again
+            log.warn("warning: could not save package discovery cache %s (%s)" % (self.path, exc))
+
+    def _revalidate(self, state):
+        """:return: whether the recorded scanner state still holds (updating changed mtimes in place)"""
+        try:
+            for rel_path, recorded in state['scanned'].items():
+                path = os.path.join(self.root, rel_path) if rel_path else self.root
+                mtime_ns = _mtime_ns(path)
+                if mtime_ns != recorded[0]:
+                    if _scan_subdirs(path) != recorded[1]:
+                        return False
+                    recorded[0] = mtime_ns
+            for rel_path, recorded in state['checked'].items():
+                path = os.path.join(self.root, rel_path)
+                mtime_ns = _mtime_ns(path)
+                if mtime_ns != recorded[0]:
+                    if _is_package_dir(path) != recorded[1]:
+                        return False
+                    recorded[0] = mtime_ns
+            for rel_path, recorded in state['gitignore_files'].items():
+                if _file_stamp(os.path.join(self.root, rel_path)) != recorded:
+                    return False
+        except (KeyError, TypeError, IndexError, AttributeError) as exc:
+            raise DiscoveryCacheError("package discovery cache %s is malformed (%r), delete it to rebuild it" % (
+                self.path, exc))
+        return True
+
+    def discover(self, top_packages=None):
+        """:return: (sorted package names, whether they came from the cache)"""
+        key = self.get_key(top_packages)
+        entries = self._load()
+        entry = entries.get(key)
+        if entry is not None:
+            if not isinstance(entry, dict) or not isinstance(entry.get('packages'), list):
+                raise DiscoveryCacheError("package discovery cache %s is malformed, delete it to rebuild it" % (
+                    self.path,))
+            state = copy.deepcopy(entry.get('state'))
+            if self._revalidate(state):
+                if state != entry['state']:
+                    # same tree shape, only mtimes changed - remember them so the next check is quicker
+                    entry['state'] = state
+                    self._save(entries)
+                return list(entry['packages']), True
+        scanner = PackageScanner(self.root)
+        packages = scanner.find_packages() if top_packages is None else scanner.find_top_packages(top_packages)
+        entries[key] = dict(packages=packages, state=scanner.get_state())
+        self._save(entries)
+        return packages, False
+
+
+def discover_packages(root=".", top_packages=None):
+    """:return: sorted package names, see PackageScanner.find_packages and PackageScanner.find_top_packages"""
+    scanner = PackageScanner(root)
+    if top_packages is None:
+        return scanner.find_packages()
+    return scanner.find_top_packages(top_packages)
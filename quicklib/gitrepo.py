@@ -0,0 +1,1101 @@
+"""Read-only access to a git repository's refs, objects and index, implemented without running the git binary.
+
+Only what quicklib needs for versioning is supported: resolving HEAD and tags, reading commit and tag objects
+(loose or packed), `git describe` (also for many libraries at once, optionally counting only the commits that changed
+their paths), and detecting local modifications the way `git describe --dirty` does (also only among given files).
+Repositories using features outside that scope raise `UnsupportedRepository`, and callers fall back to git itself.
+"""
+import configparser
+import fnmatch
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import re
+import stat
+import struct
+import threading
+import time
+import zlib
+
+from .caching import atomic_write
+
+
+class UnsupportedRepository(Exception):
+    """the repository uses a feature that can't be read directly, use the git binary instead"""
+
+
+OBJ_COMMIT, OBJ_TREE, OBJ_BLOB, OBJ_TAG, OBJ_OFS_DELTA, OBJ_REF_DELTA = 1, 2, 3, 4, 6, 7
+OBJECT_TYPE_NAMES = {OBJ_COMMIT: "commit", OBJ_TREE: "tree", OBJ_BLOB: "blob", OBJ_TAG: "tag"}
+
+S_IFGITLINK = 0o160000
+
+# the default number of tag candidates git describe considers
+DESCRIBE_MAX_CANDIDATES = 10
+
+# the number of commits git rev-list walks past the point where only uninteresting ones are left
+REV_LIST_SLOP = 5
+
+# posix character classes accepted by git's wildmatch, translated for fnmatch
+WILDMATCH_CLASSES = {
+    "[:digit:]": "0-9",
+    "[:alpha:]": "a-zA-Z",
+    "[:alnum:]": "a-zA-Z0-9",
+    "[:lower:]": "a-z",
+    "[:upper:]": "A-Z",
+    "[:xdigit:]": "0-9a-fA-F",
+    "[:space:]": " \\t\\n\\r\\f\\v",
+}
+
+
+def wildmatch(pattern, name):
+    """match a name against a git glob pattern, where (unlike with paths) `*` also matches slashes"""
+    for posix_class, chars in WILDMATCH_CLASSES.items():
+        pattern = pattern.replace(posix_class, chars)
+    return fnmatch.fnmatchcase(name, pattern)
+
+
+def find_git_dir(start_path):
+    """:return: (git dir, work tree) of the repository containing start_path"""
+    path = os.path.abspath(start_path)
+    while True:
+        dot_git = os.path.join(path, ".git")
+        if os.path.isdir(dot_git):
+            return dot_git, path
+        if os.path.isfile(dot_git):
+            # worktrees and submodules: a file pointing at the actual git dir
+            with open(dot_git, "r") as f:
+                content = f.read().strip()
+            if not content.startswith("gitdir:"):
+                raise UnsupportedRepository("unrecognized .git file at %s" % dot_git)
+            git_dir = content[len("gitdir:"):].strip()
+            return os.path.normpath(os.path.join(path, git_dir)), path
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise Exception("not in a git repository: %s" % os.path.abspath(start_path))
+        path = parent
+
+
+class Commit:
+    __slots__ = ("sha", "tree", "parents", "date")
+
+    def __init__(self, sha, tree, parents, date):
+        self.sha = sha
+        self.tree = tree
+        self.parents = parents
+        self.date = date
+
+
+class Tag:
+    __slots__ = ("sha", "object", "object_type", "name", "date")
+
+    def __init__(self, sha, object_sha, object_type, name, date):
+        self.sha = sha
+        self.object = object_sha
+        self.object_type = object_type
+        self.name = name
+        self.date = date
+
+
+class IndexEntry:
+    __slots__ = ("path", "ctime", "mtime", "dev", "ino", "mode", "uid", "gid", "size", "sha", "flags",
+                 "extended_flags")
+
+    def __init__(self, path, ctime, mtime, dev, ino, mode, uid, gid, size, sha, flags, extended_flags):
+        self.path = path
+        self.ctime = ctime
+        self.mtime = mtime
+        self.dev = dev
+        self.ino = ino
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.size = size
+        self.sha = sha
+        self.flags = flags
+        self.extended_flags = extended_flags
+
+    @property
+    def stage(self):
+        return (self.flags >> 12) & 3
+
+    @property
+    def assume_valid(self):
+        return bool(self.flags & 0x8000)
+
+    @property
+    def skip_worktree(self):
+        return bool(self.extended_flags & 0x4000)
+
+
+class Index:
+    def __init__(self, entries, mtime, cache_tree_root):
+        self.entries = entries
+        # modification time (ns) of the index file, needed for "racy git" detection
+        self.mtime = mtime
+        # sha of the tree the whole index would be written as, if known to be valid
+        self.cache_tree_root = cache_tree_root
+
+
+class PackFile:
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len(".idx")] + ".pack"
+        self._shas = None
+        self._offsets = None
+        self._pack = None
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        with open(self.idx_path, "rb") as f:
+            data = f.read()
+        if data[:4] == b"\377tOc":
+            version, = struct.unpack(">I", data[4:8])
+            if version != 2:
+                raise UnsupportedRepository("unsupported pack index version %d in %s" % (version, self.idx_path))
+            fanout_start = 8
+            count, = struct.unpack(">I", data[fanout_start + 255 * 4:fanout_start + 256 * 4])
+            shas_start = fanout_start + 256 * 4
+            shas = data[shas_start:shas_start + count * 20]
+            offsets_start = shas_start + count * 24
+            offsets = list(struct.unpack(">%dI" % count, data[offsets_start:offsets_start + count * 4]))
+            large_offsets_start = offsets_start + count * 4
+            for i, offset in enumerate(offsets):
+                if offset & 0x80000000:
+                    large_index = offset & 0x7fffffff
+                    offsets[i], = struct.unpack(
+                        ">Q", data[large_offsets_start + large_index * 8:large_offsets_start + large_index * 8 + 8])
+        else:
+            count, = struct.unpack(">I", data[255 * 4:256 * 4])
+            entries = [data[1024 + i * 24:1024 + i * 24 + 24] for i in range(count)]
+            shas = b"".join(e[4:] for e in entries)
+            offsets = [struct.unpack(">I", e[:4])[0] for e in entries]
+        self._shas = shas
+        self._offsets = offsets
+
+    def find(self, sha_bin):
+        """:return: offset of the object in the pack, or None"""
+        if self._shas is None:
+            self._load_index()
+        shas = self._shas
+        lo, hi = 0, len(self._offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_sha = shas[mid * 20:mid * 20 + 20]
+            if mid_sha < sha_bin:
+                lo = mid + 1
+            elif mid_sha > sha_bin:
+                hi = mid
+            else:
+                return self._offsets[mid]
+        return None
+
+    def _mapped(self):
+        if self._pack is None:
+            with open(self.pack_path, "rb") as f:
+                self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._pack
+
+    def read_at(self, offset, repo):
+        with self._lock:
+            pack = self._mapped()
+            c = pack[offset]
+            pos = offset + 1
+            obj_type = (c >> 4) & 7
+            size = c & 15
+            shift = 4
+            while c & 0x80:
+                c = pack[pos]
+                pos += 1
+                size |= (c & 0x7f) << shift
+                shift += 7
+            if obj_type == OBJ_OFS_DELTA:
+                c = pack[pos]
+                pos += 1
+                base_distance = c & 0x7f
+                while c & 0x80:
+                    c = pack[pos]
+                    pos += 1
+                    base_distance = ((base_distance + 1) << 7) | (c & 0x7f)
+                base_offset = offset - base_distance
+                delta = self._inflate(pack, pos, size)
+            elif obj_type == OBJ_REF_DELTA:
+                base_sha = pack[pos:pos + 20]
+                pos += 20
+                delta = self._inflate(pack, pos, size)
+            else:
+                return obj_type, self._inflate(pack, pos, size)
+        if obj_type == OBJ_OFS_DELTA:
+            base_type, base_data = self.read_at(base_offset, repo)
+        else:
+            base_type, base_data = repo.read_object_bin(base_sha)
+        return base_type, apply_delta(base_data, delta)
+
+    @staticmethod
+    def _inflate(pack, pos, size):
+        decompressor = zlib.decompressobj()
+        chunks = []
+        chunk_size = max(size + 64, 4096)
+        while not decompressor.eof:
+            chunk = pack[pos:pos + chunk_size]
+            if not chunk:
+                raise UnsupportedRepository("truncated pack file")
+            pos += len(chunk)
+            chunks.append(decompressor.decompress(chunk))
+        data = b"".join(chunks)
+        if len(data) != size:
+            raise UnsupportedRepository("corrupt pack entry (expected %d bytes, got %d)" % (size, len(data)))
+        return data
+
+
+def _read_delta_size(delta, pos):
+    size = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, pos
+
+
+def apply_delta(base, delta):
+    base_size, pos = _read_delta_size(delta, 0)
+    if base_size != len(base):
+        raise UnsupportedRepository("delta base size mismatch")
+    result_size, pos = _read_delta_size(delta, pos)
+    out = []
+    delta_len = len(delta)
+    while pos < delta_len:
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            copy_offset = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    copy_offset |= delta[pos] << (8 * i)
+                    pos += 1
+            copy_size = 0
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    copy_size |= delta[pos] << (8 * i)
+                    pos += 1
+            if copy_size == 0:
+                copy_size = 0x10000
+            out.append(base[copy_offset:copy_offset + copy_size])
+        elif cmd:
+            out.append(delta[pos:pos + cmd])
+            pos += cmd
+        else:
+            raise UnsupportedRepository("invalid delta instruction")
+    result = b"".join(out)
+    if len(result) != result_size:
+        raise UnsupportedRepository("delta result size mismatch")
+    return result
+
+
+def _parse_signature_date(line):
+    # "Name <email> 1234567890 +0200"
+    parts = line.rsplit(b" ", 2)
+    try:
+        return int(parts[-2])
+    except (IndexError, ValueError):
+        return 0
+
+
+def blob_sha(data):
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class GitRepository:
+    # describe results by (git dir, HEAD, match pattern, tags digest), shared by all instances in the process
+    _describe_memo = {}
+
+    def __init__(self, git_dir, work_tree=None):
+        self.git_dir = git_dir
+        self.work_tree = work_tree
+        common_dir_file = os.path.join(git_dir, "commondir")
+        if os.path.exists(common_dir_file):
+            with open(common_dir_file, "r") as f:
+                self.common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+        else:
+            self.common_dir = git_dir
+        self.config = self._read_config()
+        self._check_supported()
+        self._object_dirs = self._find_object_dirs()
+        self._packs = None
+        self._packed_refs = None
+        self._commits = {}
+        self._tags = {}
+        self._trees = {}
+        self._shallow = self._read_shallow()
+
+    @classmethod
+    def discover(cls, start_path="."):
+        git_dir, work_tree = find_git_dir(start_path)
+        return cls(git_dir, work_tree)
+
+    # ---- configuration
+
+    def _read_config(self):
+        config = configparser.RawConfigParser(strict=False)
+        try:
+            config.read(os.path.join(self.common_dir, "config"))
+        except configparser.Error as exc:
+            raise UnsupportedRepository("unable to parse git config: %s" % exc)
+        return config
+
+    def config_get(self, section, key, default=None):
+        try:
+            return self.config.get(section, key)
+        except (configparser.Error, KeyError):
+            return default
+
+    def config_bool(self, section, key, default):
+        value = self.config_get(section, key)
+        if value is None:
+            return default
+        return value.strip().lower() in ("true", "yes", "on", "1")
+
+    def _check_supported(self):
+        object_format = self.config_get("extensions", "objectformat", "sha1")
+        if object_format.lower() != "sha1":
+            raise UnsupportedRepository("unsupported object format %s" % object_format)
+        ref_storage = self.config_get("extensions", "refstorage", "files")
+        if ref_storage.lower() != "files":
+            raise UnsupportedRepository("unsupported ref storage %s" % ref_storage)
+        if os.path.exists(os.path.join(self.common_dir, "info", "grafts")):
+            raise UnsupportedRepository("grafts are not supported")
+        if os.path.isdir(os.path.join(self.common_dir, "refs", "replace")) and \
+                os.listdir(os.path.join(self.common_dir, "refs", "replace")):
+            raise UnsupportedRepository("replace refs are not supported")
+
+    def _read_shallow(self):
+        shallow_path = os.path.join(self.common_dir, "shallow")
+        if not os.path.exists(shallow_path):
+            return frozenset()
+        with open(shallow_path, "r") as f:
+            return frozenset(line.strip() for line in f if line.strip())
+
+    # ---- objects
+
+    def _find_object_dirs(self):
+        objects_dir = os.path.join(self.common_dir, "objects")
+        object_dirs = [objects_dir]
+        alternates_path = os.path.join(objects_dir, "info", "alternates")
+        if os.path.exists(alternates_path):
+            with open(alternates_path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        object_dirs.append(os.path.normpath(os.path.join(objects_dir, line)))
+        return object_dirs
+
+    def _get_packs(self):
+        if self._packs is None:
+            packs = []
+            for object_dir in self._object_dirs:
+                pack_dir = os.path.join(object_dir, "pack")
+                if os.path.isdir(pack_dir):
+                    packs.extend(
+                        PackFile(os.path.join(pack_dir, fn))
+                        for fn in sorted(os.listdir(pack_dir)) if fn.endswith(".idx")
+                    )
+            self._packs = packs
+        return self._packs
+
+    def read_object_bin(self, sha_bin):
+        sha = sha_bin.hex()
+        for object_dir in self._object_dirs:
+            loose_path = os.path.join(object_dir, sha[:2], sha[2:])
+            if os.path.exists(loose_path):
+                with open(loose_path, "rb") as f:
+                    raw = zlib.decompress(f.read())
+                header, _, data = raw.partition(b"\0")
+                type_name = header.split(b" ", 1)[0].decode('ascii')
+                obj_type = {name: t for t, name in OBJECT_TYPE_NAMES.items()}[type_name]
+                return obj_type, data
+        for pack in self._get_packs():
+            offset = pack.find(sha_bin)
+            if offset is not None:
+                return pack.read_at(offset, self)
+        raise UnsupportedRepository("object %s not found (partial clone?)" % sha)
+
+    def read_object(self, sha):
+        return self.read_object_bin(bytes.fromhex(sha))
+
+    def read_commit(self, sha):
+        commit = self._commits.get(sha)
+        if commit is not None:
+            return commit
+        obj_type, data = self.read_object(sha)
+        if obj_type != OBJ_COMMIT:
+            raise ValueError("object %s is not a commit" % sha)
+        tree = None
+        parents = []
+        date = 0
+        for line in data.split(b"\n"):
+            if not line:
+                break
+            if line.startswith(b"tree "):
+                tree = line[5:].decode('ascii')
+            elif line.startswith(b"parent "):
+                parents.append(line[7:].decode('ascii'))
+            elif line.startswith(b"committer "):
+                date = _parse_signature_date(line)
+        if sha in self._shallow:
+            parents = []
+        commit = Commit(sha, tree, tuple(parents), date)
+        self._commits[sha] = commit
+        return commit
+
+    def read_tag(self, sha):
+        tag = self._tags.get(sha)
+        if tag is not None:
+            return tag
+        obj_type, data = self.read_object(sha)
+        if obj_type != OBJ_TAG:
+            return None
+        fields = {}
+        date = 0
+        for line in data.split(b"\n"):
+            if not line:
+                break
+            key, _, value = line.partition(b" ")
+            if key == b"tagger":
+                date = _parse_signature_date(line)
+            else:
+                fields[key] = value.decode('utf-8', 'replace')
+        tag = Tag(sha, fields.get(b"object"), fields.get(b"type"), fields.get(b"tag"), date)
+        self._tags[sha] = tag
+        return tag
+
+    def read_tree(self, sha):
+        """:return: list of (mode, name, sha) entries of a tree object"""
+        obj_type, data = self.read_object(sha)
+        if obj_type != OBJ_TREE:
+            raise ValueError("object %s is not a tree" % sha)
+        entries = []
+        pos = 0
+        while pos < len(data):
+            space = data.index(b" ", pos)
+            nul = data.index(b"\0", space)
+            mode = int(data[pos:space], 8)
+            name = data[space + 1:nul].decode('utf-8', 'surrogateescape')
+            entries.append((mode, name, data[nul + 1:nul + 21].hex()))
+            pos = nul + 21
+        return entries
+
+    def tree_entry(self, tree_sha, path):
+        """:return: (mode, sha) of the entry at a '/'-separated path under a tree, None if there isn't one"""
+        entry = (stat.S_IFDIR, tree_sha)
+        for name in path.split("/") if path else ():
+            if not stat.S_ISDIR(entry[0]):
+                return None
+            entries = self._trees.get(entry[1])
+            if entries is None:
+                entries = self._trees[entry[1]] = {
+                    entry_name: (mode, entry_sha) for mode, entry_name, entry_sha in self.read_tree(entry[1])
+                }
+            entry = entries.get(name)
+            if entry is None:
+                return None
+        return entry
+
+    def flatten_tree(self, sha, prefix=""):
+        """:return: dict of path to (mode, sha) for all non-tree entries under the tree, recursively"""
+        result = {}
+        for mode, name, entry_sha in self.read_tree(sha):
+            path = prefix + name
+            if stat.S_ISDIR(mode):
+                result.update(self.flatten_tree(entry_sha, path + "/"))
+            else:
+                result[path] = (mode, entry_sha)
+        return result
+
+    # ---- refs
+
+    def _read_packed_refs(self):
+        if self._packed_refs is None:
+            refs = {}
+            peeled = {}
+            fully_peeled = False
+            packed_refs_path = os.path.join(self.common_dir, "packed-refs")
+            if os.path.exists(packed_refs_path):
+                last_ref = None
+                with open(packed_refs_path, "r") as f:
+                    for line in f:
+                        line = line.rstrip("\n")
+                        if line.startswith("#"):
+                            fully_peeled = "fully-peeled" in line.split()
+                        elif line.startswith("^"):
+                            peeled[last_ref] = line[1:]
+                        elif line:
+                            sha, last_ref = line.split(" ", 1)
+                            refs[last_ref] = sha
+            self._packed_refs = (refs, peeled, fully_peeled)
+        return self._packed_refs
+
+    def resolve_ref(self, ref_name):
+        for base_dir in (self.git_dir, self.common_dir):
+            ref_path = os.path.join(base_dir, *ref_name.split("/"))
+            if os.path.isfile(ref_path):
+                with open(ref_path, "r") as f:
+                    value = f.read().strip()
+                if value.startswith("ref:"):
+                    return self.resolve_ref(value[4:].strip())
+                return value
+        return self._read_packed_refs()[0].get(ref_name)
+
+    def head(self):
+        """:return: sha of the commit checked out"""
+        with open(os.path.join(self.git_dir, "HEAD"), "r") as f:
+            value = f.read().strip()
+        if value.startswith("ref:"):
+            ref_name = value[4:].strip()
+            sha = self.resolve_ref(ref_name)
+            if sha is None:
+                raise Exception("HEAD points at %s which has no commits yet" % ref_name)
+            return sha
+        return value
+
+    def tag_refs(self):
+        """:return: dict of tag name (without refs/tags/) to the sha the ref points at"""
+        packed_refs = self._read_packed_refs()[0]
+        tags = {
+            ref_name[len("refs/tags/"):]: sha
+            for ref_name, sha in packed_refs.items() if ref_name.startswith("refs/tags/")
+        }
+        tags_dir = os.path.join(self.common_dir, "refs", "tags")
+        for root, dirs, files in os.walk(tags_dir):
+            for fn in files:
+                path = os.path.join(root, fn)
+                with open(path, "r") as f:
+                    value = f.read().strip()
+                if re.match("^[0-9a-f]{40}$", value):
+                    tags[os.path.relpath(path, tags_dir).replace(os.sep, "/")] = value
+        return tags
+
+    def peel_annotated_tag(self, tag_name, sha):
+        """:return: (commit sha, Tag) if the tag is annotated and points at a commit, None otherwise"""
+        refs, peeled, fully_peeled = self._read_packed_refs()
+        ref_name = "refs/tags/" + tag_name
+        if refs.get(ref_name) == sha and fully_peeled and ref_name not in peeled:
+            # packed-refs tells us this is a lightweight tag without having to read the object
+            return None
+        tag = self.read_tag(sha)
+        if tag is None:
+            return None
+        target = tag
+        while target.object_type == "tag":
+            target = self.read_tag(target.object)
+        if target.object_type != "commit":
+            return None
+        return target.object, tag
+
+    # ---- describe
+
+    def describe(self, match_pattern="*", max_candidates=DESCRIBE_MAX_CANDIDATES, dirty_suffix=None, dirty_paths=None):
+        """
+        equivalent to `git describe --match <match_pattern> [--dirty=<dirty_suffix>]`: describe HEAD using the
+        closest annotated tag whose name matches the pattern.
+        """
+        return self.describe_many([(match_pattern, ())], max_candidates, dirty_suffix, dirty_paths)[0]
+
+    def describe_many(self, requests, max_candidates=DESCRIBE_MAX_CANDIDATES, dirty_suffix=None, dirty_paths=None):
+        """
+        describe HEAD for many (match pattern, paths) requests at once: refs and tags are read once, and every commit
+        is read at most once for all of them.
+        with paths, the tag is the one describe picks, but only commits since it that changed any of the paths count
+        (like `git rev-list --count <tag>..HEAD -- <paths>`), and the bare tag name is returned if there are none.
+        :param dirty_paths: if given, only modifications of these files add the dirty suffix (see is_dirty)
+        :return: list of descriptions, in request order
+        """
+        head = self.head()
+        tag_refs = self.tag_refs()
+        descriptions = []
+        for match_pattern, paths in requests:
+            tags = {name: sha for name, sha in tag_refs.items() if wildmatch(match_pattern, name)}
+            description = self._describe_memoized(head, tags, match_pattern, max_candidates)
+            if paths:
+                description = self._scope_description(head, description, tags, paths)
+            descriptions.append(description)
+        if dirty_suffix is not None and self.is_dirty(dirty_paths):
+            descriptions = [description + dirty_suffix for description in descriptions]
+        return descriptions
+
+    def _describe_memoized(self, head, tags, match_pattern, max_candidates):
+        tags_digest = hashlib.sha1(
+            "\n".join("%s %s" % item for item in sorted(tags.items())).encode('utf-8')).hexdigest()
+        memo_key = (self.git_dir, head, match_pattern, max_candidates, tags_digest)
+        description = self._describe_memo.get(memo_key)
+        if description is None:
+            description = self._load_describe_cache(memo_key)
+            if description is None:
+                description = self._describe(head, tags, max_candidates)
+                self._store_describe_cache(memo_key, description)
+            self._describe_memo[memo_key] = description
+        return description
+
+    def _scope_description(self, head, description, tags, paths):
+        """:return: the description, with the depth counting only commits that changed any of the paths"""
+        if description in tags:
+            # HEAD is tagged
+            return description
+        tag_name, _, _ = description.rsplit("-", 2)
+        tag_commit = self.peel_annotated_tag(tag_name, tags[tag_name])[0]
+        depth = len(self.commits_changing_paths(head, tag_commit, paths))
+        return "%s-%d-g%s" % (tag_name, depth, head[:7]) if depth else tag_name
+
+    def commits_changing_paths(self, head, base, paths):
+        """
+        :return: shas of the commits `git rev-list <base>..<head> -- <paths>` lists - those reachable from head but not
+        from base that changed any of the '/'-separated paths, after git's default history simplification: a merge
+        that kept the paths of one of its parents only follows that parent (so a side branch it discarded, e.g. with
+        `merge -s ours`, doesn't count), and otherwise only counts if it differs from every parent. the walk follows
+        the one of git, as which parents are known to be uninteresting when simplifying a merge depends on it.
+        """
+        entries_memo = {}
+
+        def entries(sha):
+            if sha not in entries_memo:
+                tree = self.read_commit(sha).tree
+                entries_memo[sha] = [self.tree_entry(tree, path) for path in paths]
+            return entries_memo[sha]
+
+        # parents of the commits read so far - a simplified merge only keeps the parent it follows
+        parents = {}
+
+        def parse(sha):
+            if sha not in parents:
+                parents[sha] = list(self.read_commit(sha).parents)
+            return parents[sha]
+
+        uninteresting = {base}
+
+        def mark_parents_uninteresting(sha):
+            pending = [sha]
+            while pending:
+                for parent in parents.get(pending.pop(), ()):
+                    if parent not in uninteresting:
+                        uninteresting.add(parent)
+                        pending.append(parent)
+
+        def is_relevant(sha):
+            return sha not in uninteresting or sha == base
+
+        def is_treesame(sha):
+            """whether a commit left the paths as they were, simplifying its parents like git does"""
+            commit_parents = parents[sha]
+            if not commit_parents:
+                return all(entry is None for entry in entries(sha))
+            relevant_parents, relevant_change, irrelevant_change = 0, False, False
+            for parent in commit_parents:
+                parse(parent)
+                relevant = is_relevant(parent)
+                relevant_parents += relevant
+                if entries(parent) == entries(sha):
+                    if relevant:
+                        parents[sha] = [parent]
+                        return True
+                elif relevant:
+                    relevant_change = True
+                else:
+                    irrelevant_change = True
+            # parents reachable from base only matter if there are no others
+            return not (relevant_change if relevant_parents else irrelevant_change)
+
+        queue = []
+        seen = set()
+
+        def enqueue(sha):
+            seen.add(sha)
+            heapq.heappush(queue, (-self.read_commit(sha).date, len(seen), sha))
+
+        parse(base)
+        parse(head)
+        enqueue(base)
+        enqueue(head)
+        found = []
+        last_date = None
+        slop = REV_LIST_SLOP
+        while queue:
+            _, _, sha = heapq.heappop(queue)
+            if sha in uninteresting:
+                for parent in parse(sha):
+                    uninteresting.add(parent)
+                    parse(parent)
+                    mark_parents_uninteresting(parent)
+                    if parent not in seen:
+                        enqueue(parent)
+                # like git, stop a few commits after only uninteresting ones are left, in case of clock skew
+                if queue and ((last_date is not None and last_date <= -queue[0][0])
+                              or not all(queued_sha in uninteresting for _, _, queued_sha in queue)):
+                    slop = REV_LIST_SLOP
+                else:
+                    slop -= 1
+                if not queue or not slop:
+                    break
+                continue
+            if not is_treesame(sha):
+                found.append(sha)
+            for parent in parents[sha]:
+                parse(parent)
+                if parent not in seen:
+                    enqueue(parent)
+            last_date = self.read_commit(sha).date
+        return [sha for sha in found if sha not in uninteresting]
+
+    def _describe_cache_path(self):
+        return os.path.join(self.git_dir, "quicklib", "describe-cache.json")
+
+    def _load_describe_cache(self, memo_key):
+        try:
+            with open(self._describe_cache_path(), "r") as f:
+                return json.load(f).get(json.dumps(memo_key[1:]))
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def _store_describe_cache(self, memo_key, description):
+        try:
+            with open(self._describe_cache_path(), "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        if not isinstance(cached, dict) or len(cached) >= 64:
+            cached = {}
+        cached[json.dumps(memo_key[1:])] = description
+        try:
+            atomic_write(self._describe_cache_path(), json.dumps(cached))
+        except OSError:
+            # a read-only repository is fine, we just don't get to reuse the result
+            pass
+
+    def _known_names(self, tags):
+        """:return: dict of commit sha to the Tag describing it, following git's choice among several tags"""
+        names = {}
+        for tag_name in sorted(tags):
+            peeled = self.peel_annotated_tag(tag_name, tags[tag_name])
+            if peeled is None:
+                continue
+            commit_sha, tag = peeled
+            existing = names.get(commit_sha)
+            # several annotated tags on the same commit: the newest one wins
+            if existing is None or existing.date < tag.date:
+                names[commit_sha] = tag
+        return names
+
+    def _describe(self, head, tags, max_candidates):
+        # a close port of the candidate search in git's builtin/describe.c
+        names = self._known_names(tags)
+        if head in names:
+            return names[head].name
+        seen = 1
+        flags = {head: seen}
+        order = 0
+        queue = [(-self.read_commit(head).date, order, head)]
+        matches = []  # [name, depth, flag_within, found_order]
+        annotated_count = 0
+        seen_commits = 0
+        gave_up_on = None
+        while queue:
+            # like git's pop_most_recent_commit, parents are queued as soon as their child is popped
+            _, _, sha = heapq.heappop(queue)
+            commit = self.read_commit(sha)
+            for parent in commit.parents:
+                if parent not in flags:
+                    order += 1
+                    heapq.heappush(queue, (-self.read_commit(parent).date, order, parent))
+                    flags[parent] = seen
+            seen_commits += 1
+            tag = names.get(sha)
+            if tag is not None:
+                if len(matches) < max_candidates:
+                    flag_within = 1 << (len(matches) + 1)
+                    matches.append([tag, seen_commits - 1, flag_within, len(matches) + 1])
+                    flags[sha] |= flag_within
+                    annotated_count += 1
+                else:
+                    gave_up_on = commit
+                    break
+            for match in matches:
+                if not flags[sha] & match[2]:
+                    match[1] += 1
+            if annotated_count and not queue:
+                break
+            for parent in commit.parents:
+                flags[parent] |= flags[sha]
+        if not matches:
+            raise Exception("No annotated tags can describe '%s'." % head)
+        matches.sort(key=lambda m: (m[1], m[3]))
+        best = matches[0]
+        if gave_up_on is not None:
+            order += 1
+            heapq.heappush(queue, (-gave_up_on.date, order, gave_up_on.sha))
+        self._finish_depth_computation(queue, flags, best, order)
+        return "%s-%d-g%s" % (best[0].name, best[1], head[:7])
+
+    def _finish_depth_computation(self, queue, flags, best, order):
+        while queue:
+            _, _, sha = heapq.heappop(queue)
+            commit = self.read_commit(sha)
+            if flags[sha] & best[2]:
+                if all(flags[other] & best[2] for (_, _, other) in queue):
+                    break
+            else:
+                best[1] += 1
+            for parent in commit.parents:
+                if parent not in flags:
+                    order += 1
+                    heapq.heappush(queue, (-self.read_commit(parent).date, order, parent))
+                    flags[parent] = 0
+                flags[parent] |= flags[sha]
+
+    # ---- index and work tree
+
+    def read_index(self):
+        index_path = os.path.join(self.git_dir, "index")
+        if not os.path.exists(index_path):
+            return Index([], 0, None)
+        with open(index_path, "rb") as f:
+            index_mtime = os.fstat(f.fileno()).st_mtime_ns
+            data = f.read()
+        if data[:4] != b"DIRC":
+            raise UnsupportedRepository("unrecognized index file")
+        version, count = struct.unpack(">II", data[4:12])
+        if version not in (2, 3, 4):
+            raise UnsupportedRepository("unsupported index version %d" % version)
+        entries = []
+        pos = 12
+        previous_path = b""
+        for _ in range(count):
+            (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode, uid, gid, size) = \
+                struct.unpack(">10I", data[pos:pos + 40])
+            sha = data[pos + 40:pos + 60].hex()
+            flags, = struct.unpack(">H", data[pos + 60:pos + 62])
+            path_start = pos + 62
+            extended_flags = 0
+            if flags & 0x4000:
+                if version < 3:
+                    raise UnsupportedRepository("extended index entry in a version 2 index")
+                extended_flags, = struct.unpack(">H", data[path_start:path_start + 2])
+                path_start += 2
+            if version == 4:
+                strip, path_start = _read_offset_varint(data, path_start)
+                path_end = data.index(b"\0", path_start)
+                path = previous_path[:len(previous_path) - strip] + data[path_start:path_end]
+                pos = path_end + 1
+            else:
+                path_end = data.index(b"\0", path_start)
+                path = data[path_start:path_end]
+                pos += ((path_end - pos) + 8) & ~7
+            previous_path = path
+            if stat.S_ISDIR(mode):
+                raise UnsupportedRepository("sparse index is not supported")
+            entries.append(IndexEntry(
+                path.decode('utf-8', 'surrogateescape'), (ctime_s, ctime_ns), (mtime_s, mtime_ns),
+                dev, ino, mode, uid, gid, size, sha, flags, extended_flags,
+            ))
+        cache_tree_root = None
+        end = len(data) - 20
+        while pos + 8 <= end:
+            signature = data[pos:pos + 4]
+            ext_size, = struct.unpack(">I", data[pos + 4:pos + 8])
+            ext_data = data[pos + 8:pos + 8 + ext_size]
+            if signature == b"TREE":
+                cache_tree_root = _parse_cache_tree_root(ext_data)
+            elif signature == b"link":
+                raise UnsupportedRepository("split index is not supported")
+            elif b"A" <= signature[:1] <= b"Z":
+                # optional extension we don't need
+                pass
+            else:
+                raise UnsupportedRepository("unsupported index extension %r" % signature)
+            pos += 8 + ext_size
+        return Index(entries, index_mtime, cache_tree_root)
+
+    def is_dirty(self, paths=None):
+        """
+        whether the work tree or the index differ from HEAD, like `git describe --dirty` (untracked files don't count).
+        :param paths: '/'-separated paths of the only files to look at (e.g. the ones going into a package), like
+            `git diff --quiet HEAD -- <paths>`
+        files whose stat data doesn't match the index are hashed, and their hashes kept in a stat cache (see StatCache)
+        """
+        index = self.read_index()
+        entries = index.entries
+        if paths is not None:
+            paths = set(paths)
+            entries = [entry for entry in entries if entry.path in paths]
+        if any(entry.stage != 0 for entry in entries):
+            # unmerged paths
+            return True
+        if self._index_differs_from_head(index, paths):
+            return True
+        stat_cache = StatCache(self._stat_cache_path())
+        try:
+            return any(self._worktree_entry_modified(entry, index, stat_cache) for entry in entries)
+        finally:
+            stat_cache.save(entry.path for entry in index.entries)
+
+    def _stat_cache_path(self):
+        return os.path.join(self.git_dir, "quicklib", "stat-cache.json")
+
+    def _index_differs_from_head(self, index, paths=None):
+        head_tree = self.read_commit(self.head()).tree
+        if index.cache_tree_root is not None and (paths is None or index.cache_tree_root == head_tree):
+            return index.cache_tree_root != head_tree
+        if paths is not None:
+            index_files = {entry.path: (entry.mode, entry.sha) for entry in index.entries if entry.path in paths}
+            return any(self.tree_entry(head_tree, path) != index_files.get(path) for path in paths)
+        head_files = self.flatten_tree(head_tree)
+        if len(head_files) != len(index.entries):
+            return True
+        for entry in index.entries:
+            if head_files.get(entry.path) != (entry.mode, entry.sha):
+                return True
+        return False
+
+    def _worktree_entry_modified(self, entry, index, stat_cache=None):
+        if entry.assume_valid or entry.skip_worktree:
+            return False
+        if entry.mode == S_IFGITLINK:
+            raise UnsupportedRepository("submodules are not supported")
+        path = os.path.join(self.work_tree, *entry.path.split("/"))
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return True
+        except NotADirectoryError:
+            return True
+        if stat.S_ISLNK(entry.mode) != stat.S_ISLNK(st.st_mode) and self.config_bool("core", "symlinks", True):
+            return True
+        if stat.S_ISREG(st.st_mode) and self.config_bool("core", "filemode", os.name != 'nt'):
+            if bool(entry.mode & 0o100) != bool(st.st_mode & 0o100):
+                return True
+        if self._stat_matches(entry, st, index):
+            return False
+        sha = stat_cache.get(entry.path, st) if stat_cache is not None else None
+        if sha is None:
+            sha = self._content_sha(path, st)
+            if stat_cache is not None:
+                stat_cache.put(entry.path, st, sha)
+        if sha == entry.sha:
+            return False
+        if self.content_may_be_filtered():
+            raise UnsupportedRepository("can't compare %s without applying git's content filters" % entry.path)
+        return True
+
+    @staticmethod
+    def _stat_matches(entry, st, index):
+        mtime_ns = st.st_mtime_ns
+        if entry.size != st.st_size & 0xffffffff:
+            return False
+        if entry.mtime[0] != (mtime_ns // 1000000000) & 0xffffffff:
+            return False
+        if entry.mtime[1] and entry.mtime[1] != mtime_ns % 1000000000:
+            return False
+        if entry.ctime[0] != (st.st_ctime_ns // 1000000000) & 0xffffffff and os.name != 'nt':
+            return False
+        if entry.ino and entry.ino != st.st_ino & 0xffffffff:
+            return False
+        # "racy git": a file modified in the same time slot as the index was written can't be trusted by stat
+        if entry.mtime[1]:
+            return entry.mtime[0] * 1000000000 + entry.mtime[1] < index.mtime
+        return entry.mtime[0] < index.mtime // 1000000000
+
+    def _content_sha(self, path, st):
+        if stat.S_ISLNK(st.st_mode):
+            data = os.fsencode(os.readlink(path))
+        else:
+            with open(path, "rb") as f:
+                data = f.read()
+        return blob_sha(data)
+
+    def content_may_be_filtered(self):
+        """whether checked-out content may differ from the stored blobs (line endings or attribute filters)"""
+        autocrlf = (self.config_get("core", "autocrlf") or "false").strip().lower()
+        return autocrlf not in ("false", "0", "no", "off") or \
+            os.path.exists(os.path.join(self.work_tree, ".gitattributes")) or \
+            os.path.exists(os.path.join(self.common_dir, "info", "attributes"))
+
+
+class StatCache:
+    """
+    content shas of work tree files, by path and stat data. git refreshes the index's stat data of files it had to
+    hash (e.g. touched but unchanged ones) so it doesn't hash them again - reading the repository, we can't write the
+    index, so we remember them here instead.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries, self.mtime_ns = self._load()
+        self.changed = False
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+                mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        except (OSError, ValueError):
+            return {}, 0
+        if not isinstance(entries, dict):
+            return {}, 0
+        return entries, mtime_ns
+
+    @staticmethod
+    def _stat_key(st):
+        return [st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, st.st_mode]
+
+    def get(self, path, st):
+        """:return: the content sha of the file at path if it didn't change since it was hashed, otherwise None"""
+        cached = self.entries.get(path)
+        if not isinstance(cached, list) or cached[:5] != self._stat_key(st):
+            return None
+        # "racy git" again: a file modified in the same second the cache was written may have changed since
+        if st.st_mtime_ns // 1000000000 >= self.mtime_ns // 1000000000:
+            return None
+        return cached[5]
+
+    def put(self, path, st, sha):
+        self.entries[path] = self._stat_key(st) + [sha]
+        self.changed = True
+
+    def save(self, known_paths):
+        """write the cache, keeping only the given paths (the index's) so it doesn't grow forever"""
+        if not self.changed:
+            return
+        known_paths = set(known_paths)
+        # files modified this second may change again without their stat data changing, they can't be trusted later
+        now_s = time.time_ns() // 1000000000
+        entries = {path: cached for path, cached in self.entries.items()
+                   if path in known_paths and isinstance(cached, list) and cached[0] // 1000000000 < now_s}
+        try:
+            atomic_write(self.path, json.dumps(entries))
+        except OSError:
+            # a read-only repository is fine, files are just hashed again next time
+            pass
+
+
+def _read_offset_varint(data, pos):
+    # git's "offset" varint encoding, used for path prefix compression in index version 4
+    c = data[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+
+def _parse_cache_tree_root(ext_data):
+    # root entry: "" NUL entry_count SP subtree_count LF [sha1 if entry_count >= 0]
+    nul = ext_data.index(b"\0")
+    if nul != 0:
+        return None
+    newline = ext_data.index(b"\n", nul)
+    entry_count = int(ext_data[nul + 1:newline].split(b" ")[0])
+    if entry_count < 0:
+        return None
+    return ext_data[newline + 1:newline + 21].hex()
@@ -1,21 +1,27 @@
+import hashlib
+import importlib.util
 import os
+import py_compile
 import re
-import shutil
+import tempfile
 import textwrap
 import zipfile
 
-import pkg_resources
 from setuptools import Command
 from distutils import log
 
 import quicklib
 import quicklib.version
+from .archiving import link_or_copy, unlink_if_exists
+from .caching import atomic_write
 from .versioning import DEV_VERSION
 from .virtualfiles import register_for_removal
 from .datafiles import PrepareManifestIn
 
 INCORPORATED = 'quicklib_incorporated'
 INCORPORATED_ZIP = INCORPORATED + '.zip'
+# batch builds resolve the zip once and hand it to every build through this environment variable
+INCORPORATED_ZIP_ENV = "QUICKLIB_INCORPORATED_ZIP"
 
 
 # ---- used by quicklib itself
@@ -23,35 +29,114 @@ INCORPORATED_ZIP = INCORPORATED + '.zip'
 class CreateIncorporatedZip(Command):
     SHORTNAME = "create_incorporated_zip"
 
-    user_options = []
+    user_options = [
+        ("cache-path=", None,
+         "where the last created zip is kept, and reused while its content is unchanged "
+         "(default: quicklib_incorporated.zip under the build directory)"),
+        ("precompile", None,
+         "also ship bytecode of the building interpreter, so installs using it don't compile quicklib from source"),
+    ]
+    boolean_options = ["precompile"]
+
+    # fixed entry timestamps (the earliest a zip can hold) make the zip byte-reproducible
+    ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+    CONTENT_HASH_COMMENT_PREFIX = b"quicklib-content-sha256:"
 
     def initialize_options(self):
-        pass
+        self.cache_path = None
+        self.precompile = False
 
     def finalize_options(self):
-        pass
+        if self.cache_path is None:
+            self.cache_path = os.path.join(self.get_finalized_command('build').build_base, INCORPORATED_ZIP)
 
     def run(self):
         import quicklib
         quicklib_path = os.path.relpath(os.path.dirname(quicklib.__file__), os.getcwd())
         final_path = os.path.join(quicklib_path, INCORPORATED_ZIP)
         log.info("incorporating %s from %s (and from select dependencies)" % (INCORPORATED_ZIP, os.path.abspath(quicklib_path)))
-        self.create_zip(final_path)
+        self.create_zip(final_path, cache_path=self.cache_path, precompile=self.precompile)
         register_for_removal(final_path)
 
-    def create_zip(self, target_path, excluded_exts=(".pyc", ".pyo"), excluded_dirs=('__pycache__',)):
+    def create_zip(self, target_path, excluded_exts=(".pyc", ".pyo"), excluded_dirs=('__pycache__',), cache_path=None,
+                   precompile=False):
+        entries = self._collect_entries(target_path, excluded_exts, excluded_dirs)
+        comment = self.CONTENT_HASH_COMMENT_PREFIX + self._content_hash(entries, precompile).encode('ascii')
+        # left behind by a killed build, and possibly a link to the cached zip
+        unlink_if_exists(target_path)
+        if cache_path is not None and self._read_zip_comment(cache_path) == comment:
+            log.info("incorporated zip content unchanged, reusing %s" % cache_path)
+            link_or_copy(cache_path, target_path)
+            return
+        self._write_zip(target_path, entries, comment, precompile)
+        if cache_path is not None:
+            with open(target_path, "rb") as f:
+                atomic_write(cache_path, f.read(), binary=True)
+
+    def _collect_entries(self, target_path, excluded_exts, excluded_dirs):
+        """:return: sorted list of (arcname, source file path)"""
         packages = self._pacakges_to_incorporate()
         top_level_folders = [os.path.dirname(pkg.__file__) for pkg in packages]
-        with zipfile.ZipFile(target_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for top_folder in top_level_folders:
-                for root, dirs, files in os.walk(top_folder):
-                    if root in excluded_dirs:
+        target_path = os.path.abspath(target_path)
+        entries = []
+        for top_folder in top_level_folders:
+            for root, dirs, files in os.walk(top_folder):
+                # pruned in place so excluded directories are never walked into
+                dirs[:] = [d for d in dirs if d not in excluded_dirs]
+                for f in files:
+                    source_file = os.path.join(root, f)
+                    if os.path.splitext(source_file)[-1].lower() in excluded_exts:
                         continue
-                    for f in files:
-                        source_file = os.path.join(root, f)
-                        arcname = os.path.relpath(source_file, os.path.dirname(top_folder))
-                        if os.path.splitext(source_file)[-1].lower() not in excluded_exts:
-                            zipf.write(source_file, arcname)
+                    if os.path.abspath(source_file) == target_path:
+                        # a leftover from an interrupted build
+                        continue
+                    arcname = os.path.relpath(source_file, os.path.dirname(top_folder)).replace(os.sep, "/")
+                    entries.append((arcname, source_file))
+        return sorted(entries)
+
+    @staticmethod
+    def _content_hash(entries, precompile=False):
+        content_hash = hashlib.sha256()
+        if precompile:
+            # bytecode is specific to the interpreter version it was compiled by
+            content_hash.update(b"precompiled:" + importlib.util.MAGIC_NUMBER)
+        for arcname, source_file in entries:
+            with open(source_file, "rb") as f:
+                data = f.read()
+            content_hash.update(b"%d:%s%d:" % (len(arcname), arcname.encode('utf-8'), len(data)))
+            content_hash.update(data)
+        return content_hash.hexdigest()
+
+    @staticmethod
+    def _read_zip_comment(zip_path):
+        try:
+            with zipfile.ZipFile(zip_path) as zipf:
+                return zipf.comment
+        except (OSError, zipfile.BadZipFile):
+            return None
+
+    def _write_zip(self, target_path, entries, comment, precompile=False):
+        with zipfile.ZipFile(target_path, 'w', zipfile.ZIP_DEFLATED) as zipf, \
+                tempfile.TemporaryDirectory(prefix="quicklib-pyc-") as temp_dir:
+            for arcname, source_file in entries:
+                with open(source_file, "rb") as f:
+                    self._write_entry(zipf, arcname, f.read(), zipfile.ZIP_DEFLATED)
+                if precompile and arcname.endswith(".py"):
+                    # zipimport only looks for bytecode right next to the source (not under __pycache__).
+                    # unchecked hash-based pycs are used as-is, regardless of the source entry's timestamp.
+                    # they're read on every import, so they're stored uncompressed.
+                    pyc_path = py_compile.compile(
+                        source_file, cfile=os.path.join(temp_dir, "module.pyc"), dfile=arcname, doraise=True,
+                        invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+                    with open(pyc_path, "rb") as f:
+                        self._write_entry(zipf, arcname + "c", f.read(), zipfile.ZIP_STORED)
+            zipf.comment = comment
+
+    def _write_entry(self, zipf, arcname, data, compress_type):
+        info = zipfile.ZipInfo(arcname, date_time=self.ZIP_DATE_TIME)
+        info.compress_type = compress_type
+        info.external_attr = 0o644 << 16
+        zipf.writestr(info, data)
 
     def _pacakges_to_incorporate(self):
         import quicklib
@@ -88,22 +173,28 @@ class BundleIncorporatedZip(Command):
         pass
 
     def run(self):
-        version = quicklib.version.__version__
-        if version == DEV_VERSION:
-            raise Exception("cowardly refusing to bundle incorportated zip when quicklib states DEV_VERSION "
-                            "(path to quicklib is %s, did you remember to pip install and use that?)" %
-                            os.path.dirname(os.path.abspath(quicklib.__file__)))
-        zip_path = pkg_resources.resource_filename('quicklib', INCORPORATED_ZIP)
-        bundled_zip_name = "%s.v%s.zip" % (INCORPORATED, version)
+        zip_path = os.environ.get(INCORPORATED_ZIP_ENV) or find_incorporated_zip()
+        bundled_zip_name = "%s.v%s.zip" % (INCORPORATED, quicklib.version.__version__)
         log.info("bundling %s as %s" % (
             zip_path, bundled_zip_name))
-        shutil.copy(zip_path, bundled_zip_name)
+        # the bundled zip is never modified, so a link is as good as a copy - but not one left behind by a killed build
+        unlink_if_exists(bundled_zip_name)
+        link_or_copy(zip_path, bundled_zip_name)
         register_for_removal(bundled_zip_name)
         # add to MANIFEST.in
         pmi = self.get_finalized_command(PrepareManifestIn.SHORTNAME)
         pmi.rewriter.add_include(bundled_zip_name)
 
 
+def find_incorporated_zip():
+    version = quicklib.version.__version__
+    if version == DEV_VERSION:
+        raise Exception("cowardly refusing to bundle incorportated zip when quicklib states DEV_VERSION "
+                        "(path to quicklib is %s, did you remember to pip install and use that?)" %
+                        os.path.dirname(os.path.abspath(quicklib.__file__)))
+    return os.path.join(os.path.dirname(os.path.abspath(quicklib.__file__)), INCORPORATED_ZIP)
+
+
 # this tells the library whether it's using a fresh (source tree) or incorporated (zip) quicklib
 def is_quicklib_incorporated():
     return bool(re.match("^%s\\.v.*\\.zip$" % INCORPORATED, os.path.dirname(os.path.dirname(quicklib.__file__))))
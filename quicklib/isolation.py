@@ -0,0 +1,81 @@
+"""Isolated builds: run the build in an overlay copy of the library tree instead of the checkout itself.
+
+The overlay is staged under the checkout's build directory using hard links (falling back to reflinks, then copies), and every
+virtual file the build creates or modifies is written there, so the checkout's sources are never touched. This lets
+several builds run in the same checkout at once, and a crashed build leaves nothing behind but its overlay.
+Virtual files are always replaced (never modified in place), so hard-linked sources are safe.
+"""
+import contextlib
+import os
+import shutil
+import tempfile
+
+from . import virtualfiles
+from .archiving import link_or_copy
+
+ISOLATED_BUILD_ENV = "QUICKLIB_ISOLATED_BUILD"
+OVERLAYS_DIR = os.path.join("build", "quicklib-overlays")
+
+# never staged: build outputs and metadata at the top of the tree, and caches/virtualenvs anywhere in it
+SKIPPED_TOP_DIRS = frozenset(["build", "dist", ".git", ".hg", ".svn"])
+SKIPPED_DIRS = frozenset([
+    "__pycache__", ".tox", ".nox", ".venv", "venv", "node_modules", ".mypy_cache", ".pytest_cache", ".ruff_cache",
+    ".eggs",
+])
+
+# commands whose output is redirected from the overlay back to the checkout
+DIST_DIR_COMMANDS = ("sdist", "bdist", "bdist_wheel", "bdist_egg")
+
+
+def is_isolated_build_requested(isolated_build=None):
+    """an explicit setup kwarg wins, otherwise the QUICKLIB_ISOLATED_BUILD environment variable decides"""
+    if isolated_build is not None:
+        return bool(isolated_build)
+    return os.environ.get(ISOLATED_BUILD_ENV, "").lower() in ("1", "true", "yes", "on")
+
+
+def stage_overlay(source_root, overlay_root):
+    """:return: number of files staged from source_root into (existing, empty) overlay_root"""
+    staged = 0
+    for dir_path, dirs, files in os.walk(source_root):
+        rel_dir = os.path.relpath(dir_path, source_root)
+        overlay_dir = os.path.normpath(os.path.join(overlay_root, rel_dir))
+        skipped = SKIPPED_DIRS | SKIPPED_TOP_DIRS if rel_dir == os.curdir else SKIPPED_DIRS
+        subdirs = []
+        for d in dirs:
+            if d in skipped or d.endswith(".egg-info"):
+                continue
+            if os.path.islink(os.path.join(dir_path, d)):
+                os.symlink(os.readlink(os.path.join(dir_path, d)), os.path.join(overlay_dir, d))
+                continue
+            os.mkdir(os.path.join(overlay_dir, d))
+            subdirs.append(d)
+        dirs[:] = subdirs
+        for f in files:
+            source_path = os.path.join(dir_path, f)
+            if os.path.islink(source_path):
+                os.symlink(os.readlink(source_path), os.path.join(overlay_dir, f))
+            else:
+                link_or_copy(source_path, os.path.join(overlay_dir, f))
+            staged += 1
+    return staged
+
+
+@contextlib.contextmanager
+def isolated_build(source_root="."):
+    """stage an overlay of source_root and run the enclosed code in it, with virtual files redirected into it"""
+    source_root = os.path.abspath(source_root)
+    overlays_dir = os.path.join(source_root, OVERLAYS_DIR)
+    os.makedirs(overlays_dir, exist_ok=True)
+    overlay_root = tempfile.mkdtemp(prefix="overlay-", dir=overlays_dir)
+    staged = stage_overlay(source_root, overlay_root)
+    print("note: isolated build, staged %d files into %s" % (staged, overlay_root))
+    orig_cwd = os.getcwd()
+    virtualfiles.set_overlay(source_root, overlay_root)
+    os.chdir(overlay_root)
+    try:
+        yield overlay_root
+    finally:
+        os.chdir(orig_cwd)
+        virtualfiles.set_overlay(None, None)
+        shutil.rmtree(overlay_root, ignore_errors=True)
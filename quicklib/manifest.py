@@ -0,0 +1,329 @@
+"""Single-walk evaluation of MANIFEST.in templates.
+
+setuptools runs each template line as a separate pass: every include globs the file system again, and every exclude
+scans the whole file list. Here all lines are compiled up front into one matcher instead. A file's fate is decided by
+the last line that matches it (an include adds it, an exclude removes it, a line that doesn't match leaves it as it
+was), so putting the lines' patterns into one regex in reverse order lets a single match per file give the same
+result. Candidate files are collected in one directory walk, which only descends into directories that some include
+line can reach.
+
+Lines are matched with the same semantics setuptools uses (its glob for include lines, its translate_pattern for exclude
+lines), and the same warnings are given for lines that have no effect. Templates using paths this can't handle (absolute,
+or containing "." or "..") are evaluated the regular, line-by-line way.
+"""
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from setuptools import Command
+from distutils import log
+from distutils.errors import DistutilsTemplateError
+from distutils.filelist import FileList
+from distutils.text_file import TextFile
+from setuptools.command.egg_info import manifest_maker, translate_pattern
+
+# same messages as setuptools' FileList.process_template_line
+WARNINGS = {
+    'include': "warning: no files found matching '%s'",
+    'exclude': "warning: no previously-included files found matching '%s'",
+    'global-include': "warning: no files found matching '%s' anywhere in distribution",
+    'global-exclude': "warning: no previously-included files matching '%s' found anywhere in distribution",
+    'recursive-include': "warning: no files found matching '%s' under directory '%s'",
+    'recursive-exclude': "warning: no previously-included files matching '%s' found under directory '%s'",
+    'graft': "warning: no directories found matching '%s'",
+    'prune': "no previously-included directories found matching '%s'",
+}
+INCLUDE_ACTIONS = frozenset(['include', 'global-include', 'recursive-include', 'graft'])
+MAGIC_CHARS = re.compile(r"[*?[]")
+
+
+def _regex_body(compiled):
+    # translate_pattern anchors its patterns at the end, the combined matcher adds its own anchor
+    assert compiled.pattern.endswith(r"\Z")
+    return compiled.pattern[:-2]
+
+
+def translate_glob(pattern, recursive=False):
+    """
+    :return: regex source matching the files setuptools' glob(pattern, recursive=recursive) finds - unlike the standard
+             glob, it doesn't skip hidden files
+    """
+    if not recursive:
+        # a '**' is just a '*' then
+        pattern = os.sep.join("*" if chunk == "**" else chunk for chunk in pattern.split(os.sep))
+    return _regex_body(translate_pattern(pattern))
+
+
+def _literal_prefix(dir_chunks):
+    """:return: the leading directories of a path before any wildcard, as a tuple"""
+    prefix = []
+    for chunk in dir_chunks:
+        if MAGIC_CHARS.search(chunk):
+            break
+        prefix.append(chunk)
+    return tuple(prefix)
+
+
+class ManifestRule:
+    """one pattern of one template line"""
+    def __init__(self, action, pattern, regex, walk_scope=None, warn_args=()):
+        self.action = action
+        self.pattern = pattern
+        self.regex = regex
+        # where an include rule can match files: (directory as a tuple of names, maximal depth of directories below the
+        # top one or None), None for exclude rules
+        self.walk_scope = walk_scope
+        self.warn_args = warn_args
+
+    @property
+    def is_include(self):
+        return self.action in INCLUDE_ACTIONS
+
+    def warn(self):
+        log.warn(WARNINGS[self.action], *self.warn_args)
+
+
+def _is_supported_path(path):
+    return not os.path.isabs(path) and not any(chunk in (os.curdir, os.pardir) for chunk in path.split(os.sep))
+
+
+def compile_line(line):
+    """:return: list of ManifestRule for a template line, raises DistutilsTemplateError for malformed lines"""
+    action, patterns, dir, dir_pattern = FileList()._parse_template_line(line)
+    sep = os.sep
+    rules = []
+    if action == 'include':
+        for pattern in patterns:
+            chunks = pattern.split(sep)
+            rules.append(ManifestRule(action, pattern, translate_glob(pattern),
+                                      (_literal_prefix(chunks[:-1]), len(chunks) - 1), (pattern,)))
+    elif action == 'exclude':
+        rules.extend(ManifestRule(action, pattern, _regex_body(translate_pattern(pattern)), warn_args=(pattern,))
+                     for pattern in patterns)
+    elif action == 'global-include':
+        rules.extend(ManifestRule(action, pattern, _regex_body(translate_pattern(os.path.join('**', pattern))),
+                                  ((), None), (pattern,))
+                     for pattern in patterns)
+    elif action == 'global-exclude':
+        rules.extend(ManifestRule(action, pattern, _regex_body(translate_pattern(os.path.join('**', pattern))),
+                                  warn_args=(pattern,))
+                     for pattern in patterns)
+    elif action == 'recursive-include':
+        rules.extend(ManifestRule(action, pattern, translate_glob(os.path.join(dir, '**', pattern), recursive=True),
+                                  (_literal_prefix(dir.split(sep)), None), (pattern, dir))
+                     for pattern in patterns)
+    elif action == 'recursive-exclude':
+        rules.extend(ManifestRule(action, pattern, _regex_body(translate_pattern(os.path.join(dir, '**', pattern))),
+                                  warn_args=(pattern, dir))
+                     for pattern in patterns)
+    elif action == 'graft':
+        # any file under a directory matching the (glob) dir pattern
+        rules.append(ManifestRule(action, dir_pattern, translate_glob(dir_pattern) + re.escape(sep) + ".*",
+                                  (_literal_prefix(dir_pattern.split(sep)), None), (dir_pattern,)))
+    elif action == 'prune':
+        rules.append(ManifestRule(action, dir_pattern, _regex_body(translate_pattern(os.path.join(dir_pattern, '**'))),
+                                  warn_args=(dir_pattern,)))
+    return rules
+
+
+class CompiledManifest:
+    """a MANIFEST.in template compiled into a single matcher"""
+    def __init__(self, lines):
+        """
+        :param lines: template lines (comments and blank lines are skipped)
+        malformed lines are skipped and reported in self.errors as (line index, message)
+        """
+        self.lines = []
+        self.rules = []
+        self.errors = []
+        self.supported = True
+        for index, line in enumerate(lines):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                rules = compile_line(line)
+            except (DistutilsTemplateError, ValueError) as exc:
+                self.errors.append((index, str(exc)))
+                continue
+            self.lines.append(line)
+            self.rules.extend(rules)
+            if not all(_is_supported_path(path) for rule in rules for path in rule.warn_args):
+                self.supported = False
+        self.walk_scopes = set(rule.walk_scope for rule in self.rules if rule.is_include)
+        # the last matching rule decides
+        self.matcher = self._combine(self.rules)
+
+    @staticmethod
+    def _combine(rules):
+        """:return: a regex matching what any of the rules match, the last matching rule being the one reported"""
+        if not rules:
+            return re.compile(r"(?!)")
+        return re.compile("(?:%s)\\Z" % "|".join(
+            "(?P<r%d>%s)" % (index, rules[index].regex) for index in reversed(range(len(rules)))
+        ), re.DOTALL)
+
+    @classmethod
+    def from_file(cls, template_path):
+        """:return: (CompiledManifest, {line index: line number in the file}) - read just like sdist reads it"""
+        template = TextFile(template_path, strip_comments=1, skip_blanks=1, join_lines=1, lstrip_ws=1, rstrip_ws=1,
+                            collapse_join=1)
+        lines = []
+        line_numbers = {}
+        try:
+            while True:
+                line = template.readline()
+                if line is None:
+                    break
+                line_numbers[len(lines)] = template.current_line
+                lines.append(line)
+        finally:
+            template.close()
+        return cls(lines), line_numbers
+
+    def _may_contain_matches(self, dir_chunks):
+        for prefix, max_depth in self.walk_scopes:
+            common = min(len(prefix), len(dir_chunks))
+            if prefix[:common] == dir_chunks[:common] and (max_depth is None or len(dir_chunks) <= max_depth):
+                return True
+        return False
+
+    def walk(self, root=os.curdir):
+        """:return: all files under root that an include rule could match, in one walk (symlinks are followed)"""
+        files = []
+        seen_dirs = set()
+        for dir_path, dirs, names in os.walk(root, followlinks=True):
+            st = os.stat(dir_path)
+            if (st.st_dev, st.st_ino) in seen_dirs:
+                # a symlink loop
+                dirs[:] = []
+                continue
+            seen_dirs.add((st.st_dev, st.st_ino))
+            rel_dir = os.path.relpath(dir_path, root)
+            dir_chunks = () if rel_dir == os.curdir else tuple(rel_dir.split(os.sep))
+            dirs[:] = [d for d in dirs if self._may_contain_matches(dir_chunks + (d,))]
+            for name in names:
+                path = os.path.join(*(dir_chunks + (name,)))
+                if os.path.isfile(os.path.join(root, path)):
+                    files.append(path)
+        return files
+
+    def evaluate(self, initial_files, candidate_files=None, warn=True):
+        """
+        :param initial_files: files already selected before the template applies (e.g. sdist's defaults)
+        :param candidate_files: the files include lines may add, by default found by walking the current directory
+        :param warn: warn about lines that matched nothing, like setuptools does
+        :return: the selected files: the surviving initial files followed by the added ones
+        """
+        if candidate_files is None:
+            candidate_files = self.walk() if self.walk_scopes else []
+        winners = set()
+        selected = []
+        initial_set = set(initial_files)
+        for path, included in ([(path, True) for path in initial_files] +
+                               [(path, False) for path in candidate_files if path not in initial_set]):
+            m = self.matcher.match(path)
+            if m is not None:
+                index = int(m.lastgroup[1:])
+                winners.add(index)
+                included = self.rules[index].is_include
+            if included:
+                selected.append(path)
+        if warn:
+            for index, rule in enumerate(self.rules):
+                # an include that decided some file's fate found it, an exclude may only have matched excluded files
+                if rule.is_include and index in winners:
+                    continue
+                if not self._rule_had_effect(index, initial_files, candidate_files):
+                    rule.warn()
+        return selected
+
+    def _rule_had_effect(self, index, initial_files, candidate_files):
+        """whether a rule found any files when its turn came (only needed for warnings)"""
+        regex = re.compile(self.rules[index].regex + r"\Z", re.DOTALL)
+        if self.rules[index].is_include:
+            return any(regex.match(path) for path in candidate_files) or \
+                any(regex.match(path) and os.path.isfile(path) for path in initial_files)
+        earlier = CompiledManifest._combine(self.rules[:index])
+        initial_set = set(initial_files)
+        for path in list(initial_files) + [path for path in candidate_files if path not in initial_set]:
+            if not regex.match(path):
+                continue
+            m = earlier.match(path)
+            if (self.rules[int(m.lastgroup[1:])].is_include if m is not None else path in initial_set):
+                return True
+        return False
+
+    def apply_to(self, filelist):
+        """evaluate the template on a setuptools/distutils FileList, replacing its files"""
+        if not self.supported:
+            for line in self.lines:
+                filelist.process_template_line(line)
+            return
+        filelist.files = self.evaluate(filelist.files, filelist.allfiles)
+
+
+class ManifestMaker(manifest_maker):
+    """setuptools' manifest_maker, evaluating the template with a CompiledManifest"""
+    def read_template(self):
+        log.info("reading manifest template '%s'", self.template)
+        compiled, line_numbers = CompiledManifest.from_file(self.template)
+        for index, msg in compiled.errors:
+            self.warn("%s, line %d: %s" % (self.template, line_numbers[index], msg))
+        compiled.apply_to(self.filelist)
+
+
+def resolve_manifest(distribution, template, template_text=None):
+    """
+    :param template_text: the content to evaluate the template with, if it's not the one it has on disk
+    :return: (sorted files an sdist of the distribution would include, seconds it took to resolve them), without
+             writing anything into the library tree
+    """
+    egg_info = distribution.get_command_obj('egg_info')
+    egg_info_finalized = egg_info.finalized
+    manifest_dir = tempfile.mkdtemp(prefix="quicklib-manifest-")
+    try:
+        maker = ManifestMaker(distribution)
+        maker.manifest = os.path.join(manifest_dir, "SOURCES.txt")
+        maker.template = template
+        if template_text is not None:
+            maker.template = os.path.join(manifest_dir, "MANIFEST.in")
+            with open(maker.template, "w") as f:
+                f.write(template_text)
+        start = time.perf_counter()
+        maker.run()
+        duration = time.perf_counter() - start
+    finally:
+        shutil.rmtree(manifest_dir, ignore_errors=True)
+        if not egg_info_finalized:
+            # egg_info takes the library's version when it's finalized, which may not be set yet
+            distribution.reinitialize_command('egg_info')
+    # the manifest itself isn't part of the library
+    files = set(path for path in maker.filelist.files if path != maker.manifest)
+    if maker.template != template and maker.template in files:
+        files.remove(maker.template)
+        files.add(template)
+    return sorted(files), duration
+
+
+class PreviewManifest(Command):
+    SHORTNAME = "preview_manifest"
+
+    description = "print the files an sdist would include and how long it took to resolve them, without building it"
+
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        template = self.get_finalized_command('sdist').template or "MANIFEST.in"
+        files, duration = resolve_manifest(self.distribution, template)
+        for path in files:
+            print(path)
+        print("note: the manifest selects %d files, resolved in %.1f ms" % (len(files), duration * 1000))
@@ -1,16 +1,82 @@
+import ast
+import json
 import os
 import re
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
 
 from setuptools import Command
 from distutils import log
-from pkg_resources import Requirement, parse_requirements
+try:
+    from packaging.requirements import Requirement
+    from packaging.specifiers import SpecifierSet
+    from packaging.utils import canonicalize_name
+    from packaging.version import InvalidVersion, Version
+except ImportError:
+    # installing an sdist in a build environment that has setuptools but not packaging - use setuptools' copy
+    from setuptools.extern.packaging.requirements import Requirement
+    from setuptools.extern.packaging.specifiers import SpecifierSet
+    from setuptools.extern.packaging.utils import canonicalize_name
+    from setuptools.extern.packaging.version import InvalidVersion, Version
 
 from .utils import is_packaging
+from .caching import user_cache_dir, PackageVersionsCache
 from .virtualfiles import put_file
 from .datafiles import PrepareManifestIn
 
 
+DYNAMIC_REQUIREMENTS_FILENAME = "quicklib_requirements.json"
+DYNAMIC_REQUIREMENTS_FORMAT = 1
+# written as python reprs by older quicklib versions
+LEGACY_INSTALL_REQUIRES_FILENAME = "dynamic_install_requires.txt"
+LEGACY_EXTRAS_REQUIRE_FILENAME = "dynamic_extras_require.txt"
+
+
+def dump_dynamic_requirements(install_requires, extras_require):
+    return json.dumps(dict(
+        format=DYNAMIC_REQUIREMENTS_FORMAT,
+        install_requires=[str(req) for req in install_requires or []],
+        extras_require={extra: [str(req) for req in reqs] for extra, reqs in (extras_require or {}).items()},
+    ), sort_keys=True)
+
+
+def _is_str_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def read_dynamic_requirements(filename=DYNAMIC_REQUIREMENTS_FILENAME):
+    """:return: (install_requires, extras_require) persisted by DynamicRequirementsCommand during packaging"""
+    if not os.path.exists(filename) and os.path.exists(LEGACY_INSTALL_REQUIRES_FILENAME):
+        return read_legacy_dynamic_requirements()
+    try:
+        with open(filename, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as exc:
+        raise Exception("failed reading persisted requirements from %s (%s)" % (filename, exc))
+    if not isinstance(data, dict) or data.get('format') != DYNAMIC_REQUIREMENTS_FORMAT:
+        raise Exception("persisted requirements in %s have an unsupported format (%r), expected %d" % (
+            filename, data.get('format') if isinstance(data, dict) else None, DYNAMIC_REQUIREMENTS_FORMAT))
+    install_requires = data.get('install_requires')
+    extras_require = data.get('extras_require')
+    if not _is_str_list(install_requires) or not isinstance(extras_require, dict) or \
+            not all(_is_str_list(reqs) for reqs in extras_require.values()):
+        raise Exception("persisted requirements in %s are malformed" % filename)
+    log.info("loaded pre-persisted dynamic requirements from %s" % filename)
+    return install_requires, extras_require
+
+
+def read_legacy_dynamic_requirements(filename_install_requires=LEGACY_INSTALL_REQUIRES_FILENAME,
+                                     filename_extras_require=LEGACY_EXTRAS_REQUIRE_FILENAME):
+    # python literals, so they can be read without evaluating code
+    install_requires = ast.literal_eval(open(filename_install_requires, "r").read())
+    extras_require = ast.literal_eval(open(filename_extras_require, "r").read())
+    log.info("loaded pre-persisted dynamic requirements from %s and %s" % (
+        filename_install_requires, filename_extras_require))
+    return list(install_requires), dict(extras_require)
+
+
 class DynamicRequirementsCommand(Command):
     SHORTNAME = "dynamic_requirements"
 
@@ -18,39 +84,32 @@ class DynamicRequirementsCommand(Command):
 
     user_options = [
         ("filename-install-requires=", None,
-         "where calculated 'install_requires' values are saved, and later loaded back"),
+         "deprecated and ignored: the requirements are always saved in %s" % DYNAMIC_REQUIREMENTS_FILENAME),
         ("filename-extras-require=", None,
-         "where calculated 'extras_require' values are saved, and later loaded back"),
+         "deprecated and ignored: the requirements are always saved in %s" % DYNAMIC_REQUIREMENTS_FILENAME),
     ]
 
     def initialize_options(self):
-        self.filename_install_requires = "dynamic_install_requires.txt"
-        self.filename_extras_require = "dynamic_extras_require.txt"
+        self.filename_install_requires = None
+        self.filename_extras_require = None
 
     def finalize_options(self):
-        pass
+        # installing an sdist reads the requirements before any command runs, so their file name can't be configured
+        for option in ("filename_install_requires", "filename_extras_require"):
+            if getattr(self, option) is not None:
+                log.warn("warning: %s --%s is deprecated and ignored, requirements are saved in %s" % (
+                    self.SHORTNAME, option.replace("_", "-"), DYNAMIC_REQUIREMENTS_FILENAME))
 
     def run_packaging(self):
         pmi = self.get_finalized_command(PrepareManifestIn.SHORTNAME)
-
-        pmi.rewriter.add_include(self.filename_install_requires)
-        dumped_install_requires = repr(self.distribution.install_requires)
-        log.info("persisting dynamic install_requires:\n%s" % dumped_install_requires)
-        put_file(self.filename_install_requires, dumped_install_requires)
-
-        pmi.rewriter.add_include(self.filename_extras_require)
-        dumped_extras_require = repr(self.distribution.extras_require)
-        log.info("persisting dynamic extras_require:\n%s" % dumped_extras_require)
-        put_file(self.filename_extras_require, dumped_extras_require)
+        pmi.rewriter.add_include(DYNAMIC_REQUIREMENTS_FILENAME)
+        dumped_requirements = dump_dynamic_requirements(self.distribution.install_requires,
+                                                        self.distribution.extras_require)
+        log.info("persisting dynamic requirements:\n%s" % dumped_requirements)
+        put_file(DYNAMIC_REQUIREMENTS_FILENAME, dumped_requirements)
 
     def run_deploying(self):
-        loaded_install_requires = open(self.filename_install_requires, "r").read()
-        log.info("loaded pre-persisted dynamic install_requires:\n%s" % loaded_install_requires)
-        self.distribution.install_requires = eval(loaded_install_requires)
-
-        loaded_extras_require = open(self.filename_extras_require, "r").read()
-        log.info("loaded pre-persisted dynamic extras_require:\n%s" % loaded_extras_require)
-        self.distribution.extras_require = eval(loaded_extras_require)
+        self.distribution.install_requires, self.distribution.extras_require = read_dynamic_requirements()
 
     def run(self):
         if is_packaging():
@@ -59,6 +118,75 @@ class DynamicRequirementsCommand(Command):
             self.run_deploying()
 
 
+def parse_version(version):
+    """:return: the parsed version, or None if it is not a valid (PEP 440) version"""
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return None
+
+
+def get_requirement_key(req):
+    return canonicalize_name(req.name)
+
+
+def parse_requirements(text):
+    """:return: the requirements of requirements.txt style text, skipping comments and joining continued lines"""
+    lines = iter(text.splitlines())
+    requirements = []
+    for line in lines:
+        line = line.strip()
+        while line.endswith("\\"):
+            line = line[:-1].strip() + " " + next(lines, "").strip()
+        if " #" in line:
+            line = line[:line.find(" #")]
+        if not line or line.startswith("#"):
+            continue
+        requirements.append(Requirement(line))
+    return requirements
+
+
+class ParsedVersionsCache:
+    """
+    parsed versions of each package's available versions, so that they are parsed once per package rather than
+    once per requirement line (and per specifier clause) matched against them.
+    """
+    def __init__(self):
+        self._cache = {}
+
+    def get(self, package_key, available_versions):
+        available_versions = tuple(available_versions)
+        cached = self._cache.get(package_key)
+        if cached is not None and cached[0] == available_versions:
+            return cached[1]
+        parsed_versions = tuple(parse_version(v) for v in available_versions)
+        self._cache[package_key] = (available_versions, parsed_versions)
+        return parsed_versions
+
+
+parsed_versions_cache = ParsedVersionsCache()
+
+
+def find_latest_matching_version(req, available_versions):
+    """
+    :param req: a parsed requirement
+    :param available_versions: version strings, ordered from oldest to latest
+    :return: the latest of the available versions matching the requirement, or None if there is no such version
+    """
+    parsed_versions = parsed_versions_cache.get(get_requirement_key(req), available_versions)
+    # walk from latest to oldest, stopping at the first match.
+    # prereleases are always allowed, and versions that can't be parsed never match.
+    for index in range(len(parsed_versions) - 1, -1, -1):
+        if parsed_versions[index] is not None and req.specifier.contains(parsed_versions[index], prereleases=True):
+            return available_versions[index]
+    return None
+
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_CACHE_TTL = 600
+DEFAULT_CACHE_MAX_ENTRIES = 5000
+
+
 class FreezeRequirementsCommand(Command):
     SHORTNAME = "freeze_requirements"
 
@@ -69,16 +197,55 @@ class FreezeRequirementsCommand(Command):
          "alternative pypi server (when using a plugin, arbitrary data can be passed, depending on the plugin)"),
         ("server-plugin=", None,
          "external plugin for accessing pypi server and recovering package data"),
+        ("max-workers=", None,
+         "maximal number of package lookups running concurrently (default: %d)" % DEFAULT_MAX_WORKERS),
+        ("cache-dir=", None,
+         "where fetched package versions are cached between builds (default: under the user cache directory)"),
+        ("cache-ttl=", None,
+         "seconds for which cached package versions are used (default: %d, 0 disables caching)" % DEFAULT_CACHE_TTL),
+        ("cache-max-entries=", None,
+         "maximal number of cached packages, least recently used are evicted (default: %d)" % DEFAULT_CACHE_MAX_ENTRIES),
+        ("refresh", None,
+         "ignore cached package versions and fetch all of them again"),
     ]
 
+    boolean_options = ['refresh']
+
     def initialize_options(self):
         self.pypi_server = None
         self.server_plugin = 'quicklib.requirements:StandardPypiServerPlugin'
+        self.max_workers = None
+        self.cache_dir = None
+        self.cache_ttl = None
+        self.cache_max_entries = None
+        self.refresh = False
 
     def finalize_options(self):
         # giving a string spec for the external plugin helps when it depends on a package available only when packaging
         if isinstance(self.server_plugin, str):
+            self.server_plugin_spec = self.server_plugin
             self.server_plugin = self._load_plugin_from_spec()
+        else:
+            self.server_plugin_spec = "%s:%s" % (
+                getattr(self.server_plugin, '__module__', None),
+                getattr(self.server_plugin, '__qualname__', type(self.server_plugin).__qualname__),
+            )
+        if self.max_workers is None:
+            self.max_workers = DEFAULT_MAX_WORKERS
+        self.max_workers = int(self.max_workers)
+        if self.max_workers < 1:
+            raise ValueError("max_workers must be a positive number, got %s" % self.max_workers)
+        if self.cache_dir is None:
+            self.cache_dir = user_cache_dir("package_versions")
+        self.cache_ttl = DEFAULT_CACHE_TTL if self.cache_ttl is None else float(self.cache_ttl)
+        self.cache_max_entries = (
+            DEFAULT_CACHE_MAX_ENTRIES if self.cache_max_entries is None else int(self.cache_max_entries)
+        )
+        # plugins that are cheap to query (or must never be cached) may opt out by setting CACHEABLE = False
+        if self.cache_ttl > 0 and getattr(self.server_plugin, 'CACHEABLE', True):
+            self.cache = PackageVersionsCache(self.cache_dir, self.cache_ttl, self.cache_max_entries)
+        else:
+            self.cache = None
 
     PLUGIN_IMPORT_SPEC = "^([0-9a-zA-Z_.]+)(?::([0-9a-zA-Z_]+)(\\(\\))?)?$"
 
@@ -101,42 +268,109 @@ class FreezeRequirementsCommand(Command):
         return plugin
 
     def run(self):
+        available_versions = self.fetch_available_versions(
+            list(self.distribution.install_requires) +
+            [item for req_list in self.distribution.extras_require.values() for item in req_list]
+        )
         frozen_requirements = [
-            self.get_frozen_package_spec(item)
+            self.get_frozen_package_spec(item, available_versions)
             for item in self.distribution.install_requires
         ]
         self.distribution.install_requires = frozen_requirements
         frozen_extras_require = {
             extra_cond: [
-                self.get_frozen_package_spec(item)
+                self.get_frozen_package_spec(item, available_versions)
                 for item in req_list
             ]
             for extra_cond, req_list in self.distribution.extras_require.items()
         }
         self.distribution.extras_require = frozen_extras_require
 
-    def get_frozen_package_spec(self, requirement_line):
-        req = Requirement.parse(requirement_line)
-        try:
-            available_versions = self.server_plugin.get_ordered_package_versions(req.name, self.pypi_server)
-        except Exception:
-            log.error("freeze requirements: failed fetching available versions for %s" % req.name)
-            raise
+    def fetch_available_versions(self, requirement_lines):
+        """
+        retrieve the ordered available versions of all packages named in the given requirement lines.
+        each package is looked up once, even when it appears in several lines (e.g. in more than one extra).
+        :return: dict of requirement key to list of available versions
+        """
+        package_names = {}
+        for requirement_line in requirement_lines:
+            req = Requirement(requirement_line)
+            package_names.setdefault(get_requirement_key(req), req.name)
+        if not package_names:
+            return {}
+        available_versions = {}
+        if self.cache is not None and not self.refresh:
+            for key, name in package_names.items():
+                cached_versions = self.cache.get(self.server_plugin_spec, self.pypi_server, canonicalize_name(name))
+                if cached_versions is not None:
+                    available_versions[key] = cached_versions
+            if available_versions:
+                log.info("freeze requirements: using cached versions of %d packages from %s" % (
+                    len(available_versions), self.cache.path))
+        to_fetch = {key: name for key, name in package_names.items() if key not in available_versions}
+        if to_fetch:
+            fetched_versions = self._fetch_from_plugin(to_fetch)
+            if self.cache is not None:
+                for key, name in to_fetch.items():
+                    self.cache.put(self.server_plugin_spec, self.pypi_server, canonicalize_name(name),
+                                   fetched_versions[key])
+                self.cache.evict()
+            available_versions.update(fetched_versions)
+        return available_versions
+
+    def _fetch_from_plugin(self, package_names):
+        # plugins may optionally answer for many packages in a single round trip
+        get_many = getattr(self.server_plugin, 'get_many_ordered_package_versions', None)
+        if get_many is not None:
+            log.info("freeze requirements: fetching available versions of %d packages in one batch" % len(package_names))
+            versions_by_name = get_many(list(package_names.values()), self.pypi_server)
+            missing = [name for name in package_names.values() if name not in versions_by_name]
+            if missing:
+                raise Exception("freeze requirements: plugin returned no data for packages %s" % (missing,))
+            return {key: versions_by_name[name] for key, name in package_names.items()}
+        log.info("freeze requirements: fetching available versions of %d packages (%d workers)" % (
+            len(package_names), min(self.max_workers, len(package_names))))
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(package_names))) as executor:
+            futures = {
+                key: executor.submit(self.server_plugin.get_ordered_package_versions, name, self.pypi_server)
+                for key, name in package_names.items()
+            }
+            available_versions = {}
+            for key, future in futures.items():
+                try:
+                    available_versions[key] = future.result()
+                except Exception:
+                    log.error("freeze requirements: failed fetching available versions for %s" % package_names[key])
+                    raise
+        return available_versions
+
+    def get_frozen_package_spec(self, requirement_line, available_versions=None):
+        req = Requirement(requirement_line)
+        if available_versions is None:
+            available_versions = self.fetch_available_versions([requirement_line])
+        available_versions = available_versions[get_requirement_key(req)]
         if not available_versions:
             raise Exception("no versions found for package %s" % req.name)
-        matching_versions = [v for v in available_versions if v in req]
-        if not matching_versions:
+        latest_version = find_latest_matching_version(req, available_versions)
+        if latest_version is None:
             raise Exception("no versions found for package %s matching %s" % (req.name, requirement_line))
-        latest_version = matching_versions[-1]
         self.set_req_version_specifier(req, latest_version)
         return str(req)
 
     @staticmethod
     def set_req_version_specifier(req, specific_version):
-        req.specifier = Requirement.parse("dummy==%s" % specific_version).specifier
+        req.specifier = SpecifierSet("==%s" % specific_version)
 
 
 class StandardPypiServerPlugin:
+    """
+    the default plugin, retrieving package versions from pypi (or a compatible server) one package at a time.
+
+    plugins must implement `get_ordered_package_versions(package_name, pypi_server)`, returning a list of available
+    version strings ordered from oldest to latest. they may also implement
+    `get_many_ordered_package_versions(package_names, pypi_server)`, returning a dict of package name to such a list,
+    in which case all packages are looked up using a single call.
+    """
     @staticmethod
     def get_ordered_package_versions(package_name, pypi_server=None):
         # imported here so that it's only needed in packaging time
@@ -148,6 +382,142 @@ class StandardPypiServerPlugin:
         return available_versions
 
 
+class LocalIndexServerPlugin:
+    """
+    an offline plugin, answering from a local directory given as the `pypi_server` value (a path or a file:// url).
+    the directory can be either a flat "wheelhouse" of distribution files, or a PEP 503 "simple" tree with a directory
+    per (normalized) project name, holding distribution files and/or an index.html linking to them.
+
+    the directory is indexed once per process and kept as a compact mapping of project name to ordered versions.
+    later lookups only stat the directories involved, re-indexing just the ones that were modified since.
+    """
+    # looking up a local index is cheaper than reading the on-disk cache
+    CACHEABLE = False
+
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+
+    @classmethod
+    def get_ordered_package_versions(cls, package_name, pypi_server=None):
+        return cls.get_index(pypi_server).get_versions(package_name)
+
+    @classmethod
+    def get_many_ordered_package_versions(cls, package_names, pypi_server=None):
+        index = cls.get_index(pypi_server)
+        return {package_name: index.get_versions(package_name) for package_name in package_names}
+
+    @classmethod
+    def get_index(cls, pypi_server):
+        if not pypi_server:
+            raise ValueError("LocalIndexServerPlugin requires the local index directory to be given as pypi_server")
+        path = pypi_server
+        if path.startswith("file:"):
+            path = unquote(urlparse(path).path)
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            raise ValueError("local index directory %s does not exist" % path)
+        with cls._indexes_lock:
+            if path not in cls._indexes:
+                cls._indexes[path] = _LocalIndex(path)
+            return cls._indexes[path]
+
+
+# ---- local index internals
+
+RE_HTML_HREF = re.compile(r"""href\s*=\s*["']([^"']+)["']""", re.IGNORECASE)
+SDIST_EXTENSIONS = (".tar.gz", ".tar.bz2", ".tar.xz", ".tgz", ".zip")
+
+
+def parse_distribution_filename(filename):
+    """:return: (project name, version) of a wheel/sdist/egg file name, or None if it is not one"""
+    if filename.endswith(".whl") or filename.endswith(".egg"):
+        parts = filename[:-4].split("-")
+        if len(parts) < 2:
+            return None
+        return parts[0], parts[1]
+    for ext in SDIST_EXTENSIONS:
+        if filename.endswith(ext):
+            m = re.match(r"^(.+?)-(\d[^-]*)$", filename[:-len(ext)])
+            return m.groups() if m else None
+    return None
+
+
+def sort_versions(versions):
+    parsed_versions = []
+    for version in set(versions):
+        parsed_version = parse_version(version)
+        if parsed_version is None:
+            log.warn("local index: ignoring unparsable version %r" % (version,))
+        else:
+            parsed_versions.append((parsed_version, version))
+    return tuple(version for (_, version) in sorted(parsed_versions))
+
+
+class _LocalIndex:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.root_mtime = None
+        # flat wheelhouse content: normalized project name -> ordered versions
+        self.flat_versions = {}
+        # simple tree layout: normalized project name -> project directory
+        self.project_dirs = {}
+        # normalized project name -> (project directory mtime, ordered versions)
+        self.project_versions = {}
+
+    def get_versions(self, package_name):
+        name = canonicalize_name(package_name)
+        with self.lock:
+            self._refresh_root()
+            versions = self.flat_versions.get(name, ())
+            if name in self.project_dirs:
+                versions = sort_versions(versions + self._get_project_versions(name))
+        return list(versions)
+
+    def _refresh_root(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.root_mtime:
+            return
+        log.info("local index: indexing %s" % self.path)
+        flat_versions = {}
+        project_dirs = {}
+        for entry in os.scandir(self.path):
+            if entry.is_dir():
+                project_dirs[canonicalize_name(entry.name)] = entry.path
+            elif entry.is_file():
+                parsed = parse_distribution_filename(entry.name)
+                if parsed is not None:
+                    flat_versions.setdefault(canonicalize_name(parsed[0]), []).append(parsed[1])
+        self.flat_versions = {name: sort_versions(versions) for name, versions in flat_versions.items()}
+        self.project_dirs = project_dirs
+        self.root_mtime = mtime
+
+    def _get_project_versions(self, name):
+        project_dir = self.project_dirs[name]
+        mtime = os.stat(project_dir).st_mtime_ns
+        cached = self.project_versions.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        filenames = []
+        for entry in os.scandir(project_dir):
+            if entry.name.lower() in ("index.html", "index.htm"):
+                with open(entry.path, "r", encoding="utf-8", errors="replace") as f:
+                    filenames.extend(
+                        unquote(href.split("#", 1)[0].rstrip("/").rsplit("/", 1)[-1])
+                        for href in RE_HTML_HREF.findall(f.read())
+                    )
+            elif entry.is_file():
+                filenames.append(entry.name)
+        versions = []
+        for filename in filenames:
+            parsed = parse_distribution_filename(filename)
+            if parsed is not None and canonicalize_name(parsed[0]) == name:
+                versions.append(parsed[1])
+        versions = sort_versions(versions)
+        self.project_versions[name] = (mtime, versions)
+        return versions
+
+
 class UseRequirementsTxtCommand(Command):
     SHORTNAME = "use_requirements_txt"
 
@@ -1,20 +1,30 @@
+import collections
+import copy
 import os
 import re
 import sys
+import textwrap
 
 import setuptools
+from distutils import dir_util, log
 from setuptools.command.sdist import sdist as setuptools_sdist
-from setuptools.command.egg_info import manifest_maker, egg_info as setuptools_egg_info
+from setuptools.command.egg_info import egg_info as setuptools_egg_info
 
+from . import buildcache, isolation, tracing
+from .archiving import MAX_ARCHIVE_WORKERS, link_or_copy, make_tarball, unlink_if_exists
 from .utils import is_packaging
+from .discovery import DiscoveryCache, DISCOVERY_CACHE_PATH
 from .versioning import read_module_version
 from .commands import CleanEggInfo, ExportMetadata
-from .versioning import VersionSetByGit
-from .incorporator import BundleIncorporatedZip
+from .versioning import VersionScope, VersionSetByGit
+from .incorporator import BundleIncorporatedZip, create_bootstrap_block
 from .scripting import CreateScriptHooks
 from .virtualfiles import UndoVirtualFiles, undo_virtual_files
 from .datafiles import PrepareManifestIn
-from .requirements import UseRequirementsTxtCommand, DynamicRequirementsCommand, FreezeRequirementsCommand
+from .manifest import ManifestMaker, PreviewManifest
+from .requirements import (
+    UseRequirementsTxtCommand, DynamicRequirementsCommand, FreezeRequirementsCommand, read_dynamic_requirements,
+)
 
 
 class SetupModifier:
@@ -24,7 +34,13 @@ class SetupModifier:
         self.freeze_requirements = False
         self.freeze_requirements_params = {}
         self.version_module_paths = []
+        self.version_calculator = None
+        self.version_scope = None
+        self.version_dirty_scope = None
         self.module_level_scripts = {}
+        self.trace_dir = None
+        self.isolated_build = None
+        self.build_cache = None
 
     def set_use_requirements_txt(self, flag_value):
         self.use_requirements_txt = flag_value
@@ -45,12 +61,56 @@ class SetupModifier:
             module_paths = [module_paths]
         self.version_module_paths = list(module_paths)
 
+    def set_version_calculator(self, calculator):
+        self.version_calculator = calculator
+
+    def set_version_scope(self, version_scope):
+        self.version_scope = version_scope
+
+    def set_version_dirty_scope(self, dirty_scope):
+        self.version_dirty_scope = dirty_scope
+
     def set_module_level_scripts(self, script_names_to_module_names):
         self.module_level_scripts = script_names_to_module_names
 
+    def set_trace_dir(self, trace_dir):
+        self.trace_dir = trace_dir
+
+    def set_isolated_build(self, flag_value):
+        self.isolated_build = flag_value
+
+    def set_build_cache(self, value):
+        self.build_cache = value
+
     def setup(self, **kwargs):
-        self._modify_setup_kwargs(kwargs)
-        return setuptools.setup(**kwargs)
+        build_cache = buildcache.get_build_cache(self.build_cache) if is_packaging() else None
+        if build_cache is not None:
+            # wrapped by tracing, if enabled, so restored artifacts are traced too
+            kwargs['distclass'] = buildcache.get_build_cache_distclass(kwargs.get('distclass'), build_cache)
+        trace_dir = tracing.get_trace_dir(self.trace_dir)
+        if trace_dir is None:
+            self._modify_setup_kwargs(kwargs)
+            return self._run_setup(kwargs)
+        tracer = tracing.start_tracing(trace_dir, kwargs.get('name'))
+        try:
+            span = tracer.begin("quicklib.setup:modify_setup_kwargs")
+            try:
+                self._modify_setup_kwargs(kwargs)
+            finally:
+                tracer.end(span)
+            kwargs['distclass'] = tracing.get_tracing_distclass(kwargs.get('distclass'))
+            return self._run_setup(kwargs)
+        finally:
+            tracing.stop_tracing()
+
+    def _run_setup(self, kwargs):
+        if not (is_packaging() and isolation.is_isolated_build_requested(self.isolated_build)):
+            return setuptools.setup(**kwargs)
+        dist_dir = os.path.abspath("dist")
+        with isolation.isolated_build():
+            for cmd in isolation.DIST_DIR_COMMANDS:
+                self.cmd_opt_setdefault(kwargs, cmd, 'dist_dir', dist_dir)
+            return setuptools.setup(**kwargs)
 
     def _modify_setup_kwargs(self, kwargs):
         script_file = sys.argv[0]
@@ -60,7 +120,7 @@ class SetupModifier:
                 self.cmd_opt_setdefault(kwargs, 'sdist', 'template', matching_manifest_template)
 
         if self.freeze_requirements:
-            for key in ("pypi_server", "server_plugin"):
+            for key in ("pypi_server", "server_plugin", "max_workers", "cache_dir", "cache_ttl", "cache_max_entries"):
                 if key in self.freeze_requirements_params:
                     self.cmd_opt_setdefault(kwargs, FreezeRequirementsCommand.SHORTNAME, key,
                                             self.freeze_requirements_params[key])
@@ -69,11 +129,27 @@ class SetupModifier:
             raise ValueError("when specifying version modules, you must not also specify hard-coded `version` in setup")
         if kwargs.get('version', None) is None and not self.version_module_paths:
             raise ValueError("you must either specify version modules or give a hard-coded `version` in setup")
+        if self.version_scope and not self.version_module_paths:
+            raise ValueError("a version_scope only applies to versions set by git, using version modules")
+        if self.version_dirty_scope and not self.version_module_paths:
+            raise ValueError("a version_dirty_scope only applies to versions set by git, using version modules")
         if self.version_module_paths:
             if is_packaging():
                 # ignored, replaced later by the SetVersion command
                 kwargs['version'] = "0.0.0"
                 self.cmd_opt_setdefault(kwargs, 'version_set_by_git', 'version_module_paths', self.version_module_paths)
+                if self.version_calculator is not None:
+                    self.cmd_opt_setdefault(kwargs, 'version_set_by_git', 'calculator', self.version_calculator)
+                if self.version_dirty_scope is not None:
+                    self.cmd_opt_setdefault(kwargs, 'version_set_by_git', 'dirty_scope', self.version_dirty_scope)
+                if self.version_scope:
+                    # validated right away, rather than when the version is set
+                    VersionScope.from_setup_value(self.version_scope)
+                    paths = self.version_scope.get('paths') or []
+                    self.cmd_opt_setdefault(kwargs, 'version_set_by_git', 'tag_prefix',
+                                            self.version_scope.get('tag_prefix', ""))
+                    self.cmd_opt_setdefault(kwargs, 'version_set_by_git', 'scope_paths',
+                                            [paths] if isinstance(paths, str) else list(paths))
             else:
                 kwargs['version'] = read_module_version(self.version_module_paths[0])
 
@@ -98,30 +174,18 @@ class SetupModifier:
             packages = []
             auto_discovered = False
             if 'top_packages' in kwargs:
-                top_packages = kwargs.pop('top_packages')
-                if any(not re.match("^[a-zA-Z0-9_]+$", i) for i in top_packages):
-                    raise ValueError("invalid top_packages %s - must be valid top_packages" % top_packages)
-                found_packages = setuptools.find_packages(include=[
-                    "%s*" % p for p in top_packages
-                ])
-                # globbing "include pkg*" could bring unwanted pkg_other, so we filter specifically
-                found_packages = [p for p in found_packages if p.split(".")[0] in top_packages]
-                packages.extend([p for p in found_packages if p not in packages])
-                # also find any packages under a top namespace that has one of the provided names
-                ns_packages = [p for p in setuptools.find_namespace_packages() if p.split(".")[0] in top_packages]
-                for ns_package in ns_packages:
-                    ns_path = os.path.join(*ns_package.split("."))
-                    for package in setuptools.find_packages(where=ns_path):
-                        full_package = ns_package + "." + package
-                        if full_package not in packages:
-                            packages.append(full_package)
+                found_packages, from_cache = self.discover_packages(kwargs.pop('top_packages'))
+                packages.extend(found_packages)
                 auto_discovered = True
             elif self.auto_find_packages:
-                found_packages = setuptools.find_packages()
-                packages.extend([p for p in found_packages if p not in packages])
+                found_packages, from_cache = self.discover_packages()
+                packages.extend(found_packages)
                 auto_discovered = True
             kwargs['packages'] = packages
-            if auto_discovered:
+            if auto_discovered and from_cache:
+                print("note: %d packages auto-discovered, unchanged since the last build (cached in %s)" % (
+                    len(packages), DISCOVERY_CACHE_PATH))
+            elif auto_discovered:
                 print("note: some packages auto-discovered, here are the final packages:")
                 for p in kwargs['packages']:
                     print("  - %s" % (p,))
@@ -165,10 +229,22 @@ class SetupModifier:
             script_args += orig_script_args
             script_args += [UndoVirtualFiles.SHORTNAME]
         else:
-            script_args += [DynamicRequirementsCommand.SHORTNAME]
+            # installing from an sdist: the requirements persisted while packaging are read right away, so egg_info
+            # and install see them without running any quicklib command
+            kwargs['install_requires'], kwargs['extras_require'] = read_dynamic_requirements()
             script_args += orig_script_args
         kwargs['script_args'] = script_args
 
+    @classmethod
+    def discover_packages(cls, top_packages=None):
+        """:return: (sorted package names, whether they came from the discovery cache)"""
+        if isinstance(top_packages, str):
+            top_packages = [top_packages]
+        if top_packages is not None and any(not re.match("^[a-zA-Z0-9_]+$", i) for i in top_packages):
+            raise ValueError("invalid top_packages %s - must be valid top_packages" % top_packages)
+        # a single pass finding regular packages, also under namespace directories of the top packages
+        return DiscoveryCache(DISCOVERY_CACHE_PATH).discover(top_packages)
+
     @classmethod
     def get_quicklib_commands(cls):
         return {
@@ -176,7 +252,7 @@ class SetupModifier:
             for cmd_class in [
                 CleanEggInfo, ExportMetadata, VersionSetByGit, BundleIncorporatedZip, CreateScriptHooks,
                 UndoVirtualFiles, PrepareManifestIn, UseRequirementsTxtCommand, FreezeRequirementsCommand,
-                DynamicRequirementsCommand,
+                DynamicRequirementsCommand, PreviewManifest,
                 # --
                 SdistReplacement, EggInfoReplacement,
             ]
@@ -187,6 +263,32 @@ class SetupModifier:
         return kwargs.setdefault('command_options', {}).setdefault(cmd, {}).setdefault(opt, ('setup.py', default))[1]
 
 
+def create_setup_modifier(kwargs):
+    """:return: a SetupModifier set up by the quicklib-specific setup kwargs, which are removed from kwargs"""
+    sm = SetupModifier()
+    if 'use_requirements_txt' in kwargs:
+        sm.set_use_requirements_txt(kwargs.pop('use_requirements_txt'))
+    if 'freeze_requirements' in kwargs:
+        sm.set_freeze_requirements(kwargs.pop('freeze_requirements'))
+    if 'version_module_paths' in kwargs:
+        sm.set_version_modules(kwargs.pop('version_module_paths'))
+    if 'version_calculator' in kwargs:
+        sm.set_version_calculator(kwargs.pop('version_calculator'))
+    if 'version_scope' in kwargs:
+        sm.set_version_scope(kwargs.pop('version_scope'))
+    if 'version_dirty_scope' in kwargs:
+        sm.set_version_dirty_scope(kwargs.pop('version_dirty_scope'))
+    if 'module_level_scripts' in kwargs:
+        sm.set_module_level_scripts(kwargs.pop('module_level_scripts'))
+    if 'trace_dir' in kwargs:
+        sm.set_trace_dir(kwargs.pop('trace_dir'))
+    if 'isolated_build' in kwargs:
+        sm.set_isolated_build(kwargs.pop('isolated_build'))
+    if 'build_cache' in kwargs:
+        sm.set_build_cache(kwargs.pop('build_cache'))
+    return sm
+
+
 # TODO: can this be replaced by a Distribution subclass? some of it?
 def setup(**kwargs):
     """
@@ -197,15 +299,7 @@ def setup(**kwargs):
         packages - if not given, find_packages() is applied automatically
     :return:
     """
-    sm = SetupModifier()
-    if 'use_requirements_txt' in kwargs:
-        sm.set_use_requirements_txt(kwargs.pop('use_requirements_txt'))
-    if 'freeze_requirements' in kwargs:
-        sm.set_freeze_requirements(kwargs.pop('freeze_requirements'))
-    if 'version_module_paths' in kwargs:
-        sm.set_version_modules(kwargs.pop('version_module_paths'))
-    if 'module_level_scripts' in kwargs:
-        sm.set_module_level_scripts(kwargs.pop('module_level_scripts'))
+    sm = create_setup_modifier(kwargs)
     try:
         return sm.setup(**kwargs)
     except Exception as exc1:
@@ -218,20 +312,143 @@ def setup(**kwargs):
         raise
 
 
+def create_setup_script_code(ql_setup_kwargs):
+    """:return: code of a setup.py calling quicklib.setup with the given kwargs (e.g. those of a setup YAML file)"""
+    return textwrap.dedent("""\
+        %(bootstrap_block)s
+
+        ql_setup_kwargs = %(ql_setup_kwargs)r
+
+        quicklib.setup(
+            **ql_setup_kwargs
+        )
+    """) % dict(
+        bootstrap_block=create_bootstrap_block(),
+        ql_setup_kwargs=ql_setup_kwargs,
+    )
+
+
+def setup_from_yml(ql_setup_kwargs, script_args):
+    """
+    run quicklib.setup in-process with the kwargs of a setup YAML file, just like a setup.py in the current directory
+    calling it would. sdists get such a setup.py, written directly into them.
+    """
+    kwargs = copy.deepcopy(ql_setup_kwargs)
+    kwargs['script_args'] = list(script_args)
+    SetupModifier.cmd_opt_setdefault(kwargs, SdistReplacement.SHORTNAME, 'setup_script_code',
+                                     create_setup_script_code(ql_setup_kwargs))
+    # mkpath remembers the directories it created, and doesn't create them again if an earlier build in this process
+    # removed them (e.g. bdist_wheel's build directory)
+    path_created = getattr(dir_util, '_path_created', None)
+    if path_created is not None:
+        path_created.clear()
+    # quicklib.setup and its commands look at sys.argv[0] for the script location (requirements.txt, ...)
+    orig_argv = sys.argv
+    sys.argv = ["setup.py"] + list(script_args)
+    try:
+        return setup(**kwargs)
+    finally:
+        sys.argv = orig_argv
+
+
+def build(yml_path="quicklib_setup.yml", commands=("sdist",)):
+    """
+    build the library described by a setup YAML file in-process, from the current directory - the same as running
+    `quicklib-setup -s yml_path commands...`, but without starting a process, so tools can call it repeatedly.
+    :param commands: setup.py command line, e.g. ["sdist", "bdist_wheel"]
+    :return: the setuptools Distribution
+    """
+    from .cli.setupyml import SetupYml
+    try:
+        return setup_from_yml(SetupYml.load_from_file(yml_path).setup, commands)
+    except SystemExit as exc:
+        # setuptools reports failed commands by exiting, which must not end the calling process
+        if exc.code in (None, 0):
+            return None
+        undo_virtual_files()
+        raise Exception("building %s failed: %s" % (yml_path, exc.code))
+
+
 class SdistReplacement(setuptools_sdist):
     SHORTNAME = "sdist"
 
+    user_options = setuptools_sdist.user_options + [
+        ("setup-script-code=", None,
+         "code of the setup.py to put into the sdist, instead of copying the setup script"),
+        ("archive-workers=", None,
+         "number of threads compressing gztar archives (default: number of CPUs, up to %d)" % MAX_ARCHIVE_WORKERS),
+    ]
+
+    def initialize_options(self):
+        setuptools_sdist.initialize_options(self)
+        self.setup_script_code = None
+        self.archive_workers = None
+        self.linked_paths = []
+
+    def finalize_options(self):
+        setuptools_sdist.finalize_options(self)
+        if self.archive_workers is not None:
+            self.archive_workers = int(self.archive_workers)
+
+    def make_distribution(self):
+        # setuptools hides os.link while making the distribution, release tree files are linked here with fallbacks
+        return super(setuptools_sdist, self).make_distribution()
+
     def make_release_tree(self, base_dir, files):
+        """like setuptools' make_release_tree, linking the files into base_dir rather than copying them"""
         self.mkpath(base_dir)
+        release_files = []
+        self.linked_paths = []
+        if self.setup_script_code is not None:
+            files = [f for f in files if f.lower() != "setup.py"]
+            setup_script_path = os.path.join(base_dir, "setup.py")
+            unlink_if_exists(setup_script_path)
+            log.info("writing %s" % setup_script_path)
+            open(setup_script_path, "w").write(self.setup_script_code)
         # alternative script locations are made possible
         script_file = sys.argv[0]
         if script_file.lower() != "setup.py":
             files = [f for f in files if f.lower() != "setup.py"]
-            self.copy_file(script_file, os.path.join(base_dir, "setup.py"))
+            release_files.append((script_file, "setup.py"))
         if self.template is not None and self.template.lower() != "manifest.in":
             files = [f for f in files if f.lower() != "manifest.in"]
-            self.copy_file(self.template, os.path.join(base_dir, "MANIFEST.in"))
-        return setuptools_sdist.make_release_tree(self, base_dir, files)
+            release_files.append((self.template, "MANIFEST.in"))
+        if not files:
+            log.warn("no files to distribute -- empty manifest?")
+        for f in files:
+            if not os.path.isfile(f):
+                log.warn("'%s' not a regular file -- skipping", f)
+            else:
+                release_files.append((f, f))
+
+        dir_util.create_tree(base_dir, [target for _, target in release_files], dry_run=self.dry_run)
+        if not self.dry_run:
+            methods = collections.Counter()
+            for source, target in release_files:
+                target_path = os.path.join(base_dir, target)
+                unlink_if_exists(target_path)
+                methods[link_or_copy(source, target_path)] += 1
+                self.linked_paths.append(target_path)
+            log.info("linked %d files into %s (%d hard links, %d reflinks, %d copies)" % (
+                len(release_files), base_dir, methods['hardlink'], methods['reflink'], methods['copy']))
+
+        # files written into the release tree must not be links to the library's files
+        pkg_info_path = os.path.join(base_dir, "PKG-INFO")
+        setup_cfg_path = os.path.join(base_dir, "setup.cfg")
+        self.linked_paths = [path for path in self.linked_paths if path not in (pkg_info_path, setup_cfg_path)]
+        unlink_if_exists(pkg_info_path)
+        self.distribution.metadata.write_pkg_info(base_dir)
+        # save any egg_info command line options used to create this sdist
+        if os.path.exists(setup_cfg_path):
+            os.remove(setup_cfg_path)
+            self.copy_file("setup.cfg", setup_cfg_path)
+        self.get_finalized_command('egg_info').save_version_info(setup_cfg_path)
+
+    def make_archive(self, base_name, format, root_dir=None, base_dir=None, owner=None, group=None):
+        if format != "gztar" or root_dir is not None:
+            return setuptools_sdist.make_archive(self, base_name, format, root_dir, base_dir, owner, group)
+        return make_tarball(base_name, base_dir, owner=owner, group=group, workers=self.archive_workers,
+                            dry_run=self.dry_run, linked_paths=self.linked_paths)
 
 
 class EggInfoReplacement(setuptools_egg_info):
@@ -240,7 +457,8 @@ class EggInfoReplacement(setuptools_egg_info):
     def find_sources(self):
         """Generate SOURCES.txt manifest file"""
         manifest_filename = os.path.join(self.egg_info, "SOURCES.txt")
-        mm = manifest_maker(self.distribution)
+        # the manifest template is evaluated in one pass (see quicklib.manifest)
+        mm = ManifestMaker(self.distribution)
         mm.manifest = manifest_filename
         # this line is our modification - the rest remains unchanged
         mm.template = self.get_finalized_command('sdist').template
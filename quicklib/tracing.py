@@ -0,0 +1,228 @@
+"""Opt-in timing instrumentation of the setuptools commands run by quicklib.setup.
+
+Enabled by setting the QUICKLIB_TRACE_DIR environment variable or the `trace_dir` setup kwarg. Every command run
+records its wall time, CPU time (including child processes, e.g. git), peak RSS and the files it opened for reading
+or writing. Each build writes two files to the trace directory: a JSON summary and a Chrome trace-event file
+(load it in chrome://tracing or https://ui.perfetto.dev).
+
+Files are tracked with an audit hook, so only from python 3.8 - before that, their lists are empty.
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+from setuptools.dist import Distribution
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+TRACE_DIR_ENV = "QUICKLIB_TRACE_DIR"
+TRACE_FORMAT_VERSION = 1
+
+_WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_APPEND | os.O_TRUNC
+
+# the tracer of the build running in this process (if any), used by TracingDistribution and the audit hook
+active_tracer = None
+_audit_hook_installed = False
+
+
+def _peak_rss_bytes():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere but on macOS
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def _cpu_seconds():
+    cpu_seconds = time.process_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_seconds += children.ru_utime + children.ru_stime
+    return cpu_seconds
+
+
+class CommandSpan:
+    def __init__(self, name, depth, start, cpu_start):
+        self.name = name
+        self.depth = depth
+        self.start = start
+        self.cpu_start = cpu_start
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_bytes = None
+        self.files_read = set()
+        self.files_written = set()
+        self.failed = False
+
+    def to_dict(self, origin):
+        return dict(
+            command=self.name,
+            depth=self.depth,
+            start_seconds=round(self.start - origin, 6),
+            wall_seconds=round(self.wall_seconds, 6),
+            cpu_seconds=round(self.cpu_seconds, 6),
+            peak_rss_bytes=self.peak_rss_bytes,
+            failed=self.failed,
+            files_read=sorted(self.files_read),
+            files_written=sorted(self.files_written),
+        )
+
+
+class CommandTracer:
+    def __init__(self, trace_dir, library_name=None):
+        self.trace_dir = trace_dir
+        self.library_name = library_name
+        self.origin = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self._stack = []
+        self._thread_id = threading.get_ident()
+
+    def begin(self, name):
+        span = CommandSpan(name, len(self._stack), time.perf_counter(), _cpu_seconds())
+        self.spans.append(span)
+        self._stack.append(span)
+        return span
+
+    def end(self, span, failed=False):
+        span.wall_seconds = time.perf_counter() - span.start
+        span.cpu_seconds = _cpu_seconds() - span.cpu_start
+        span.peak_rss_bytes = _peak_rss_bytes()
+        span.failed = failed
+        self._stack.remove(span)
+
+    def record_open(self, path, mode, flags):
+        # only opens made by the commands themselves, not by threads they may have left behind
+        if not self._stack or threading.get_ident() != self._thread_id:
+            return
+        if isinstance(path, int):
+            return
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        path = os.path.abspath(path)
+        cwd = os.getcwd()
+        if path.startswith(cwd + os.sep):
+            path = os.path.relpath(path, cwd)
+        if mode is not None:
+            is_write = any(c in mode for c in "wax+")
+        else:
+            is_write = bool(flags & _WRITE_FLAGS)
+        span = self._stack[-1]
+        (span.files_written if is_write else span.files_read).add(path)
+
+    def get_summary(self):
+        return dict(
+            format=TRACE_FORMAT_VERSION,
+            library=self.library_name,
+            argv=sys.argv,
+            cwd=os.getcwd(),
+            pid=os.getpid(),
+            python=sys.version.split()[0],
+            platform=sys.platform,
+            started_at=self.started_at,
+            wall_seconds=round(time.perf_counter() - self.origin, 6),
+            commands=[span.to_dict(self.origin) for span in self.spans if span.wall_seconds is not None],
+        )
+
+    def get_trace_events(self):
+        pid = os.getpid()
+        events = [dict(name="process_name", ph="M", pid=pid, tid=0,
+                       args=dict(name="quicklib %s" % (self.library_name or "build")))]
+        for span in self.spans:
+            if span.wall_seconds is None:
+                continue
+            events.append(dict(
+                name=span.name,
+                cat="command",
+                ph="X",
+                pid=pid,
+                tid=0,
+                ts=round((span.start - self.origin) * 1e6),
+                dur=round(span.wall_seconds * 1e6),
+                args=dict(
+                    cpu_ms=round(span.cpu_seconds * 1000, 3),
+                    peak_rss_bytes=span.peak_rss_bytes,
+                    files_read=len(span.files_read),
+                    files_written=len(span.files_written),
+                    failed=span.failed,
+                ),
+            ))
+        return events
+
+    def write(self):
+        """:return: paths of the written summary and trace-event files"""
+        os.makedirs(self.trace_dir, exist_ok=True)
+        base_name = "quicklib-%s-%s-%d" % (
+            self.library_name or "build", time.strftime("%Y%m%dT%H%M%S", time.localtime(self.started_at)),
+            os.getpid())
+        summary_path = os.path.join(self.trace_dir, base_name + ".json")
+        trace_path = os.path.join(self.trace_dir, base_name + ".trace.json")
+        with open(summary_path, "w") as f:
+            json.dump(self.get_summary(), f, indent=2)
+        with open(trace_path, "w") as f:
+            json.dump(dict(traceEvents=self.get_trace_events(), displayTimeUnit="ms"), f)
+        return summary_path, trace_path
+
+
+def _audit_hook(event, args):
+    if event == "open" and active_tracer is not None:
+        active_tracer.record_open(*args)
+
+
+def start_tracing(trace_dir, library_name=None):
+    global active_tracer, _audit_hook_installed
+    active_tracer = CommandTracer(trace_dir, library_name)
+    if not _audit_hook_installed and hasattr(sys, 'addaudithook'):
+        # audit hooks can't be removed, this one does nothing while no tracer is active
+        sys.addaudithook(_audit_hook)
+        _audit_hook_installed = True
+    return active_tracer
+
+
+def stop_tracing():
+    """stop tracing and write the trace files"""
+    global active_tracer
+    tracer, active_tracer = active_tracer, None
+    if tracer is None:
+        return
+    summary_path, trace_path = tracer.write()
+    print("quicklib trace written to %s (chrome trace events: %s)" % (summary_path, trace_path))
+
+
+def get_trace_dir(trace_dir=None):
+    return trace_dir or os.environ.get(TRACE_DIR_ENV) or None
+
+
+class TracingDistributionMixin:
+    """records every command run (including sub-commands) with the active tracer"""
+    def run_command(self, command):
+        tracer = active_tracer
+        if tracer is None or self.have_run.get(command):
+            return super().run_command(command)
+        span = tracer.begin(command)
+        failed = True
+        try:
+            result = super().run_command(command)
+            failed = False
+            return result
+        finally:
+            tracer.end(span, failed=failed)
+
+
+class TracingDistribution(TracingDistributionMixin, Distribution):
+    pass
+
+
+def get_tracing_distclass(distclass=None):
+    """:return: a tracing version of the given Distribution class (or of the default one)"""
+    if distclass is None:
+        return TracingDistribution
+    if issubclass(distclass, TracingDistributionMixin):
+        return distclass
+    return type("Tracing" + distclass.__name__, (TracingDistributionMixin, distclass), {})
@@ -1,3 +1,4 @@
+import json
 import os
 import re
 import subprocess
@@ -7,10 +8,21 @@ from setuptools import Command
 from distutils import log
 
 from quicklib.virtualfiles import put_file
-from .virtualfiles import modify_file
+from .virtualfiles import get_source_path, modify_file
 
 DEV_VERSION = "0.0.0.dev0"
 
+# version tags are annotated tags labeled `major.minor`
+VERSION_TAG_PATTERN = "[[:digit:]]*.[[:digit:]]*"
+
+# batch builds calculate the version once and hand it to every build through this environment variable
+PRECOMPUTED_VERSION_ENV = "QUICKLIB_PRECOMPUTED_VERSION"
+# ...and the versions of all the version scopes they know of, as a JSON object of {scope key: version}
+PRECOMPUTED_VERSIONS_ENV = "QUICKLIB_PRECOMPUTED_VERSIONS"
+
+# the git binary is given this many paths at a time to look for local modifications in
+DIRTY_PATHS_PER_GIT_RUN = 1000
+
 RE_VERSION_CODE_LINE = re.compile("^__version__ *= *.*$", re.MULTILINE)
 
 
@@ -43,6 +55,105 @@ def read_module_version(version_module_path):
     return version_load_vars['__version__']
 
 
+def get_work_tree_paths(paths, base_dir="."):
+    """
+    :return: the given paths (relative to base_dir) relative to the git work tree, '/'-separated ('' for its root).
+             in an isolated build, paths in the overlay stand for the checkout's files.
+    """
+    from .gitrepo import find_git_dir
+    work_tree = find_git_dir(get_source_path(base_dir))[1]
+    repo_paths = []
+    for path in paths:
+        repo_path = os.path.relpath(get_source_path(os.path.join(base_dir, path)), work_tree)
+        if repo_path == os.pardir or repo_path.startswith(os.pardir + os.sep):
+            raise ValueError("path %s is outside of the git work tree %s" % (path, work_tree))
+        repo_paths.append("" if repo_path == os.curdir else repo_path.replace(os.sep, "/"))
+    return repo_paths
+
+
+class VersionScope:
+    """
+    the part of the repository history a library's version is calculated from: only version tags named
+    `<tag_prefix><major>.<minor>` count, and if paths are given, only the commits that changed them since that tag.
+    paths are relative to the git work tree, '/'-separated.
+    """
+    def __init__(self, tag_prefix="", paths=()):
+        self.tag_prefix = tag_prefix or ""
+        self.paths = tuple(sorted(set(paths)))
+
+    @classmethod
+    def from_setup_value(cls, value, base_dir="."):
+        """:return: the scope described by a `version_scope` setup value - a dict with tag_prefix and paths (relative
+                    to base_dir), or None for the whole repository"""
+        if not value:
+            return cls()
+        unknown_keys = set(value) - {'tag_prefix', 'paths'}
+        if unknown_keys:
+            raise ValueError("unknown version_scope keys %s, expected tag_prefix and/or paths" % sorted(unknown_keys))
+        return cls.from_paths(value.get('tag_prefix', ""), value.get('paths', ()), base_dir)
+
+    @classmethod
+    def from_paths(cls, tag_prefix, paths, base_dir="."):
+        """:return: a scope of paths relative to base_dir"""
+        if isinstance(paths, str):
+            paths = [paths]
+        if not paths:
+            return cls(tag_prefix)
+        return cls(tag_prefix, get_work_tree_paths(paths, base_dir))
+
+    @property
+    def is_default(self):
+        return not self.tag_prefix and not self.paths
+
+    @property
+    def match_pattern(self):
+        return self.tag_prefix + VERSION_TAG_PATTERN
+
+    @property
+    def key(self):
+        return json.dumps([self.tag_prefix, list(self.paths)])
+
+    def __eq__(self, other):
+        return isinstance(other, VersionScope) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "VersionScope(%r, %r)" % (self.tag_prefix, self.paths)
+
+
+def get_precomputed_version(scope):
+    """:return: the version of the scope handed down by a batch build (or watch mode), None if there isn't one"""
+    versions = os.environ.get(PRECOMPUTED_VERSIONS_ENV)
+    if versions:
+        version = json.loads(versions).get(scope.key)
+        if version is not None:
+            return version
+    if scope.is_default:
+        return os.environ.get(PRECOMPUTED_VERSION_ENV) or None
+    return None
+
+
+def calculate_version(calculator, scope, dirty_paths=None):
+    # calculators that don't know of scopes (or of dirty paths) only need to implement getVersion
+    dirty_args = () if dirty_paths is None else (dirty_paths,)
+    if scope.is_default:
+        return calculator.getVersion(*dirty_args)
+    return calculator.getVersions([scope], *dirty_args)[0]
+
+
+def calculate_versions(scopes, calculator=None):
+    """
+    calculate the versions of many libraries in the git work tree of the current directory, walking its history once
+    :param scopes: VersionScope objects, or `version_scope` setup values (None for the whole repository)
+    :param calculator: by default the one reading the repository directly (falling back to git when it can't)
+    :return: list of versions, in scope order
+    """
+    scopes = [scope if isinstance(scope, VersionScope) else VersionScope.from_setup_value(scope) for scope in scopes]
+    return (calculator or PureGitVersionCalculator()).getVersions(scopes)
+
+
 class VersionSetCommandBase(Command):
     user_options = [
         ("version-module-paths=", None,
@@ -63,9 +174,28 @@ class VersionSetCommandBase(Command):
         if not self.version_module_paths:
             log.warn("warning: no version_module_paths provided, SetVersion command will have no effect")
 
+    def get_version_scope(self):
+        return VersionScope()
+
+    def get_dirty_paths(self):
+        """:return: work tree paths of the only files whose local modifications make the version dirty, None for all"""
+        return None
+
     def run(self):
         # we generate the version of the package, update it in all needed places, and write back to user if asked nicely
-        self.version = self.VERSION_CALCULATOR.getVersion()
+        scope = self.get_version_scope()
+        precomputed_version = get_precomputed_version(scope)
+        if precomputed_version is not None:
+            self.version = precomputed_version
+            log.info("using precomputed version %s" % self.version)
+            if self.version.endswith(".dirty"):
+                dirty_paths = self.get_dirty_paths()
+                if dirty_paths is not None and not self.VERSION_CALCULATOR.isDirty(dirty_paths):
+                    # precomputed for the whole work tree, but the library's own files aren't modified
+                    self.version = self.version[:-len(".dirty")]
+                    log.info("the library's files are unmodified, using version %s" % self.version)
+        else:
+            self.version = calculate_version(self.VERSION_CALCULATOR, scope, self.get_dirty_paths())
         self._updateVersion()
 
     def _updateVersion(self):
@@ -81,32 +211,98 @@ class VersionSetCommandBase(Command):
         """
         create or modify (virtually) the module at the given path to have a `__version__ = [version]` code line.
         """
-        if not isinstance(module_path, str):
-            raise TypeError("expected string module path, got %r" % (module_path,))
-        if not os.path.splitext(module_path)[1].lower() == ".py":
-            raise ValueError("expected module path of a python source (.py) file, got %s" % (module_path,))
+        versioned_code = get_versioned_module_code(module_path, version)
         if os.path.exists(module_path):
-            version_module_code = open(module_path, "r").read()
-            if not re.search(RE_VERSION_CODE_LINE, version_module_code):
-                raise Exception("no version line (matching %s) found in %s, unable to replace module version" % (
-                    RE_VERSION_CODE_LINE, module_path,
-                ))
-            # set any version line to the given specific string version (virtual - for package only)
-            modified_code = re.sub(RE_VERSION_CODE_LINE, "__version__ = '%s'" % version, version_module_code)
-            modify_file(module_path, modified_code, binary=False)
+            modify_file(module_path, versioned_code, binary=False)
         else:
-            put_file(module_path, create_version_block(repr(version)))
+            put_file(module_path, versioned_code)
+
+
+def get_versioned_module_code(module_path, version):
+    """:return: the code of the module at the given path with its `__version__` line set, or of a new version module"""
+    if not isinstance(module_path, str):
+        raise TypeError("expected string module path, got %r" % (module_path,))
+    if not os.path.splitext(module_path)[1].lower() == ".py":
+        raise ValueError("expected module path of a python source (.py) file, got %s" % (module_path,))
+    if not os.path.exists(module_path):
+        return create_version_block(repr(version))
+    version_module_code = open(module_path, "r").read()
+    if not re.search(RE_VERSION_CODE_LINE, version_module_code):
+        raise Exception("no version line (matching %s) found in %s, unable to replace module version" % (
+            RE_VERSION_CODE_LINE, module_path,
+        ))
+    # set any version line to the given specific string version
+    return re.sub(RE_VERSION_CODE_LINE, "__version__ = '%s'" % version, version_module_code)
 
 
 class GitVersionCalculator:
-    """determine library version based on git tags and git-describe"""
-    def getVersion(self):
-        git_describe = subprocess.check_output('git describe --match "[[:digit:]]*.[[:digit:]]*" --dirty=_dirty',
+    """
+    determine library version based on git tags and git-describe.
+    dirty_paths, where given, are '/'-separated work tree paths of the only files whose local modifications make the
+    version dirty (by default any tracked file's do).
+    """
+    def getVersion(self, dirty_paths=None):
+        if dirty_paths is not None:
+            return GitVersionCalculator.getVersions(self, [VersionScope()], dirty_paths)[0]
+        git_describe = subprocess.check_output('git describe --match "%s" --dirty=_dirty' % VERSION_TAG_PATTERN,
                                                shell=True, encoding='ascii')
         return self.describe_to_version(git_describe)
 
+    def getVersions(self, scopes, dirty_paths=None):
+        """:return: the versions of the given VersionScopes, running git for each of them"""
+        versions = [GitVersionCalculator._get_scoped_version(self, scope, dirty_paths is None) for scope in scopes]
+        if dirty_paths is not None and GitVersionCalculator.isDirty(self, dirty_paths):
+            versions = [version + ".dirty" for version in versions]
+        return versions
+
+    def isDirty(self, paths=None):
+        """
+        whether any of the given work tree files differ from HEAD, like `git diff --quiet HEAD -- <paths>` - without
+        paths, whether any tracked file does
+        """
+        if paths is None:
+            path_groups = [[]]
+        else:
+            paths = sorted(paths)
+            if not paths:
+                return False
+            # a few at a time, command lines have a length limit
+            path_groups = [paths[start:start + DIRTY_PATHS_PER_GIT_RUN]
+                           for start in range(0, len(paths), DIRTY_PATHS_PER_GIT_RUN)]
+        top_dir = subprocess.check_output(["git", "rev-parse", "--show-toplevel"], encoding='utf-8').strip()
+        for path_group in path_groups:
+            returncode = subprocess.call(
+                ["git", "--literal-pathspecs", "diff", "--quiet", "--no-ext-diff", "HEAD", "--"] + path_group,
+                cwd=top_dir)
+            if returncode == 1:
+                return True
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, "git diff --quiet HEAD")
+        return False
+
+    def _get_scoped_version(self, scope, dirty=True):
+        git_describe = subprocess.check_output(
+            ["git", "describe", "--match", scope.match_pattern] + (["--dirty=_dirty"] if dirty else []),
+            encoding='ascii').strip()
+        if scope.paths:
+            described, dirty_mark, _ = git_describe.partition("_dirty")
+            if "-g" in described:
+                tag_name, _, commit = described.rsplit("-", 2)
+                top_dir = subprocess.check_output(["git", "rev-parse", "--show-toplevel"], encoding='utf-8').strip()
+                depth = int(subprocess.check_output(
+                    ["git", "rev-list", "--count", "%s..HEAD" % tag_name, "--"] + [path or "." for path in scope.paths],
+                    cwd=top_dir, encoding='ascii'))
+                described = "%s-%d-%s" % (tag_name, depth, commit) if depth else tag_name
+            git_describe = described + dirty_mark
+        return self.describe_to_version(git_describe, scope.tag_prefix)
+
     @classmethod
-    def describe_to_version(cls, git_describe):
+    def describe_to_version(cls, git_describe, tag_prefix=""):
+        if tag_prefix:
+            if not git_describe.startswith(tag_prefix):
+                raise Exception("Expected a tag starting with %r in the 'git describe' output: %r" % (
+                    tag_prefix, git_describe))
+            git_describe = git_describe[len(tag_prefix):]
         if "-g" in git_describe:
             # we are a few commits past the latest version tag
             m = re.match("^(\\d+)\\.(\\d+)-(\\d+)-g([0-9a-f]+)(_dirty)?$", git_describe)
@@ -126,10 +322,104 @@ class GitVersionCalculator:
         return version
 
 
+class PureGitVersionCalculator(GitVersionCalculator):
+    """
+    same as GitVersionCalculator, but reads the repository directly instead of running git.
+    describe results are cached by HEAD commit and version tags, so repeated builds of a checkout only need to look
+    for local modifications. repositories using git features that can't be read directly fall back to running git.
+    """
+    def getVersion(self, dirty_paths=None):
+        from .gitrepo import GitRepository, UnsupportedRepository
+        try:
+            repo = GitRepository.discover(os.getcwd())
+            git_describe = repo.describe(VERSION_TAG_PATTERN, dirty_suffix="_dirty", dirty_paths=dirty_paths)
+        except UnsupportedRepository as exc:
+            log.info("reading git repository directly is not supported here (%s), running git instead" % exc)
+            return GitVersionCalculator.getVersion(self, dirty_paths)
+        return self.describe_to_version(git_describe)
+
+    def getVersions(self, scopes, dirty_paths=None):
+        """:return: the versions of the given VersionScopes, from a single read of the repository's history"""
+        from .gitrepo import GitRepository, UnsupportedRepository
+        try:
+            repo = GitRepository.discover(os.getcwd())
+            descriptions = repo.describe_many([(scope.match_pattern, scope.paths) for scope in scopes],
+                                              dirty_suffix="_dirty", dirty_paths=dirty_paths)
+        except UnsupportedRepository as exc:
+            log.info("reading git repository directly is not supported here (%s), running git instead" % exc)
+            return GitVersionCalculator.getVersions(self, scopes, dirty_paths)
+        return [self.describe_to_version(description, scope.tag_prefix)
+                for description, scope in zip(descriptions, scopes)]
+
+    def isDirty(self, paths=None):
+        from .gitrepo import GitRepository, UnsupportedRepository
+        try:
+            return GitRepository.discover(os.getcwd()).is_dirty(paths)
+        except UnsupportedRepository as exc:
+            log.info("reading git repository directly is not supported here (%s), running git instead" % exc)
+            return GitVersionCalculator.isDirty(self, paths)
+
+
 class VersionSetByGit(VersionSetCommandBase):
     SHORTNAME = "version_set_by_git"
     description = "set library version from git info"
-    VERSION_CALCULATOR = GitVersionCalculator()
+
+    user_options = VersionSetCommandBase.user_options + [
+        ("calculator=", None,
+         "how git info is read: 'git' runs git describe (default), 'python' reads the repository directly"),
+        ("tag-prefix=", None,
+         "version this library by its own tags, named <prefix><major>.<minor>"),
+        ("scope-paths=", None,
+         "list (or comma-separated) paths, only commits changing them count towards the version"),
+        ("dirty-scope=", None,
+         "which local modifications make the version dirty: 'repository' (default, any tracked file's) or 'manifest' "
+         "(only those of the files the manifest selects for the package)"),
+    ]
+
+    DIRTY_SCOPES = ('repository', 'manifest')
+
+    VERSION_CALCULATORS = {
+        'git': GitVersionCalculator(),
+        'python': PureGitVersionCalculator(),
+    }
+    VERSION_CALCULATOR = VERSION_CALCULATORS['git']
+
+    def initialize_options(self):
+        VersionSetCommandBase.initialize_options(self)
+        self.calculator = None
+        self.tag_prefix = None
+        self.scope_paths = None
+        self.dirty_scope = None
+
+    def finalize_options(self):
+        VersionSetCommandBase.finalize_options(self)
+        if self.calculator is not None:
+            if self.calculator not in self.VERSION_CALCULATORS:
+                raise ValueError("unknown version calculator %r, expected one of %s" % (
+                    self.calculator, sorted(self.VERSION_CALCULATORS)))
+            self.VERSION_CALCULATOR = self.VERSION_CALCULATORS[self.calculator]
+        if isinstance(self.scope_paths, str):
+            self.scope_paths = list(map(str.strip, self.scope_paths.split(",")))
+        if self.dirty_scope is None:
+            self.dirty_scope = 'repository'
+        elif self.dirty_scope not in self.DIRTY_SCOPES:
+            raise ValueError("unknown dirty scope %r, expected one of %s" % (self.dirty_scope, list(self.DIRTY_SCOPES)))
+
+    def get_version_scope(self):
+        return VersionScope.from_paths(self.tag_prefix, self.scope_paths or ())
+
+    def get_dirty_paths(self):
+        if self.dirty_scope != 'manifest':
+            return None
+        from .datafiles import PrepareManifestIn
+        from .manifest import resolve_manifest
+        template = self.get_finalized_command('sdist').template or "MANIFEST.in"
+        # the template as it will be once rewritten - it isn't yet, and a rewritten template would be a modified file
+        template_text = self.get_finalized_command(PrepareManifestIn.SHORTNAME).get_template_text()
+        files, _ = resolve_manifest(self.distribution, template, template_text)
+        log.info("only modifications of the %d files the manifest selects make the version dirty" % len(files))
+        # in an isolated build these are files of the overlay, which stand for (and are compared as) the checkout's
+        return get_work_tree_paths(files)
 
 
 # exposed as a standalone utility
@@ -1,16 +1,123 @@
 """Helper module for managing files that we want to create or modify before we package our library.
+
+Changes are recorded in a journal while the build runs, so the changes of a build that was killed can be undone later
+by running quicklib-recover.
 """
 import contextlib
+import getpass
+import json
 import os
+import shutil
+import tempfile
 
 from setuptools import Command
 from distutils import log
 
+JOURNAL_DIR_ENV = "QUICKLIB_JOURNAL_DIR"
+JOURNAL_EXT = ".journal"
+# relative to the build's working directory, so it is normally on the library tree's file system (backing a file up
+# is then a rename) and is never packaged by sdist
+BACKUPS_DIR = os.path.join("build", "quicklib-backups")
+
+
+class JournalError(Exception):
+    pass
+
+
+def get_journal_dir():
+    """where builds keep their journals, overridable using the QUICKLIB_JOURNAL_DIR environment variable"""
+    journal_dir = os.environ.get(JOURNAL_DIR_ENV)
+    if journal_dir:
+        return journal_dir
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = "default"
+    return os.path.join(tempfile.gettempdir(), "quicklib-journals-%s" % user)
+
+
+def _move(source_path, target_path):
+    try:
+        os.replace(source_path, target_path)
+    except OSError:
+        # e.g. across file systems
+        shutil.move(source_path, target_path)
+
+
+class _Journal:
+    """
+    an append-only record of a build's virtual file changes, so they can be undone after a crash (see quicklib-recover).
+    every entry is flushed to disk before the change it describes is made.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, path, file, backups_dir):
+        self.path = path
+        self.file = file
+        self.backups_dir = backups_dir
+        self.backup_count = 0
+
+    @classmethod
+    def create(cls):
+        journal_dir = get_journal_dir()
+        os.makedirs(journal_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix="%d-" % os.getpid(), suffix=JOURNAL_EXT, dir=journal_dir)
+        journal_id = os.path.basename(path)[:-len(JOURNAL_EXT)]
+        journal = cls(path, os.fdopen(fd, "w"), os.path.abspath(os.path.join(BACKUPS_DIR, journal_id)))
+        journal._append(dict(format=cls.FORMAT_VERSION, pid=os.getpid(), cwd=os.getcwd(),
+                             backups_dir=journal.backups_dir))
+        return journal
+
+    def _append(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record_removal(self, path):
+        self._append(dict(remove=os.path.abspath(path)))
+
+    def record_reversal(self, path):
+        """:return: the path to move the original file to"""
+        os.makedirs(self.backups_dir, exist_ok=True)
+        self.backup_count += 1
+        backup_path = os.path.join(self.backups_dir, "%d-%s" % (self.backup_count, os.path.basename(path)))
+        self._append(dict(revert=os.path.abspath(path), backup=backup_path))
+        return backup_path
+
+    def close(self, delete=True):
+        self.file.close()
+        if delete:
+            os.unlink(self.path)
+            shutil.rmtree(self.backups_dir, ignore_errors=True)
+
 
 class _VirtualFileRegistry:
+    """
+    files created or modified for the duration of a build. a modified file's original is moved aside (a rename, not
+    a copy) and moved back when reverting; every change is recorded in a journal first.
+    """
     def __init__(self):
         self.removal = []
+        # path: backup path of the original file
         self.reversal = {}
+        self.journal = None
+        self.failed = False
+
+    def _get_journal(self):
+        if self.journal is None:
+            self.journal = _Journal.create()
+        return self.journal
+
+    def _finish(self):
+        # the journal is kept, for quicklib-recover, if anything could not be undone
+        if self.journal is None or self.removal or self.reversal:
+            return
+        if self.failed:
+            print("error: some virtual file changes could not be undone, run quicklib-recover to retry (journal: %s)" % (
+                self.journal.path,))
+        self.journal.close(delete=not self.failed)
+        self.journal = None
+        self.failed = False
 
     def register_file_for_removal(self, path):
         if path in self.removal:
@@ -21,9 +128,24 @@ class _VirtualFileRegistry:
             raise Exception("cannot register path %s for removal: file does not exist")
         if not os.path.isfile(path):
             raise Exception("cannot register path %s for removal: not a regular file")
+        self._get_journal().record_removal(path)
+        self.removal.append(path)
+
+    def register_new_file_for_removal(self, path):
+        """register a file about to be created - recorded first, so a crash while writing it can't leave it behind"""
+        if path in self.removal or path in self.reversal:
+            raise Exception("cannot register path %s for removal: already registered" % path)
+        if os.path.lexists(path):
+            raise Exception("cannot create virtual file at %s, file already exists" % path)
+        self._get_journal().record_removal(path)
         self.removal.append(path)
 
-    def register_file_for_reversal(self, path):
+    def register_file_for_reversal(self, path, keep_content=True):
+        """
+        :param keep_content: leave a copy of the original at path (for modifying it in place), otherwise path is left
+                             missing until the caller writes the new content
+        :return: the backup path the original file was moved to
+        """
         if path in self.removal:
             raise Exception("cannot register path %s for reversal: already registered for removal")
         if path in self.reversal:
@@ -32,7 +154,12 @@ class _VirtualFileRegistry:
             raise Exception("cannot register path %s for reversal: file does not exist")
         if not os.path.isfile(path):
             raise Exception("cannot register path %s for reversal: not a regular file")
-        self.reversal[path] = open(path, "rb").read()
+        backup_path = self._get_journal().record_reversal(path)
+        _move(path, backup_path)
+        self.reversal[path] = backup_path
+        if keep_content:
+            shutil.copy2(backup_path, path)
+        return backup_path
 
     def remove(self, pre_callback=None):
         try:
@@ -41,26 +168,81 @@ class _VirtualFileRegistry:
                     pre_callback(p)
                 try:
                     os.unlink(p)
+                except FileNotFoundError:
+                    # registered before it was created, and never was
+                    pass
                 except Exception as exc:
+                    self.failed = True
                     print("error: failed to remove build-time created file %s, left on disk (exc: %s)" % (p, exc))
         finally:
             self.removal = []
+            self._finish()
 
     def revert(self, pre_callback=None):
         try:
-            for p, original_content in self.reversal.items():
+            for p, backup_path in self.reversal.items():
                 if pre_callback is not None:
                     pre_callback(p)
                 try:
-                    open(p, "wb").write(original_content)
+                    _move(backup_path, p)
                 except Exception as exc:
-                    print("error: failed to revert build-time modified file %s, left on disk in modified form (exc: %s)" % (p, exc))
+                    self.failed = True
+                    print("error: failed to revert build-time modified file %s, left on disk in modified form "
+                          "(original kept at %s, exc: %s)" % (p, backup_path, exc))
         finally:
             self.reversal = {}
+            self._finish()
 
 
 virtual_file_registry = _VirtualFileRegistry()
 
+# (source root, overlay root) during an isolated build, see quicklib.isolation
+_overlay = None
+
+
+def set_overlay(source_root, overlay_root):
+    global _overlay
+    _overlay = (source_root, overlay_root) if source_root is not None else None
+
+
+def _overlay_path(path):
+    # relative paths are already relative to the overlay (the working directory), absolute ones may point into the
+    # checkout (e.g. a version module path based on the setup script's __file__)
+    if _overlay is None or not os.path.isabs(path):
+        return path
+    source_root, overlay_root = _overlay
+    rel_path = os.path.relpath(path, source_root)
+    if rel_path == os.curdir or rel_path.startswith(os.pardir) or path.startswith(overlay_root + os.sep):
+        return path
+    return os.path.join(overlay_root, rel_path)
+
+
+def get_source_path(path):
+    """:return: absolute path of the checkout file a path stands for - during an isolated build, not its overlay copy"""
+    path = os.path.abspath(path)
+    if _overlay is None:
+        return path
+    source_root, overlay_root = _overlay
+    rel_path = os.path.relpath(path, overlay_root)
+    if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+        return path
+    return os.path.normpath(os.path.join(source_root, rel_path))
+
+
+def _write_new_file(path, content, binary=False, mode_path=None):
+    # written to a new file that is then moved into place, so a crash never leaves a partially written file
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb" if binary else "w") as f:
+            f.write(content)
+        if mode_path is not None:
+            shutil.copymode(mode_path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
 
 def put_file(path, content, binary=False):
     with open_file(path, binary=binary) as f:
@@ -69,31 +251,26 @@ def put_file(path, content, binary=False):
 
 @contextlib.contextmanager
 def open_file(path, binary=False):
-    if os.path.exists(path):
-        raise Exception("cannot create virtual file at %s, file already exists" % path)
-    mode = "wb" if binary else "w"
-    f = open(path, mode)
-    try:
+    path = _overlay_path(path)
+    virtual_file_registry.register_new_file_for_removal(path)
+    with open(path, "wb" if binary else "w") as f:
         yield f
-    finally:
-        f.close()
-        virtual_file_registry.register_file_for_removal(path)
 
 
 def register_for_removal(path):
-    virtual_file_registry.register_file_for_removal(path)
+    virtual_file_registry.register_file_for_removal(_overlay_path(path))
 
 
 def modify_file(path, content, binary=False):
+    path = _overlay_path(path)
     if not os.path.exists(path):
         raise Exception("cannot virtually modify file at %s, file already exists" % path)
-    virtual_file_registry.register_file_for_reversal(path)
-    mode = "wb" if binary else "w"
-    open(path, mode).write(content)
+    backup_path = virtual_file_registry.register_file_for_reversal(path, keep_content=False)
+    _write_new_file(path, content, binary=binary, mode_path=backup_path)
 
 
 def register_for_reversal(path):
-    virtual_file_registry.register_file_for_reversal(path)
+    virtual_file_registry.register_file_for_reversal(_overlay_path(path))
 
 
 class UndoVirtualFiles(Command):
@@ -115,3 +292,82 @@ class UndoVirtualFiles(Command):
 def undo_virtual_files():
     virtual_file_registry.remove()
     virtual_file_registry.revert()
+
+
+def _is_process_running(pid):
+    if os.name != 'posix':
+        # no safe way to tell, so it is left to an explicit quicklib-recover call
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_journal(path):
+    """:return: (header, entries) of a journal file"""
+    try:
+        with open(path, "r") as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+    except OSError as exc:
+        raise JournalError("journal %s can't be read (%s)" % (path, exc))
+    records = []
+    for index, line in enumerate(lines):
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            if index != len(lines) - 1:
+                raise JournalError("journal %s is malformed at line %d" % (path, index + 1))
+            # cut short by a crash before the change it describes was made
+    if not records or not isinstance(records[0], dict) or records[0].get('format') != _Journal.FORMAT_VERSION:
+        raise JournalError("journal %s has an unknown format" % (path,))
+    return records[0], records[1:]
+
+
+def find_unfinished_journals(journal_dir=None):
+    """:return: paths of the journals left behind by builds that are no longer running"""
+    journal_dir = journal_dir or get_journal_dir()
+    try:
+        names = sorted(n for n in os.listdir(journal_dir) if n.endswith(JOURNAL_EXT))
+    except FileNotFoundError:
+        return []
+    paths = []
+    for name in names:
+        path = os.path.join(journal_dir, name)
+        try:
+            header = read_journal(path)[0]
+        except JournalError:
+            # still being created, or not ours - recovering it is left to an explicit quicklib-recover call
+            continue
+        if not _is_process_running(header.get('pid')):
+            paths.append(path)
+    return paths
+
+
+def recover_journal(path, pre_callback=None):
+    """undo the changes recorded in a journal, newest first, then delete it. :return: number of files restored/removed"""
+    header, entries = read_journal(path)
+    undone = 0
+    for entry in reversed(entries):
+        if 'revert' in entry:
+            # no backup means the original was never moved aside, or was already moved back
+            if os.path.exists(entry['backup']):
+                if pre_callback is not None:
+                    pre_callback("restoring %s" % entry['revert'])
+                _move(entry['backup'], entry['revert'])
+                undone += 1
+        elif 'remove' in entry:
+            if os.path.isfile(entry['remove']):
+                if pre_callback is not None:
+                    pre_callback("removing %s" % entry['remove'])
+                os.unlink(entry['remove'])
+                undone += 1
+        else:
+            raise JournalError("journal %s has an unknown entry %r" % (path, entry))
+    os.unlink(path)
+    if header.get('backups_dir'):
+        shutil.rmtree(header['backups_dir'], ignore_errors=True)
+    return undone
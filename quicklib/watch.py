@@ -0,0 +1,269 @@
+"""Watch mode: keep one process running and rebuild a YAML-based library whenever its inputs change.
+
+The process stays warm between builds: setuptools and quicklib are imported once, the setup YAML files are parsed again
+only when they change, package discovery uses its cache, and the git version is calculated again only when the
+repository's HEAD, refs or index change (or when the first edit may have made a clean checkout dirty).
+
+After each build, the files that went into it are watched: the files the manifest selected, everything under the
+package directories and the top directories of the manifest's files, the setup YAML files (with their includes),
+requirements.txt, setup.cfg and the manifest template. A change only rebuilds the artifacts it affects: files that
+only go into the sdist (e.g. a README) don't rebuild wheels, and files that go into neither rebuild nothing.
+"""
+import json
+import os
+import time
+
+from setuptools.dist import Distribution
+
+from .cli.setupyml import SetupYml
+from .gitrepo import find_git_dir
+from .isolation import SKIPPED_DIRS, SKIPPED_TOP_DIRS
+from .setupapi import SetupModifier, setup_from_yml
+from .versioning import (
+    PRECOMPUTED_VERSIONS_ENV, VersionScope, VersionSetByGit, calculate_version, get_work_tree_paths,
+)
+from .virtualfiles import undo_virtual_files
+
+DEFAULT_INTERVAL = 1.0
+
+# commands whose artifacts are made from the package files only, and commands whose artifacts are made from the manifest
+PACKAGE_COMMANDS = frozenset(["bdist_wheel", "bdist_egg", "bdist", "build", "build_py", "install", "develop"])
+MANIFEST_COMMANDS = frozenset(["sdist"])
+CONFIG_FILES = ("requirements.txt", "setup.cfg", "MANIFEST.in")
+
+
+def split_commands(script_args):
+    """:return: (global options, [(command, its options), ...]) of a setup.py command line"""
+    known_commands = set(name for name, _ in Distribution().get_command_list())
+    known_commands.update(SetupModifier.get_quicklib_commands().keys())
+    global_args = []
+    commands = []
+    for arg in script_args:
+        if arg in known_commands:
+            commands.append((arg, []))
+        elif commands:
+            commands[-1][1].append(arg)
+        else:
+            global_args.append(arg)
+    return global_args, commands
+
+
+def get_git_state(path="."):
+    """:return: stats of the files describing the repository's HEAD, refs and index - changes when a version may"""
+    try:
+        git_dir = find_git_dir(path)[0]
+    except Exception:
+        return None
+    dirs = [git_dir]
+    common_dir_file = os.path.join(git_dir, "commondir")
+    if os.path.exists(common_dir_file):
+        # a worktree: refs and tags live in the main git dir
+        with open(common_dir_file, "r") as f:
+            dirs.append(os.path.normpath(os.path.join(git_dir, f.read().strip())))
+    paths = []
+    for d in dirs:
+        head_path = os.path.join(d, "HEAD")
+        paths.extend([head_path, os.path.join(d, "index"), os.path.join(d, "packed-refs"),
+                      os.path.join(d, "refs", "tags")])
+        if os.path.exists(head_path):
+            with open(head_path, "r") as f:
+                head = f.read().strip()
+            if head.startswith("ref:"):
+                paths.append(os.path.join(d, head[len("ref:"):].strip()))
+    return tuple((p,) + _stamp(p) for p in paths)
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (None, None)
+    return (st.st_mtime_ns, st.st_size)
+
+
+class WatchSession:
+    def __init__(self, setup_yml_path, script_args, interval=DEFAULT_INTERVAL):
+        self.setup_yml_path = setup_yml_path
+        self.global_args, self.commands = split_commands(script_args)
+        if not self.commands:
+            raise ValueError("no setup commands given to run on changes")
+        self.interval = interval
+        self.version = None
+        self.version_scope = None
+        self.git_state = None
+        self.config_paths = set()
+        self.manifest_files = None
+        self.package_dirs = []
+        self.watched_dirs = []
+
+    # ---- what to watch
+
+    def get_watched_files(self):
+        """:return: {path: (mtime, size)} of every watched file"""
+        stamps = {}
+        for path in self.config_paths:
+            stamps[path] = _stamp(path)
+        for path in self.manifest_files or ():
+            stamps[path] = _stamp(path)
+        for top_dir in self.watched_dirs:
+            for dir_path, dirs, files in os.walk(top_dir):
+                dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS and not d.endswith(".egg-info")]
+                for name in files:
+                    path = os.path.normpath(os.path.join(dir_path, name))
+                    stamps[path] = _stamp(path)
+        # top-level files, so new ones the manifest may pick up are noticed
+        for name in os.listdir("."):
+            if os.path.isfile(name):
+                stamps[name] = _stamp(name)
+        # a file that doesn't exist isn't a change to anything, as long as it stays that way
+        return {path: stamp for path, stamp in stamps.items() if stamp != (None, None) or path in self.config_paths}
+
+    def _learn_inputs(self, setup_yml, dist):
+        """remember the inputs of the build that made dist, as the files to watch"""
+        self.config_paths = set(os.path.relpath(path) for path in setup_yml.source_paths)
+        self.config_paths.update(CONFIG_FILES)
+        long_description = setup_yml.setup.get('long_description')
+        if isinstance(long_description, dict) and 'filename' in long_description:
+            self.config_paths.add(os.path.normpath(long_description['filename']))
+        self.package_dirs = sorted(set(package.replace(".", os.sep) for package in dist.packages or ()))
+        self.manifest_files = None
+        if dist.have_run.get('egg_info'):
+            filelist = getattr(dist.get_command_obj('egg_info'), 'filelist', None)
+            if filelist is not None:
+                self.manifest_files = set(os.path.normpath(path) for path in filelist.files
+                                          if ".egg-info" not in path and not os.path.isabs(path))
+        top_dirs = set(package_dir.split(os.sep, 1)[0] for package_dir in self.package_dirs)
+        top_dirs.update(path.split(os.sep, 1)[0] for path in self.manifest_files or () if os.sep in path)
+        self.watched_dirs = sorted(d for d in top_dirs if d not in SKIPPED_TOP_DIRS and os.path.isdir(d))
+
+    # ---- what a change affects
+
+    def _in_package(self, path):
+        return any(path == package_dir or path.startswith(package_dir + os.sep) for package_dir in self.package_dirs)
+
+    def get_affected_commands(self, changed, added_or_removed):
+        """:return: the commands (with their options) whose artifacts the changes affect, in command line order"""
+        affects_packages = affects_manifest = False
+        for path in changed | added_or_removed:
+            if path in self.config_paths or self.manifest_files is None:
+                affects_packages = affects_manifest = True
+                break
+            in_package = self._in_package(path) or os.path.basename(path) == "__init__.py"
+            affects_packages = affects_packages or in_package
+            # new files may be picked up by the manifest template
+            affects_manifest = affects_manifest or path in self.manifest_files or path in added_or_removed
+        affected = []
+        for command, options in self.commands:
+            if command in PACKAGE_COMMANDS:
+                is_affected = affects_packages
+            elif command in MANIFEST_COMMANDS:
+                is_affected = affects_manifest
+            else:
+                is_affected = affects_packages or affects_manifest
+            if is_affected:
+                affected.append((command, options))
+        return affected
+
+    # ---- building
+
+    def get_dirty_paths(self, setup_kwargs):
+        """:return: work tree paths of the only files whose local modifications make the version dirty, None for all"""
+        if setup_kwargs.get('version_dirty_scope') != 'manifest' or self.manifest_files is None:
+            # before the first build the manifest isn't known yet - the build drops a .dirty its files don't warrant
+            return None
+        return get_work_tree_paths(sorted(self.manifest_files))
+
+    def update_version(self, setup_kwargs):
+        """
+        calculate the git version again only if the repository changed - otherwise only whether it's dirty is checked
+        again, as an edit may have made it dirty and reverting the edit clean again
+        """
+        if not setup_kwargs.get('version_module_paths'):
+            self.version = None
+            return
+        calculator = VersionSetByGit.VERSION_CALCULATORS.get(setup_kwargs.get('version_calculator'),
+                                                             VersionSetByGit.VERSION_CALCULATOR)
+        version_scope = VersionScope.from_setup_value(setup_kwargs.get('version_scope'))
+        dirty_paths = self.get_dirty_paths(setup_kwargs)
+        git_state = get_git_state()
+        if self.version is not None and git_state == self.git_state and version_scope.key == self.version_scope.key:
+            clean_version = self.version[:-len(".dirty")] if self.version.endswith(".dirty") else self.version
+            self.version = clean_version + ".dirty" if calculator.isDirty(dirty_paths) else clean_version
+            return
+        self.version_scope = version_scope
+        self.version = calculate_version(calculator, self.version_scope, dirty_paths)
+        self.git_state = git_state
+
+    def build(self, commands):
+        """:return: whether the build succeeded"""
+        setup_yml = SetupYml.load_from_file(self.setup_yml_path)
+        script_args = list(self.global_args)
+        for command, options in commands:
+            script_args += [command] + options
+        start = time.perf_counter()
+        orig_versions_env = os.environ.get(PRECOMPUTED_VERSIONS_ENV)
+        try:
+            self.update_version(setup_yml.setup)
+            if self.version is not None:
+                os.environ[PRECOMPUTED_VERSIONS_ENV] = json.dumps({self.version_scope.key: self.version})
+            dist = setup_from_yml(setup_yml.setup, script_args)
+        except (Exception, SystemExit) as exc:
+            if isinstance(exc, SystemExit):
+                undo_virtual_files()
+            print("watch: build FAILED (%s), waiting for changes" % (exc,))
+            return False
+        finally:
+            if orig_versions_env is None:
+                os.environ.pop(PRECOMPUTED_VERSIONS_ENV, None)
+            else:
+                os.environ[PRECOMPUTED_VERSIONS_ENV] = orig_versions_env
+        self._learn_inputs(setup_yml, dist)
+        print("watch: ran %s in %.1fs%s" % (" ".join(command for command, _ in commands), time.perf_counter() - start,
+                                           "" if self.version is None else " (version %s)" % dist.get_version()))
+        return True
+
+    def wait_for_changes(self, baseline):
+        """:return: (changed paths, added or removed paths, new baseline), once changes stopped for an interval"""
+        current = baseline
+        while True:
+            time.sleep(self.interval)
+            latest = self.get_watched_files()
+            if latest == current and current != baseline:
+                break
+            current = latest
+        changed = set(path for path in current if path in baseline and current[path] != baseline[path])
+        added_or_removed = set(current) ^ set(baseline)
+        return changed, added_or_removed, current
+
+    def _merge_baselines(self, before_build):
+        """:return: the files watched after a build, with the stamps they had before it - changes during it still count"""
+        baseline = self.get_watched_files()
+        baseline.update((path, stamp) for path, stamp in before_build.items() if path in baseline)
+        return baseline
+
+    def run(self, max_builds=None):
+        """build, then rebuild on every change until interrupted (or max_builds builds ran)"""
+        builds = 0
+        baseline = self.get_watched_files()
+        self.build(self.commands)
+        builds += 1
+        baseline = self._merge_baselines(baseline)
+        try:
+            while max_builds is None or builds < max_builds:
+                print("watch: waiting for changes (ctrl-c to stop)")
+                changed, added_or_removed, current = self.wait_for_changes(baseline)
+                affected = self.get_affected_commands(changed, added_or_removed)
+                if not affected:
+                    print("watch: %d files changed, none of them goes into a build" % len(changed | added_or_removed))
+                    baseline = current
+                    continue
+                paths = sorted(changed | added_or_removed)
+                print("watch: %d files changed (%s%s)" % (
+                    len(paths), ", ".join(paths[:5]), ", ..." if len(paths) > 5 else ""))
+                self.build(affected)
+                builds += 1
+                baseline = self._merge_baselines(current)
+        except KeyboardInterrupt:
+            print("watch: stopped")
+        return 0
+
@@ -45,6 +45,7 @@ setup(
     install_requires=[
         'yarg~=0.1.9',
         'PyYAML>=4.2b1',
+        'packaging>=20.0',
     ],
     tests_require=[],
     python_requires=">=3.7",
@@ -67,10 +68,13 @@ setup(
     script_args=script_args,
     command_options={
         'version_set_by_git': {'version_module_paths': ('setup.py', version_module_path)},
+        # libraries' setup scripts import quicklib from this zip at install time, ship it with bytecode
+        'create_incorporated_zip': {'precompile': ('setup.py', True)},
     },
     entry_points={
         'console_scripts': [
             'quicklib-setup = quicklib.cli.quicklibsetup:main',
+            'quicklib-recover = quicklib.cli.recover:main',
             # utilities
             'quicklib-get-git-version = quicklib.versioning:calculate_git_version',
         ],
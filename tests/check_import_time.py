@@ -0,0 +1,73 @@
+"""
+Checks that `import quicklib` stays cheap: it must not load setuptools, distutils or pkg_resources, and must fit in a
+(generous) time budget as measured by `python -X importtime`, taking the best of a few runs.
+
+Run from the repository root:
+
+    python tests/check_import_time.py [--budget-ms 50] [--runs 5]
+
+The budget can also be set using the QUICKLIB_IMPORT_BUDGET_MS environment variable (e.g. for slow CI machines).
+"""
+import os
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FORBIDDEN_MODULES = ("setuptools", "distutils", "pkg_resources")
+DEFAULT_BUDGET_MS = 50.0
+RE_IMPORT_TIME_LINE = re.compile(r"^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|(\s*)(\S+)\s*$")
+
+# only modules loaded by importing quicklib count (site may load some at startup)
+CHECK_CODE = """
+import sys
+preloaded = set(sys.modules)
+import quicklib
+print(",".join(sorted(m for m in set(sys.modules) - preloaded if m.split(".")[0] in %r)))
+""" % (FORBIDDEN_MODULES,)
+
+
+def measure_import():
+    """:return: (cumulative import time of quicklib in microseconds, forbidden modules that got imported)"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_ROOT] + [p for p in [os.environ.get("PYTHONPATH")] if p]))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", CHECK_CODE], cwd=REPO_ROOT, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    cumulative_us = None
+    for line in proc.stderr.splitlines():
+        m = RE_IMPORT_TIME_LINE.match(line)
+        # nested imports are indented further
+        if m and m.group(4) == "quicklib" and len(m.group(3)) <= 1:
+            cumulative_us = int(m.group(2))
+    if cumulative_us is None:
+        raise Exception("no import time reported for quicklib, stderr was:\n%s" % proc.stderr)
+    forbidden = [m for m in proc.stdout.strip().split(",") if m]
+    return cumulative_us, forbidden
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--budget-ms", type=float,
+                        default=float(os.environ.get("QUICKLIB_IMPORT_BUDGET_MS", DEFAULT_BUDGET_MS)))
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    # the first run may include writing bytecode caches
+    measure_import()
+    results = [measure_import() for _ in range(args.runs)]
+    best_ms = min(cumulative_us for cumulative_us, _ in results) / 1000.0
+    forbidden = sorted(set(m for _, modules in results for m in modules))
+
+    print("import quicklib: %.1f ms (best of %d runs, budget %.1f ms)" % (best_ms, args.runs, args.budget_ms))
+    failed = False
+    if forbidden:
+        print("FAILED: import quicklib loaded %s" % ", ".join(forbidden))
+        failed = True
+    if best_ms > args.budget_ms:
+        print("FAILED: import quicklib took longer than its budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
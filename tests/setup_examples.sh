@@ -70,3 +70,124 @@ manifested-show-text | grep "The text here is displayed when running manifested-
 # manifested-verify-exclusion
 popd
 cd ..
+
+# minimal, installed by pip through the PEP 517 backend
+cd minimal
+rm -rf build dist
+pip_uninstall_examples
+printf '[build-system]\nrequires = ["quicklib"]\nbuild-backend = "quicklib.build_backend"\n' > pyproject.toml
+pip install --no-build-isolation .
+rm pyproject.toml
+pushd /tmp
+python -c 'import minimalpkg.__version__; print("minimalpkg version:", minimalpkg.__version__.__version__)'
+how-minimal | grep "so minimal"
+popd
+cd ..
+
+# minimal, reading the repository directly gives the version git describe gives
+cd minimal
+rm -rf build dist
+quicklib-setup sdist
+quicklib-setup version_set_by_git --calculator python sdist
+ls dist
+test $(ls dist | wc -l) -eq 1
+cd ..
+
+# minimal, built again from the build cache
+cd minimal
+build_cache=$(mktemp -d)
+rm -rf build dist
+QUICKLIB_BUILD_CACHE_DIR=$build_cache quicklib-setup sdist | grep "note: build cache miss for sdist"
+rm -rf build dist
+QUICKLIB_BUILD_CACHE_DIR=$build_cache quicklib-setup sdist | grep "note: build cache hit for sdist"
+ls dist/minimal-*.tar.gz
+# a malformed entry is a miss, replaced by the artifacts built instead
+echo "[]" > $(ls -d $build_cache/*/entry.json)
+rm -rf build dist
+QUICKLIB_BUILD_CACHE_DIR=$build_cache quicklib-setup sdist | grep "note: build cache miss for sdist"
+rm -rf build dist
+QUICKLIB_BUILD_CACHE_DIR=$build_cache quicklib-setup sdist | grep "note: build cache hit for sdist"
+rm -rf $build_cache
+cd ..
+
+# minimal, the virtual file changes of a killed build undone by quicklib-recover
+cd minimal
+journal_dir=$(mktemp -d)
+QUICKLIB_JOURNAL_DIR=$journal_dir python -c '
+import os
+from quicklib.virtualfiles import modify_file, open_file
+modify_file("minimalpkg/__init__.py", "# modified by a build\n")
+with open_file("quicklib_killed_build.txt") as f:
+    f.write("partially written")
+    f.flush()
+    os._exit(1)
+' || true
+grep "modified by a build" minimalpkg/__init__.py
+ls quicklib_killed_build.txt
+quicklib-recover $journal_dir/*.journal
+test ! -e quicklib_killed_build.txt
+git diff --exit-code -- minimalpkg
+rm -rf $journal_dir
+cd ..
+
+# examplelibrary_2a and examplelibrary_2b, batch-built side by side in isolation
+cd examplelibrary2
+rm -rf build dist
+pip_uninstall_examples
+quicklib-setup --all --isolated sdist
+pip install dist/examplelibrary_2a-*.tar.gz
+pushd /tmp
+examplescript2a | grep "we are in '2a' variant"
+popd
+ls dist/examplelibrary_2b-*.tar.gz
+cd ..
+
+# version scopes: a library of a throwaway monorepo, versioned by the commits changing it - also in isolated builds
+scoped_repo=$(mktemp -d)
+pushd $scoped_repo
+git init -q
+git config user.email ci@example.com
+git config user.name ci
+mkdir -p liba/pkga libb
+printf 'setup:\n  name: pkga\n  version_module_paths: [pkga/__version__.py]\n  version_scope:\n    paths: [.]\n' > liba/quicklib_setup.yml
+touch liba/pkga/__init__.py
+echo b > libb/b.txt
+git add -A
+git commit -q -m "first"
+git tag -a 1.0 -m "version 1.0"
+echo "# a1" >> liba/pkga/__init__.py && git commit -q -am "a1"
+echo "# a2" >> liba/pkga/__init__.py && git commit -q -am "a2"
+echo b2 >> libb/b.txt && git commit -q -am "b2"
+cd liba
+quicklib-setup sdist
+ls dist/pkga-1.0.2.tar.gz
+rm -rf dist
+QUICKLIB_ISOLATED_BUILD=1 quicklib-setup sdist
+ls dist/pkga-1.0.2.tar.gz
+# only modifications of the library's own files make its version dirty - also in isolated builds
+echo "  version_dirty_scope: manifest" >> quicklib_setup.yml
+echo b3 >> ../libb/b.txt
+rm -rf dist
+QUICKLIB_ISOLATED_BUILD=1 quicklib-setup sdist
+ls dist/pkga-1.0.2.tar.gz
+echo "# a3" >> pkga/__init__.py
+rm -rf dist
+quicklib-setup sdist
+ls dist/pkga-1.0.2.dirty.tar.gz
+rm -rf dist
+QUICKLIB_ISOLATED_BUILD=1 quicklib-setup sdist
+ls dist/pkga-1.0.2.dirty.tar.gz
+# a merge discarding a side branch that changed the library doesn't count, reading the repository directly too
+git checkout -q -- .
+git checkout -q -b side
+echo "# side" >> pkga/__init__.py && git commit -q -am "side"
+git checkout -q -
+git merge -q -s ours --no-edit side
+rm -rf dist
+quicklib-setup sdist
+ls dist/pkga-1.0.2.tar.gz
+rm -rf dist
+quicklib-setup version_set_by_git --calculator python sdist
+ls dist/pkga-1.0.2.tar.gz
+popd
+rm -rf $scoped_repo